@@ -1,5 +1,9 @@
+from concurrent import futures
+import asyncio
+import queue
 import random
 import string
+import threading
 import time
 import os
 
@@ -7,65 +11,116 @@ import grpc
 import core_pb2_grpc
 import core_pb2
 
-import pika
+import chat_client
 
 DEBUG = False
 
 
-def flush_messages(channel, queue):
-    while True:
-        msg = get_message(channel, queue)
-        if msg is None:
+def stream_messages(stub, player):
+    def run():
+        for event in stub.SubscribeEvents(player):
+            print("> " + event.message)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def watch_status(stub, player):
+    # Status updates pushed by game-core whenever the game changes
+    updates = queue.Queue()
+
+    def run():
+        for update in stub.WatchStatus(player):
+            updates.put(update)
+
+    threading.Thread(target=run, daemon=True).start()
+    return updates
+
+
+def wait_for_change(updates, timeout):
+    # Sleeps until the status changes rather than polling for it, then drops
+    # the rest of the pending updates
+    try:
+        updates.get(timeout=timeout)
+    except queue.Empty:
+        return
+    while not updates.empty():
+        updates.get_nowait()
+
+
+def stream_chat(session_id):
+    # RabbitMQ pushes the chat to a consumer on its own event loop; returns
+    # once it is subscribed, or raises why it could not
+    subscribed = futures.Future()
+    consumer = chat_client.ChatConsumer(lambda session_id, line: print("> " + line))
+
+    async def consume():
+        try:
+            await consumer.start()
+            await consumer.subscribe(session_id)
+        except Exception as e:
+            subscribed.set_exception(e)
             return
-        print("> " + msg.decode("utf-8"))
+        subscribed.set_result(None)
+        await asyncio.Event().wait()
 
+    threading.Thread(target=asyncio.run, args=(consume(),), daemon=True).start()
+    subscribed.result()
 
-def get_message(channel, queue):
-    method_frame, header_frame, body = channel.basic_get(queue=queue)
-    if not method_frame or method_frame.NAME == "Basic.GetEmpty":
-        return None
-    else:
-        channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-        return body
 
+def do_batch(stub, actions):
+    # One round trip for the actions of all players
+    return stub.DoBatch(core_pb2.BatchRequest(actions=actions)).results
 
-def play_round(stub, chat, session_id, players):
+
+def play_round(stub, players, updates):
     print("All players send a message to the chat")
-    for p in players:
-        stub.DoChat(core_pb2.ChatRequest(key=p, message="hi"))
-    flush_messages(chat, session_id)
+    do_batch(
+        stub,
+        [
+            core_pb2.Action(chat=core_pb2.ChatRequest(key=p, message="hi"))
+            for p in players
+        ],
+    )
 
     time.sleep(1)
 
     print()
     print("Status of each player:")
-    for i, p in enumerate(players):
-        print(f"player{i}: " + stub.DoGetStatus(core_pb2.StatusRequest(key=p)).message)
+    results = do_batch(
+        stub,
+        [core_pb2.Action(get_status=core_pb2.StatusRequest(key=p)) for p in players],
+    )
+    for i, result in enumerate(results):
+        print(f"player{i}: " + result.message)
     print()
 
     time.sleep(1)
 
     while True:
+        actions = []
         for p in players:
             i = random.choice(range(5))
             if random.randint(0, 2) == 1:
-                try:
-                    stub.DoVoteMurder(
-                        core_pb2.MurderRequest(key=p, target_name=f"player{i}")
+                actions.append(
+                    core_pb2.Action(
+                        vote_murder=core_pb2.MurderRequest(
+                            key=p, target_name=f"player{i}"
+                        )
                     )
-                except Exception as e:
-                    if DEBUG:
-                        print(f"err: {e}")
+                )
             else:
-                try:
-                    stub.DoVoteSacrifice(
-                        core_pb2.SacrificeRequest(key=p, target_name=f"player{i}")
+                actions.append(
+                    core_pb2.Action(
+                        vote_sacrifice=core_pb2.SacrificeRequest(
+                            key=p, target_name=f"player{i}"
+                        )
                     )
-                except Exception as e:
-                    if DEBUG:
-                        print(f"err: {e}")
-            flush_messages(chat, session_id)
-            time.sleep(0.1)
+                )
+        for result in do_batch(stub, actions):
+            if not result.ok and DEBUG:
+                print(f"err: {result.message}")
+        # Votes that change nothing leave the status as it is
+        wait_for_change(updates, timeout=0.5)
 
 
 def run(channel):
@@ -82,16 +137,12 @@ def run(channel):
 
     time.sleep(1)
 
-    print("Connecting to the chat message queue")
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(
-            os.environ["RABBITMQ_HOST"],
-            credentials=pika.credentials.PlainCredentials(
-                username="user", password="bitnami"
-            ),
-        )
-    )
-    chat = connection.channel()
+    use_broker = os.environ.get("CHAT_SOURCE", "rabbitmq") != "grpc"
+    if use_broker:
+        print("Connecting to the chat message queue")
+        stream_chat(session_id)
+    else:
+        print("Subscribing to the game events stream")
     print("Done!")
     print()
     time.sleep(1)
@@ -101,18 +152,21 @@ def run(channel):
 
     time.sleep(1)
 
-    players = [
-        stub.JoinSession(
-            core_pb2.JoinRequest(player_name=f"player{i}", session_id=session_id)
+    players = []
+    for i in range(5):
+        players.append(
+            stub.JoinSession(
+                core_pb2.JoinRequest(player_name=f"player{i}", session_id=session_id)
+            )
         )
-        for i in range(5)
-    ]
-    flush_messages(chat, session_id)
+        if not use_broker and i == 0:
+            stream_messages(stub, players[0])
+    updates = watch_status(stub, players[0])
 
     time.sleep(1)
 
     while True:
-        play_round(stub, chat, session_id, players)
+        play_round(stub, players, updates)
 
 
 def main():
@@ -0,0 +1,193 @@
+# Push-based consumer of the chat game-core publishes to RabbitMQ.
+#
+# game-core publishes the chat lines of every session to one topic exchange,
+# with the routing key "<session ID>.all", or "<session ID>.mafia" for the
+# mafia's chat at night (see services/core/src/chat.py). Each subscription
+# binds a queue of its own, so every listener of a session gets every line.
+# The queues are exclusive and auto-delete, so they go away with their
+# consumer, and their TTL and length limit bound what a slow one can pile up.
+#
+# One connection and channel consume the queues of any number of sessions.
+# RabbitMQ pushes messages as they are published, up to a prefetch window
+# shared by all queues of the channel, so idle sessions cost no traffic at
+# all. Messages are acked in batches: a single ack with `multiple` covers
+# every message handled before it.
+#
+# Tails the chat of sessions from the command line:
+# RABBITMQ_HOST=localhost python3 chat_client.py SESSION_ID [SESSION_ID ...]
+import argparse
+import asyncio
+import os
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+import aio_pika
+
+EXCHANGE = "chat"
+# Lines older than this or beyond this many are dropped from a subscriber's
+# queue, oldest first
+QUEUE_TTL_MS = 60000
+QUEUE_MAX_LENGTH = 1000
+
+# Unacked messages RabbitMQ pushes ahead on the channel
+PREFETCH = 512
+# A batch is acked once this many messages are handled, well before the
+# prefetch window fills up, or after ACK_INTERVAL seconds at the latest
+ACK_EVERY = 128
+ACK_INTERVAL = 0.05
+
+
+class ChatConsumer(object):
+    def __init__(
+        self,
+        on_line: Callable[[str, str], None],
+        host: Optional[str] = None,
+        prefetch: int = PREFETCH,
+        ack_every: int = ACK_EVERY,
+    ):
+        # on_line(session ID, line) is called for every chat line in order
+        self.on_line = on_line
+        self.host = host or os.environ["RABBITMQ_HOST"]
+        self.prefetch = prefetch
+        self.ack_every = ack_every
+
+        self.connection = None
+        self.channel = None
+        self.exchange = None
+        # Session ID -> (queue, consumer tag), and consumer tag -> session ID
+        self.queues: Dict[str, tuple] = dict()
+        self.sessions: Dict[str, str] = dict()
+
+        # The last handled message and how many are unacked up to it
+        self.last = None
+        self.unacked = 0
+        self.flusher = None
+        self.counters: Dict[str, int] = {"messages": 0, "lines": 0, "acks": 0}
+
+    async def start(self):
+        # A robust connection reconnects and restores the consumers
+        self.connection = await aio_pika.connect_robust(
+            host=self.host, login="user", password="bitnami"
+        )
+        self.channel = await self.connection.channel()
+        await self.channel.set_qos(prefetch_count=self.prefetch, global_=True)
+        # Same declaration as game-core's, whichever comes first
+        self.exchange = await self.channel.declare_exchange(
+            EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True
+        )
+        self.flusher = asyncio.create_task(self._flush_acks())
+
+    async def subscribe(self, session_id: str, mafia: bool = False):
+        # Lines published before the subscription are not seen. The mafia
+        # also get the lines for the mafia only; it is up to the broker
+        # permissions to keep others from binding to them
+        queue = await self.channel.declare_queue(
+            exclusive=True,
+            auto_delete=True,
+            arguments={
+                "x-message-ttl": QUEUE_TTL_MS,
+                "x-max-length": QUEUE_MAX_LENGTH,
+            },
+        )
+        await queue.bind(self.exchange, routing_key=f"{session_id}.all")
+        if mafia:
+            await queue.bind(self.exchange, routing_key=f"{session_id}.mafia")
+        tag = await queue.consume(self._on_message)
+        self.queues[session_id] = (queue, tag)
+        self.sessions[tag] = session_id
+
+    async def unsubscribe(self, session_id: str):
+        # Cancelling the only consumer deletes the queue
+        queue, tag = self.queues.pop(session_id)
+        self.sessions.pop(tag)
+        await queue.cancel(tag)
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+        await self._ack()
+        if self.connection is not None:
+            await self.connection.close()
+
+    async def run(self, session_ids: Iterable[str], mafia: bool = False):
+        # Consumes the sessions until cancelled
+        await self.start()
+        try:
+            for session_id in session_ids:
+                await self.subscribe(session_id, mafia)
+            await asyncio.Event().wait()
+        finally:
+            await self.close()
+
+    async def _on_message(self, message: aio_pika.abc.AbstractIncomingMessage):
+        # Deliveries are handled in order, as nothing is awaited before the
+        # message is recorded as the last one
+        session_id = self.sessions.get(message.consumer_tag, "")
+        # game-core batches pending lines of a session into one message
+        lines = message.body.decode("utf-8").split("\n")
+        for line in lines:
+            self.on_line(session_id, line)
+        self.counters["messages"] += 1
+        self.counters["lines"] += len(lines)
+
+        self.last = message
+        self.unacked += 1
+        if self.unacked >= self.ack_every:
+            await self._ack()
+
+    async def _ack(self):
+        message, self.last = self.last, None
+        self.unacked = 0
+        if message is None:
+            return
+        try:
+            await message.ack(multiple=True)
+            self.counters["acks"] += 1
+        except (
+            aio_pika.exceptions.AMQPError,
+            aio_pika.exceptions.ChannelInvalidStateError,
+        ) as e:
+            # The channel is gone along with its unacked messages, which
+            # RabbitMQ delivers again
+            print(f"Failed to ack chat messages: {e}")
+
+    async def _flush_acks(self):
+        # Acks the tail of a burst that stays below ack_every
+        while True:
+            await asyncio.sleep(ACK_INTERVAL)
+            await self._ack()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tails the chat of game sessions")
+    parser.add_argument("session_ids", nargs="+")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH)
+    parser.add_argument("--ack-every", type=int, default=ACK_EVERY)
+    parser.add_argument(
+        "--mafia", action="store_true", help="also get the chat of the mafia"
+    )
+    parser.add_argument(
+        "--quiet", action="store_true", help="count the lines instead of printing"
+    )
+    args = parser.parse_args()
+
+    if args.quiet:
+        on_line = lambda session_id, line: None
+    else:
+        on_line = lambda session_id, line: print(f"{session_id}> {line}")
+    consumer = ChatConsumer(on_line, prefetch=args.prefetch, ack_every=args.ack_every)
+    start = time.perf_counter()
+    try:
+        asyncio.run(consumer.run(args.session_ids, args.mafia))
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.perf_counter() - start
+    counters = consumer.counters
+    print(
+        f"{counters['lines']} lines in {counters['messages']} messages "
+        f"with {counters['acks']} acks over {elapsed:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
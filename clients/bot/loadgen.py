@@ -0,0 +1,393 @@
+from collections import Counter
+from concurrent import futures
+from typing import Dict
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+
+import grpc
+import core_pb2_grpc
+import core_pb2
+
+PLAYERS = 5
+# Deadline of a single RPC, seconds
+RPC_TIMEOUT = 10.0
+# Time to wait for the chat messages in flight when the run is over
+DRAIN_SECONDS = 2.0
+# Share of actions of each kind, the rest are votes like in bot.py
+CHAT_SHARE = 0.2
+STATUS_SHARE = 0.2
+
+
+# Latency histogram with log-linear buckets of 1% width: constant memory no
+# matter how many samples, and histograms of several processes are merged
+# by adding their counts
+class Histogram(object):
+    BASE = 1.01
+    UNIT = 1e-6
+
+    def __init__(self, counts=None):
+        self.counts = Counter(counts or {})
+
+    def add(self, seconds: float):
+        bucket = int(math.log(max(seconds, self.UNIT) / self.UNIT, self.BASE))
+        self.counts[bucket] += 1
+
+    def merge(self, other: "Histogram"):
+        self.counts.update(other.counts)
+
+    def percentile(self, q: float) -> float:
+        total = sum(self.counts.values())
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= q * total:
+                return self.UNIT * self.BASE ** (bucket + 0.5)
+        return 0.0
+
+    def summary(self) -> Dict[str, float]:
+        if not self.counts:
+            return dict()
+        return {
+            "count": sum(self.counts.values()),
+            "p50_ms": self.percentile(0.5) * 1e3,
+            "p99_ms": self.percentile(0.99) * 1e3,
+            "p999_ms": self.percentile(0.999) * 1e3,
+            "max_ms": self.percentile(1.0) * 1e3,
+        }
+
+
+class Stats(object):
+    def __init__(self):
+        self.latency: Dict[str, Histogram] = dict()
+        # RPC method -> status code name -> number of calls
+        self.codes: Dict[str, Counter] = dict()
+        self.event_lag = Histogram()
+        self.events_lost = 0
+        self.sessions = 0
+        self.sessions_failed = 0
+        # Wall clock bounds of the run, to compute the achieved rate
+        self.started = time.time()
+        self.finished = 0.0
+
+    def add_call(self, method: str, code: grpc.StatusCode, seconds: float):
+        self.latency.setdefault(method, Histogram()).add(seconds)
+        self.codes.setdefault(method, Counter())[code.name] += 1
+
+    def to_dict(self):
+        return {
+            "latency": {m: dict(h.counts) for m, h in self.latency.items()},
+            "codes": {m: dict(c) for m, c in self.codes.items()},
+            "event_lag": dict(self.event_lag.counts),
+            "events_lost": self.events_lost,
+            "sessions": self.sessions,
+            "sessions_failed": self.sessions_failed,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+    def merge(self, data):
+        for method, counts in data["latency"].items():
+            self.latency.setdefault(method, Histogram()).merge(Histogram(counts))
+        for method, codes in data["codes"].items():
+            self.codes.setdefault(method, Counter()).update(codes)
+        self.event_lag.merge(Histogram(data["event_lag"]))
+        self.events_lost += data["events_lost"]
+        self.sessions += data["sessions"]
+        self.sessions_failed += data["sessions_failed"]
+        self.started = min(self.started, data["started"])
+        self.finished = max(self.finished, data["finished"])
+
+
+# One game session played by PLAYERS bots.
+#
+# RPCs are issued open-loop: the send times of a session are a Poisson
+# process fixed in advance, so a slow server does not slow the load down.
+# A session still waits for the previous reply before sending the next
+# request, since it needs the tokens, and a late request is sent right away;
+# its latency is counted from the planned send time, so the queueing delay
+# is not hidden (no coordinated omission).
+class Session(object):
+    def __init__(self, stub, stats: Stats, rate: float, deadline: float, events: bool):
+        self.stub = stub
+        self.stats = stats
+        self.rate = rate
+        self.deadline = deadline
+        self.events = events
+        self.loop = asyncio.get_running_loop()
+        self.next_send = self.loop.time() + random.expovariate(rate)
+
+        # Chat message number -> send time, until it comes back as an event
+        self.pending: Dict[str, float] = dict()
+        self.chats = 0
+        # Set by the first event, so the stream is surely subscribed
+        self.watching = asyncio.Event()
+
+    async def run(self):
+        self.stats.sessions += 1
+        response = await self.call(
+            "MakeSession", self.stub.MakeSession, core_pb2.MakeSessionRequest()
+        )
+        if response is None:
+            self.stats.sessions_failed += 1
+            return
+        session_id = response.session_id
+
+        players = []
+        watcher = None
+        try:
+            for i in range(PLAYERS):
+                if self.next_send >= self.deadline:
+                    return
+                player = await self.call(
+                    "JoinSession",
+                    self.stub.JoinSession,
+                    core_pb2.JoinRequest(
+                        player_name=f"player{i}", session_id=session_id
+                    ),
+                )
+                if player is None:
+                    self.stats.sessions_failed += 1
+                    return
+                players.append(player)
+                if self.events and watcher is None:
+                    watcher = asyncio.create_task(self.watch(player))
+
+            while self.next_send < self.deadline:
+                await self.act(players)
+        finally:
+            if watcher is not None:
+                await asyncio.sleep(DRAIN_SECONDS)
+                watcher.cancel()
+                await asyncio.gather(watcher, return_exceptions=True)
+                self.stats.events_lost += len(self.pending)
+
+    async def act(self, players):
+        player = random.choice(players)
+        target = f"player{random.randrange(PLAYERS)}"
+        dice = random.random()
+        if dice < CHAT_SHARE:
+            planned = await self.wait_turn()
+            # Numbered, so that the event stream can tell when it arrives.
+            # Chat sent before the stream is up would never be seen there
+            self.chats += 1
+            text = f"lg-{self.chats}"
+            if self.watching.is_set():
+                self.pending[text] = self.loop.time()
+            response = await self.send(
+                "DoChat",
+                self.stub.DoChat,
+                core_pb2.ChatRequest(key=player, message=text),
+                planned,
+            )
+            if response is None:
+                self.pending.pop(text, None)
+        elif dice < CHAT_SHARE + STATUS_SHARE:
+            await self.call(
+                "DoGetStatus", self.stub.DoGetStatus, core_pb2.StatusRequest(key=player)
+            )
+        elif random.random() < 0.5:
+            await self.call(
+                "DoVoteSacrifice",
+                self.stub.DoVoteSacrifice,
+                core_pb2.SacrificeRequest(key=player, target_name=target),
+            )
+        else:
+            await self.call(
+                "DoVoteMurder",
+                self.stub.DoVoteMurder,
+                core_pb2.MurderRequest(key=player, target_name=target),
+            )
+
+    async def call(self, name: str, method, request):
+        planned = await self.wait_turn()
+        return await self.send(name, method, request, planned)
+
+    async def wait_turn(self) -> float:
+        # Returns the planned send time of the next request
+        planned = self.next_send
+        self.next_send += random.expovariate(self.rate)
+        delay = planned - self.loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return planned
+
+    async def send(self, name: str, method, request, planned: float):
+        try:
+            response = await method(request, timeout=RPC_TIMEOUT)
+            code = grpc.StatusCode.OK
+        except grpc.aio.AioRpcError as e:
+            response = None
+            code = e.code()
+        self.stats.add_call(name, code, self.loop.time() - planned)
+        self.stats.finished = max(self.stats.finished, time.time())
+        return response
+
+    async def watch(self, player):
+        try:
+            async for event in self.stub.WatchEvents(player):
+                self.watching.set()
+                if not event.HasField("chat"):
+                    continue
+                sent = self.pending.pop(event.chat.message, None)
+                if sent is not None:
+                    self.stats.event_lag.add(self.loop.time() - sent)
+        except grpc.aio.AioRpcError:
+            pass
+
+
+async def run_sessions(target: str, sessions: int, rps: float, duration: float, args):
+    channels = [grpc.aio.insecure_channel(target) for _ in range(args.channels)]
+    stats = Stats()
+    deadline = asyncio.get_running_loop().time() + duration
+    # Every session gets the same share of the target RPS
+    rate = rps / sessions
+    tasks = []
+    for i in range(sessions):
+        stub = core_pb2_grpc.GameCoreStub(channels[i % len(channels)])
+        events = random.random() < args.events_ratio
+        tasks.append(
+            asyncio.create_task(Session(stub, stats, rate, deadline, events).run())
+        )
+    await asyncio.gather(*tasks)
+    for channel in channels:
+        await channel.close()
+    return stats.to_dict()
+
+
+def run_process(target: str, sessions: int, rps: float, duration: float, args):
+    return asyncio.run(run_sessions(target, sessions, rps, duration, args))
+
+
+def make_report(args, stats: Stats, elapsed: float):
+    rpcs = dict()
+    total = 0
+    for method in sorted(stats.latency):
+        codes = stats.codes[method]
+        calls = sum(codes.values())
+        total += calls
+        # INVALID_ARGUMENT is the game refusing a move, the bots make lots of
+        # them on purpose; anything else is an error of the service
+        errors = calls - codes.get("OK", 0) - codes.get("INVALID_ARGUMENT", 0)
+        rpcs[method] = {
+            "calls": calls,
+            "rps": calls / elapsed,
+            "codes": dict(codes),
+            "error_rate": errors / calls,
+            "latency": stats.latency[method].summary(),
+        }
+    overall = Histogram()
+    for histogram in stats.latency.values():
+        overall.merge(histogram)
+
+    events = sum(stats.event_lag.counts.values())
+    return {
+        "label": args.label,
+        "target": args.target,
+        "config": {
+            "sessions": args.sessions,
+            "rps": args.rps,
+            "duration": args.duration,
+            "processes": args.processes,
+            "channels": args.channels,
+            "events_ratio": args.events_ratio,
+        },
+        "elapsed": elapsed,
+        "sessions": stats.sessions,
+        "sessions_failed": stats.sessions_failed,
+        "calls": total,
+        "achieved_rps": total / elapsed,
+        "latency": overall.summary(),
+        "rpcs": rpcs,
+        "event_lag": stats.event_lag.summary(),
+        "events_lost": stats.events_lost,
+        "events_loss_rate": stats.events_lost / max(1, events + stats.events_lost),
+    }
+
+
+def print_report(report):
+    print(
+        f"{'rpc':<16} {'calls':>8} {'rps':>8} {'errors':>7} "
+        f"{'p50, ms':>8} {'p99, ms':>8} {'p999, ms':>9}"
+    )
+    rows = list(report["rpcs"].items()) + [("total", report)]
+    for method, row in rows:
+        latency = row["latency"]
+        errors = f"{row['error_rate']:.2%}" if "error_rate" in row else ""
+        rps = row.get("rps", row.get("achieved_rps"))
+        print(
+            f"{method:<16} {row['calls']:>8} {rps:>8.1f} {errors:>7} "
+            f"{latency['p50_ms']:>8.2f} {latency['p99_ms']:>8.2f} "
+            f"{latency['p999_ms']:>9.2f}"
+        )
+    lag = report["event_lag"]
+    if lag:
+        print(
+            f"Event lag: p50 {lag['p50_ms']:.2f} ms, p99 {lag['p99_ms']:.2f} ms, "
+            f"p999 {lag['p999_ms']:.2f} ms, lost {report['events_lost']}"
+        )
+    print(f"Sessions: {report['sessions']}, failed: {report['sessions_failed']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plays many concurrent game sessions at a target rate of "
+        "RPCs and reports latency, errors and event delivery lag"
+    )
+    parser.add_argument("--target", default=os.environ.get("GAME_CORE_URL"))
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--rps", type=float, default=1000.0, help="RPCs per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--channels", type=int, default=4, help="per process")
+    parser.add_argument(
+        "--events-ratio",
+        type=float,
+        default=1.0,
+        help="share of sessions that watch WatchEvents, each stream takes "
+        "a worker thread of a threaded game-core",
+    )
+    parser.add_argument("--label", default="", help="build name for the report")
+    parser.add_argument("--report", default="loadgen-report.json")
+    args = parser.parse_args()
+
+    # Split the sessions and the rate evenly between the processes
+    shares = [args.sessions // args.processes] * args.processes
+    for i in range(args.sessions % args.processes):
+        shares[i] += 1
+    stats = Stats()
+    if args.processes == 1:
+        stats.merge(
+            run_process(args.target, args.sessions, args.rps, args.duration, args)
+        )
+    else:
+        with futures.ProcessPoolExecutor(max_workers=args.processes) as pool:
+            jobs = [
+                pool.submit(
+                    run_process,
+                    args.target,
+                    share,
+                    args.rps * share / args.sessions,
+                    args.duration,
+                    args,
+                )
+                for share in shares
+                if share
+            ]
+            for job in jobs:
+                stats.merge(job.result())
+    elapsed = stats.finished - stats.started
+
+    report = make_report(args, stats, elapsed)
+    print_report(report)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
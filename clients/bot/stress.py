@@ -0,0 +1,125 @@
+from concurrent import futures
+import argparse
+import os
+import time
+
+import grpc
+import core_pb2_grpc
+import core_pb2
+
+
+class Inconsistency(Exception):
+    pass
+
+
+def get_roles(stub, players):
+    roles = dict()
+    for name, p in players.items():
+        msg = stub.DoGetStatus(core_pb2.StatusRequest(key=p)).message
+        if "Role.MAFIA" in msg:
+            roles[name] = "mafia"
+        elif "Role.TOWNIE" in msg:
+            roles[name] = "townie"
+        else:
+            raise Inconsistency(f"Unexpected status of {name}: {msg}")
+    if sorted(roles.values()) != ["mafia"] * 2 + ["townie"] * 3:
+        raise Inconsistency(f"Bad role distribution: {roles}")
+    return roles
+
+
+def expect_phase(stub, players, phase):
+    for name, p in players.items():
+        msg = stub.DoGetStatus(core_pb2.StatusRequest(key=p)).message
+        if phase not in msg:
+            raise Inconsistency(f"{name} expected '{phase}', got: {msg}")
+
+
+def play_session(stub, games):
+    session_id = stub.MakeSession(core_pb2.MakeSessionRequest()).session_id
+    players = {
+        f"player{i}": stub.JoinSession(
+            core_pb2.JoinRequest(player_name=f"player{i}", session_id=session_id)
+        )
+        for i in range(5)
+    }
+
+    # A full lobby must reject newcomers
+    try:
+        stub.JoinSession(
+            core_pb2.JoinRequest(player_name="intruder", session_id=session_id)
+        )
+        raise Inconsistency("Joined a game in progress")
+    except grpc.RpcError as e:
+        if e.code() != grpc.StatusCode.INVALID_ARGUMENT:
+            raise
+
+    # Play a scripted game: townies sacrifice one mafioso a day, mafia murders
+    # a townie at night, so every game ends with a townie victory
+    for _ in range(games):
+        expect_phase(stub, players, "awake")
+        roles = get_roles(stub, players)
+        mafia = [n for n, r in roles.items() if r == "mafia"]
+        townies = [n for n, r in roles.items() if r == "townie"]
+        alive = list(players)
+
+        for n in alive:
+            stub.DoVoteSacrifice(
+                core_pb2.SacrificeRequest(key=players[n], target_name=mafia[0])
+            )
+        alive.remove(mafia[0])
+        expect_phase(stub, {n: players[n] for n in alive}, "asleep")
+
+        stub.DoVoteMurder(
+            core_pb2.MurderRequest(key=players[mafia[1]], target_name=townies[0])
+        )
+        alive.remove(townies[0])
+        expect_phase(stub, {n: players[n] for n in alive}, "awake")
+
+        for n in alive:
+            stub.DoVoteSacrifice(
+                core_pb2.SacrificeRequest(key=players[n], target_name=mafia[1])
+            )
+
+    # The game restarts right away after it is finished
+    expect_phase(stub, players, "awake")
+    get_roles(stub, players)
+    return session_id
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plays many game sessions concurrently and checks that "
+        "every session stays consistent"
+    )
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--games", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=32)
+    args = parser.parse_args()
+
+    with grpc.insecure_channel(os.environ["GAME_CORE_URL"]) as channel:
+        stub = core_pb2_grpc.GameCoreStub(channel)
+        failures = 0
+        start = time.perf_counter()
+        with futures.ThreadPoolExecutor(max_workers=args.threads) as pool:
+            jobs = [
+                pool.submit(play_session, stub, args.games)
+                for _ in range(args.sessions)
+            ]
+            for job in futures.as_completed(jobs):
+                try:
+                    job.result()
+                except Exception as e:
+                    failures += 1
+                    print(f"FAIL: {e}")
+        elapsed = time.perf_counter() - start
+
+    print(f"Sessions: {args.sessions}, failed: {failures}")
+    print(
+        f"Elapsed: {elapsed:.2f}s, {args.sessions * args.games / elapsed:.1f} games/s"
+    )
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
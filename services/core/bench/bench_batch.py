@@ -0,0 +1,104 @@
+# Compares the per-action cost of unary RPCs and DoBatch against an
+# in-process game-core, like a bot farm driving many players would see it.
+# Run from services/core with the generated gRPC modules in src:
+# python3 bench/bench_batch.py
+from concurrent import futures
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ["CHAT_SINK"] = "none"
+
+import grpc  # noqa: E402
+import core_pb2  # noqa: E402
+import core_pb2_grpc  # noqa: E402
+
+import main as game_core  # noqa: E402
+
+SESSIONS = 100
+PLAYERS = 5
+ACTIONS = 5000
+PORT = 50161
+
+
+def make_players(stub):
+    # Started games, so that every player can chat and ask for the status
+    players = []
+    for _ in range(SESSIONS):
+        session_id = stub.MakeSession(core_pb2.MakeSessionRequest()).session_id
+        for i in range(PLAYERS):
+            players.append(
+                stub.JoinSession(
+                    core_pb2.JoinRequest(
+                        player_name=f"player{i}", session_id=session_id
+                    )
+                )
+            )
+    return players
+
+
+def make_actions(players):
+    # Players of a session act one after another, half chat, half ask status
+    actions = []
+    while len(actions) < ACTIONS:
+        for i, player in enumerate(players):
+            if i % 2:
+                actions.append(
+                    core_pb2.Action(chat=core_pb2.ChatRequest(key=player, message="hi"))
+                )
+            else:
+                actions.append(
+                    core_pb2.Action(get_status=core_pb2.StatusRequest(key=player))
+                )
+    return actions[:ACTIONS]
+
+
+def bench_unary(stub, actions):
+    start = time.perf_counter()
+    for action in actions:
+        if action.HasField("chat"):
+            stub.DoChat(action.chat)
+        else:
+            stub.DoGetStatus(action.get_status)
+    return time.perf_counter() - start
+
+
+def bench_batch(stub, actions, size: int):
+    start = time.perf_counter()
+    for i in range(0, len(actions), size):
+        response = stub.DoBatch(core_pb2.BatchRequest(actions=actions[i : i + size]))
+        assert all(result.ok for result in response.results)
+    return time.perf_counter() - start
+
+
+def main():
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    core_pb2_grpc.add_GameCoreServicer_to_server(game_core.GameCore(), server)
+    server.add_insecure_port(f"localhost:{PORT}")
+    server.start()
+    try:
+        with grpc.insecure_channel(f"localhost:{PORT}") as channel:
+            stub = core_pb2_grpc.GameCoreStub(channel)
+            actions = make_actions(make_players(stub))
+
+            print(f"{'mode':>12} {'RPCs':>6} {'us/action':>10} {'actions/s':>10}")
+            elapsed = bench_unary(stub, actions)
+            print(
+                f"{'unary':>12} {len(actions):>6} "
+                f"{elapsed / len(actions) * 1e6:>10.1f} {len(actions) / elapsed:>10.0f}"
+            )
+            for size in [5, 50, 500]:
+                elapsed = bench_batch(stub, actions, size)
+                rpcs = -(-len(actions) // size)
+                print(
+                    f"{f'batch {size}':>12} {rpcs:>6} "
+                    f"{elapsed / len(actions) * 1e6:>10.1f} "
+                    f"{len(actions) / elapsed:>10.0f}"
+                )
+    finally:
+        server.stop(None)
+
+
+if __name__ == "__main__":
+    main()
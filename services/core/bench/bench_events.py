@@ -0,0 +1,82 @@
+# Compares typed game events with their text: the bytes on the wire and the
+# cost of fanning the events of a game out to its subscribers.
+# Run from services/core with the generated gRPC modules in src:
+# python3 bench/bench_events.py
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import events  # noqa: E402
+import game_controller  # noqa: E402
+
+GAMES = 200
+PLAYERS = 7
+
+
+def play_games():
+    # Events of random games where the players vote at random, and chat now
+    # and then at day
+    announced = []
+    rng = random.Random(1)
+    config = game_controller.GameConfig(min_players=PLAYERS, max_players=PLAYERS)
+    game = game_controller.GameController(
+        announced.append, lambda t, m: None, config, rng=rng
+    )
+    tokens = [game.join(f"player{i}") for i in range(PLAYERS)]
+    mafia = game_controller.Role.MAFIA
+    while sum(game.score.values()) < GAMES:
+        alive = [t for t in tokens if game.players[t].alive]
+        targets = [game.players[t].name for t in alive]
+        token = rng.choice(alive)
+        if game.is_day():
+            if rng.random() < 0.3:
+                game.do_chat(token, "I think it is them")
+            game.do_vote_sacrifice(token, rng.choice(targets))
+        elif game.players[token].role == mafia:
+            game.do_vote_murder(token, rng.choice(targets))
+    for event in announced:
+        event.time = time.time()
+    return announced
+
+
+def fan_out_text(announced, subscribers: int):
+    # Every event is rendered once, every line serialized per subscriber
+    start = time.perf_counter()
+    size = 0
+    for event in announced:
+        messages = events.Announcement(event).messages
+        for _ in range(subscribers):
+            for message in messages:
+                size += len(message.SerializeToString())
+    return time.perf_counter() - start, size
+
+
+def fan_out_typed(announced, subscribers: int):
+    start = time.perf_counter()
+    size = 0
+    for event in announced:
+        for _ in range(subscribers):
+            size += len(event.SerializeToString())
+    return time.perf_counter() - start, size
+
+
+def main():
+    announced = play_games()
+    lines = sum(len(events.render(event)) for event in announced)
+    print(f"{GAMES} games of {PLAYERS}: {len(announced)} events, {lines} text lines")
+
+    print(f"{'subscribers':>11} {'form':>6} {'bytes/game':>10} {'us/game':>8}")
+    for subscribers in [1, 10, 100]:
+        for form, fan_out in [("text", fan_out_text), ("typed", fan_out_typed)]:
+            elapsed, size = fan_out(announced, subscribers)
+            print(
+                f"{subscribers:>11} {form:>6} {size / GAMES:>10.0f} "
+                f"{elapsed / GAMES * 1e6:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Measures the overhead of metrics.MetricsInterceptor: per call of a wrapped
+# handler, and on the latency of real RPCs to an in-process game-core.
+# Run from services/core with the generated gRPC modules in src:
+# python3 bench/bench_metrics.py
+from concurrent import futures
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ["CHAT_SINK"] = "none"
+
+import grpc  # noqa: E402
+import core_pb2  # noqa: E402
+import core_pb2_grpc  # noqa: E402
+
+import main as game_core  # noqa: E402
+import metrics  # noqa: E402
+
+CALLS = 20000
+RPCS = 5000
+ROUNDS = 5
+
+
+class FakeContext(object):
+    def code(self):
+        return None
+
+
+def bench_wrapper():
+    # Cost of the wrapper alone around a handler that does nothing
+    handler = grpc.unary_unary_rpc_method_handler(lambda request, context: request)
+    wrapped = metrics._HandlerCache(metrics.Registry(), asynchronous=False).wrap(
+        handler, "/GameCore/Bench"
+    )
+    context = FakeContext()
+    costs = []
+    for behavior in [handler.unary_unary, wrapped.unary_unary]:
+        start = time.perf_counter()
+        for _ in range(CALLS):
+            behavior(None, context)
+        costs.append((time.perf_counter() - start) / CALLS)
+    return costs
+
+
+def bench_rpcs(interceptors, port: int):
+    # Serial DoGetStatus calls, so that the latencies add no queueing
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=4), interceptors=interceptors
+    )
+    core_pb2_grpc.add_GameCoreServicer_to_server(game_core.GameCore(), server)
+    server.add_insecure_port(f"localhost:{port}")
+    server.start()
+    try:
+        with grpc.insecure_channel(f"localhost:{port}") as channel:
+            stub = core_pb2_grpc.GameCoreStub(channel)
+            session_id = stub.MakeSession(core_pb2.MakeSessionRequest()).session_id
+            player = stub.JoinSession(
+                core_pb2.JoinRequest(player_name="player", session_id=session_id)
+            )
+            request = core_pb2.StatusRequest(key=player)
+            latencies = []
+            for _ in range(RPCS):
+                start = time.perf_counter()
+                stub.DoGetStatus(request)
+                latencies.append(time.perf_counter() - start)
+    finally:
+        server.stop(None)
+    latencies.sort()
+    return statistics.mean(latencies), latencies[len(latencies) // 2]
+
+
+def main():
+    plain, wrapped = bench_wrapper()
+    print(
+        f"Handler call: {plain * 1e6:.2f} us bare, {wrapped * 1e6:.2f} us wrapped, "
+        f"overhead {(wrapped - plain) * 1e6:.2f} us"
+    )
+
+    # Rounds alternate between the servers to even out the noise, the best
+    # round of each is reported
+    setups = [("none", []), ("metrics", [metrics.MetricsInterceptor()])]
+    results = {name: [] for name, _ in setups}
+    for round in range(ROUNDS):
+        for i, (name, interceptors) in enumerate(setups):
+            results[name].append(bench_rpcs(interceptors, 50151 + round * 2 + i))
+
+    print(f"{'interceptor':>12} {'mean, us':>10} {'p50, us':>10}")
+    for name, _ in setups:
+        mean, p50 = min(results[name])
+        print(f"{name:>12} {mean * 1e6:>10.1f} {p50 * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
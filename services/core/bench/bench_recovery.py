@@ -0,0 +1,79 @@
+# Measures how long game-core takes to recover its sessions from the journal,
+# and the cost of journaling on the game actions.
+# Run from services/core: python3 bench/bench_recovery.py
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import game_controller  # noqa: E402
+import persistence  # noqa: E402
+
+PLAYERS = 10
+ROUNDS = 3
+
+
+def play(journal: persistence.Journal, session_id: str):
+    # A lobby that fills up and plays a few days and nights, mostly voting
+    config = game_controller.GameConfig(min_players=PLAYERS, max_players=PLAYERS)
+    journal.create(session_id, config)
+    game = game_controller.GameController(
+        lambda event: None,
+        lambda t, m: None,
+        config,
+        record=lambda kind, *fields: journal.record(session_id, kind, *fields),
+    )
+    tokens = [game.join(f"player{i}") for i in range(PLAYERS)]
+    # Everybody but the last player votes, so that the day never ends
+    for _ in range(ROUNDS):
+        for token in tokens[:-1]:
+            game.do_vote_sacrifice(token, "player0")
+    return game
+
+
+def bench(sessions: int):
+    data_dir = tempfile.mkdtemp(prefix="game-core-")
+    try:
+        journal = persistence.Journal(data_dir)
+        start = time.perf_counter()
+        for i in range(sessions):
+            play(journal, f"session{i}")
+        play_cost = time.perf_counter() - start
+        journal.close()
+
+        start = time.perf_counter()
+        journal = persistence.Journal(data_dir)
+        for session_id, state in journal.recover():
+            game_controller.GameController.restore(
+                lambda event: None, lambda t, m: None, state
+            )
+        recovery_time = time.perf_counter() - start
+        journal.close()
+
+        size = sum(
+            os.path.getsize(os.path.join(data_dir, name))
+            for name in os.listdir(data_dir)
+        )
+        return play_cost, recovery_time, size
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def main():
+    print(
+        f"{'sessions':>8} {'play, s':>10} {'recovery, s':>12} "
+        f"{'per session, us':>16} {'on disk, KiB':>13}"
+    )
+    for sessions in [100, 1000, 10000]:
+        play_cost, recovery_time, size = bench(sessions)
+        print(
+            f"{sessions:>8} {play_cost:>10.3f} {recovery_time:>12.3f} "
+            f"{recovery_time / sessions * 1e6:>16.1f} {size // 1024:>13}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Measures the cold start of game-core: the time from spawning the process to
+# its health service reporting the game as SERVING, and to the first
+# successful MakeSession. The chat sink stays enabled, so without a reachable
+# RabbitMQ this also shows that the broker does not hold up startup.
+# Run from services/core with the generated gRPC modules in src:
+# python3 bench/bench_startup.py
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import grpc  # noqa: E402
+from grpc_health.v1 import health_pb2, health_pb2_grpc  # noqa: E402
+import core_pb2  # noqa: E402
+import core_pb2_grpc  # noqa: E402
+
+import utils  # noqa: E402
+
+MAIN = os.path.join(os.path.dirname(__file__), "..", "src", "main.py")
+PORT = 50171
+RUNS = 5
+TIMEOUT = 60
+# Retry the connection often, the default backoff would dominate the timings
+CHANNEL_OPTIONS = [
+    ("grpc.initial_reconnect_backoff_ms", 10),
+    ("grpc.min_reconnect_backoff_ms", 10),
+    ("grpc.max_reconnect_backoff_ms", 20),
+]
+CONFIGS = [
+    ("threads", {"CORE_MODE": "threads"}),
+    ("aio", {"CORE_MODE": "aio"}),
+    ("2 shards", {"CORE_SHARDS": "2"}),
+]
+
+
+def wait_serving(channel):
+    stub = health_pb2_grpc.HealthStub(channel)
+    request = health_pb2.HealthCheckRequest(service=utils.GAME_HEALTH)
+    for response in stub.Watch(request, wait_for_ready=True, timeout=TIMEOUT):
+        if response.status == health_pb2.HealthCheckResponse.SERVING:
+            return
+
+
+def cold_start(env):
+    # Seconds to SERVING and to the first session, of a fresh process
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-u", MAIN],
+        env=dict(os.environ, CORE_PORT=str(PORT), **env),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        with grpc.insecure_channel(f"localhost:{PORT}", CHANNEL_OPTIONS) as channel:
+            wait_serving(channel)
+            serving = time.perf_counter() - start
+            stub = core_pb2_grpc.GameCoreStub(channel)
+            stub.MakeSession(
+                core_pb2.MakeSessionRequest(), wait_for_ready=True, timeout=TIMEOUT
+            )
+            return serving, time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    print(f"{'config':>10} {'serving ms':>11} {'session ms':>11}")
+    for name, env in CONFIGS:
+        runs = [cold_start(env) for _ in range(RUNS)]
+        serving = statistics.median(run[0] for run in runs)
+        session = statistics.median(run[1] for run in runs)
+        print(f"{name:>10} {serving * 1e3:>11.0f} {session * 1e3:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
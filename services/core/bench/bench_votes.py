@@ -0,0 +1,42 @@
+# Measures the per-action cost of GameController as the lobby grows.
+# Run from services/core: python3 bench/bench_votes.py
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import game_controller  # noqa: E402
+
+
+def make_game(players: int) -> game_controller.GameController:
+    config = game_controller.GameConfig(min_players=players, max_players=players)
+    return game_controller.GameController(lambda event: None, lambda t, m: None, config)
+
+
+def bench(players: int):
+    game = make_game(players)
+
+    start = time.perf_counter()
+    tokens = [game.join(f"player{i}") for i in range(players)]
+    join_cost = (time.perf_counter() - start) / players
+
+    # Everybody but the last player votes, so that the day never ends
+    target = "player0"
+    start = time.perf_counter()
+    for token in tokens[:-1]:
+        game.do_vote_sacrifice(token, target)
+    vote_cost = (time.perf_counter() - start) / max(1, players - 1)
+
+    return join_cost, vote_cost
+
+
+def main():
+    print(f"{'players':>8} {'join, us':>10} {'vote, us':>10}")
+    for players in [5, 10, 100, 1000, 10000]:
+        join_cost, vote_cost = bench(players)
+        print(f"{players:>8} {join_cost * 1e6:>10.2f} {vote_cost * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,535 @@
+import asyncio
+import os
+import time
+from typing import Dict, List, Tuple
+
+import grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
+import core_pb2
+import core_pb2_grpc
+
+import aio_pika
+import aiohttp
+
+import utils
+import game_controller
+import events
+import chat
+import sessions
+import batch
+import status
+import persistence
+import metrics
+import scores
+
+SERVING = health_pb2.HealthCheckResponse.SERVING
+NOT_SERVING = health_pb2.HealthCheckResponse.NOT_SERVING
+
+# Chat lines kept while RabbitMQ is away, beyond which new ones are dropped
+CHAT_QUEUE_SIZE = 10000
+CHAT_BACKOFF_MIN = 0.5
+CHAT_BACKOFF_MAX = 30.0
+# Attempts to publish a message, a few minutes with the backoff, before its
+# lines are dropped
+CHAT_MAX_ATTEMPTS = 10
+
+
+# Runs the same GameController as GameCore, but on a single event loop: game
+# logic needs no locking, and chat messages and score updates are sent by
+# background tasks, so RPCs never wait for the broker or the scoreboard.
+class AioGameCore(core_pb2_grpc.GameCore):
+    def __init__(self):
+        # Readiness, reported by the gRPC health service of the server
+        self.health = health.aio.HealthServicer()
+
+        # Init sessions
+        self.sessions = sessions.SessionStore.from_env()
+
+        # In-process fan-out of game events to SubscribeEvents streams
+        self.events = events.EventHub(queue_factory=asyncio.Queue)
+        # And of status changes to WatchStatus streams, fed by the games
+        self.status = events.EventHub(queue_factory=asyncio.Queue)
+        self.feeds: Dict[str, status.StatusFeed] = dict()
+
+        # RabbitMQ is an optional sink for external chat consumers, connected
+        # in the background
+        self.chat_enabled = os.environ.get("CHAT_SINK", "rabbitmq") == "rabbitmq"
+        self.chat_connection = None
+        self.chat_channel = None
+        self.chat_exchange = None
+        # Whether the "chat" health service reports SERVING
+        self.chat_serving = False
+        self.http_session = None
+
+        # (session ID, line, mafia only) and (session ID, townies, mafia) entries
+        self.chat_queue = asyncio.Queue(CHAT_QUEUE_SIZE)
+        self.score_queue = asyncio.Queue()
+        self.chat_dropped = 0
+        self.tasks = []
+
+        # Same metrics as GameCore, timed on the loop
+        self.announce_seconds = metrics.REGISTRY.histogram(
+            "game_core_announce_seconds",
+            "Time to publish a game event to subscribers and the chat sink",
+        )
+        self.chat_publish_seconds = metrics.REGISTRY.histogram(
+            "game_core_chat_publish_seconds",
+            "Time to publish the pending messages of a session to RabbitMQ",
+        )
+        self.score_post_seconds = {
+            outcome: metrics.REGISTRY.histogram(
+                "game_core_score_post_seconds",
+                "Time to post a batch of scores to the scoreboard",
+                outcome=outcome,
+            )
+            for outcome in ["ok", "error"]
+        }
+        metrics.collect_dict(
+            "game_core_sessions",
+            self.sessions.metrics,
+            gauges=["sessions", "rss_bytes"],
+        )
+        if self.chat_enabled:
+            metrics.collect_dict(
+                "game_core_chat",
+                lambda: {
+                    "dropped": self.chat_dropped,
+                    "queue_depth": self.chat_queue.qsize(),
+                },
+                gauges=["queue_depth"],
+            )
+
+        # Sessions survive restarts when CORE_DATA_DIR is set
+        self.journal = None
+        data_dir = os.environ.get("CORE_DATA_DIR")
+        if data_dir:
+            self.journal = persistence.Journal(data_dir)
+
+    async def start(self):
+        for service in ["", utils.GAME_HEALTH]:
+            await self.health.set(service, NOT_SERVING)
+
+        # Keep-alive connections to the scoreboard
+        self.http_session = aiohttp.ClientSession(
+            headers={"Content-Type": "application/json"},
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+
+        # Timers of recovered games need the running loop
+        if self.journal is not None:
+            self._recover()
+
+        self.tasks = [
+            asyncio.create_task(self._post_scores()),
+            asyncio.create_task(self._sweep_sessions()),
+        ]
+        if self.chat_enabled:
+            await self.health.set(utils.CHAT_HEALTH, NOT_SERVING)
+            self.tasks.append(asyncio.create_task(self._publish_chat()))
+
+        for service in ["", utils.GAME_HEALTH]:
+            await self.health.set(service, SERVING)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.http_session is not None:
+            await self.http_session.close()
+        if self.chat_connection is not None:
+            await self.chat_connection.close()
+        if self.journal is not None:
+            self.journal.close()
+
+    async def MakeSession(self, request: core_pb2.MakeSessionRequest, context):
+        session_id = request.session_id
+
+        # Allocate new ID
+        if not session_id:
+            session_id = utils.make_session_id()
+        elif not utils.validate_session_id(session_id):
+            await context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                "Invalid session ID, expected 1 to 64 letters, digits, _ or -",
+            )
+
+        # Validate game config
+        config = None
+        if request.HasField("config"):
+            try:
+                config = game_controller.GameConfig.from_message(request.config)
+            except game_controller.InvalidAction as e:
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        # Reserve the ID before yielding to the loop
+        evicted = self.sessions.add(session_id)
+        if evicted is None:
+            await context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                f"Requested ID is already allocated: {session_id}",
+            )
+        self._close_sessions(evicted)
+
+        # Create a game controller
+        game = self._create_game(session_id, config=config)
+        self.sessions.put(session_id, game)
+
+        return core_pb2.SessionID(session_id=session_id)
+
+    async def JoinSession(self, request: core_pb2.JoinRequest, context):
+        session_id = request.session_id
+        player_name = request.player_name
+
+        game = self._get_session(session_id)
+        try:
+            token = game.join(player_name)
+            return core_pb2.PlayerInfo(player_token=token, session_id=session_id)
+        except game_controller.InvalidAction as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+    async def DoLeave(self, request: core_pb2.LeaveRequest, context):
+        token = request.key.player_token
+        session_id = request.key.session_id
+
+        game = self._get_session(session_id)
+        try:
+            msg = game.do_leave(token)
+            return core_pb2.CoreResponse(message=msg)
+        except game_controller.InvalidAction as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+    async def DoChat(self, request: core_pb2.ChatRequest, context):
+        token = request.key.player_token
+        session_id = request.key.session_id
+        message = request.message
+
+        game = self._get_session(session_id)
+        try:
+            msg = game.do_chat(token, message)
+            return core_pb2.CoreResponse(message=msg)
+        except game_controller.InvalidAction as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+    async def DoVoteSacrifice(self, request: core_pb2.SacrificeRequest, context):
+        token = request.key.player_token
+        session_id = request.key.session_id
+        target = request.target_name
+
+        game = self._get_session(session_id)
+        try:
+            msg = game.do_vote_sacrifice(token, target)
+            return core_pb2.CoreResponse(message=msg)
+        except game_controller.InvalidAction as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+    async def DoVoteMurder(self, request: core_pb2.MurderRequest, context):
+        token = request.key.player_token
+        session_id = request.key.session_id
+        target = request.target_name
+
+        game = self._get_session(session_id)
+        try:
+            msg = game.do_vote_murder(token, target)
+            return core_pb2.CoreResponse(message=msg)
+        except game_controller.InvalidAction as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+    async def DoGetStatus(self, request: core_pb2.StatusRequest, context):
+        token = request.key.player_token
+        session_id = request.key.session_id
+
+        game = self._get_session(session_id)
+        try:
+            msg = game.do_get_status(token)
+            return core_pb2.CoreResponse(message=msg)
+        except game_controller.InvalidAction as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+    async def DoBatch(self, request: core_pb2.BatchRequest, context):
+        try:
+            return batch.apply_batch(request, self.sessions.get, locked=False)
+        except game_controller.InvalidAction as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+    async def SubscribeEvents(self, request: core_pb2.PlayerInfo, context):
+        async for announcement in self._subscribe(request, context):
+            for message in announcement.messages:
+                yield message
+
+    async def WatchEvents(self, request: core_pb2.PlayerInfo, context):
+        async for announcement in self._subscribe(request, context):
+            yield announcement.event
+
+    async def _subscribe(self, request: core_pb2.PlayerInfo, context):
+        # Yields the events.Announcement of the session of the player
+        token = request.player_token
+        session_id = request.session_id
+
+        game = self._get_session(session_id)
+        try:
+            game.get_player_name(token)
+        except game_controller.InvalidAction as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        # A cancelled RPC raises CancelledError at the await
+        sub = self.events.subscribe(session_id)
+        try:
+            while True:
+                announcement = await sub.queue.get()
+                if announcement is None:
+                    break
+                if announcement.event.mafia_only and not game.is_mafia(token):
+                    continue
+                yield announcement
+        finally:
+            sub.close()
+        if sub.overflow:
+            await context.abort(
+                grpc.StatusCode.RESOURCE_EXHAUSTED, "Event stream is lagging behind"
+            )
+
+    async def WatchStatus(self, request: core_pb2.PlayerInfo, context):
+        token = request.player_token
+        session_id = request.session_id
+
+        self._get_session(session_id)
+        try:
+            watch = status.StatusWatch(self.feeds[session_id], token)
+        except game_controller.InvalidAction as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        # No await between the full status and the subscription, so that the
+        # updates continue exactly from it
+        sub = self.status.subscribe(session_id)
+        try:
+            yield watch.first
+            while not watch.done:
+                delta = await sub.queue.get()
+                if delta is None:
+                    break
+                update = watch.view(delta)
+                if update is not None:
+                    yield update
+        finally:
+            sub.close()
+        if sub.overflow:
+            await context.abort(
+                grpc.StatusCode.RESOURCE_EXHAUSTED, "Status stream is lagging behind"
+            )
+
+    def _get_session(self, session_id: str) -> game_controller.GameController:
+        game = self.sessions.get(session_id)
+        if game is None:
+            raise Exception(f"No session with such ID: {session_id}")
+        return game
+
+    def _create_game(
+        self, session_id: str, config=None, state=None
+    ) -> game_controller.GameController:
+        announce = lambda event: self._announce(session_id, event)
+        report = lambda t, m: self.score_queue.put_nowait((session_id, t, m))
+        # Timers run on the loop too, so the game needs no locking
+        schedule = asyncio.get_running_loop().call_later
+        feed = status.StatusFeed(
+            lambda delta: self.status.publish(session_id, delta),
+            lambda: self.status.has_subscribers(session_id),
+        )
+        record = feed.record
+        if self.journal is not None:
+
+            def record(kind, *fields):
+                feed.record(kind, *fields)
+                self.journal.record(session_id, kind, *fields)
+
+        # Either resume a recovered session or start a new one
+        if state is not None:
+            game = game_controller.GameController.restore(
+                announce, report, state, schedule, record
+            )
+        else:
+            if self.journal is not None:
+                self.journal.create(session_id, config or game_controller.GameConfig())
+            game = game_controller.GameController(
+                announce, report, config, schedule, record
+            )
+        feed.attach(game)
+        self.feeds[session_id] = feed
+        return game
+
+    def _recover(self):
+        start = time.perf_counter()
+        for session_id, state in self.journal.recover():
+            self._close_sessions(self.sessions.add(session_id) or [])
+            self.sessions.put(session_id, self._create_game(session_id, state=state))
+        print(
+            f"Recovered {len(self.sessions)} sessions "
+            f"in {time.perf_counter() - start:.3f}s"
+        )
+
+    async def _sweep_sessions(self):
+        while True:
+            await asyncio.sleep(self.sessions.SWEEP_INTERVAL)
+            evicted = self.sessions.sweep()
+            self._close_sessions(evicted)
+            if evicted:
+                metrics = self.sessions.metrics()
+                print(
+                    f"Evicted {len(evicted)} idle sessions, "
+                    f"live: {metrics['sessions']}, "
+                    f"rss: {metrics['rss_bytes'] // 2**20} MiB"
+                )
+
+    def _close_sessions(self, evicted: sessions.Evicted):
+        for session_id, game in evicted:
+            game.close()
+            self.events.close_session(session_id)
+            self.status.close_session(session_id)
+            self.feeds.pop(session_id, None)
+            if self.journal is not None:
+                self.journal.drop(session_id)
+
+    def _announce(self, session_id: str, event: core_pb2.GameEvent):
+        start = time.perf_counter()
+        event.time = time.time()
+        announcement = events.Announcement(event)
+        self.events.publish(session_id, announcement)
+        if self.chat_enabled:
+            for message in announcement.messages:
+                try:
+                    self.chat_queue.put_nowait(
+                        (session_id, message.message, event.mafia_only)
+                    )
+                except asyncio.QueueFull:
+                    self.chat_dropped += 1
+        self.announce_seconds.observe(time.perf_counter() - start)
+
+    async def _connect_chat(self):
+        # Retried until RabbitMQ is up, after which the robust connection
+        # reconnects by itself
+        attempt = 0
+        while True:
+            try:
+                connection = await aio_pika.connect_robust(
+                    host="chat", login="user", password="bitnami"
+                )
+                break
+            except Exception as e:
+                delay = utils.backoff_delay(attempt, CHAT_BACKOFF_MIN, CHAT_BACKOFF_MAX)
+                attempt += 1
+                print(f"Failed to connect to RabbitMQ, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+        self.chat_connection = connection
+        self.chat_channel = await connection.channel()
+        self.chat_exchange = await self.chat_channel.declare_exchange(
+            chat.EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True
+        )
+        print("Connected to RabbitMQ!")
+        await self._set_chat_serving(True)
+
+    async def _publish_chat(self):
+        # Lines announced meanwhile wait in the queue
+        await self._connect_chat()
+        # A single consumer keeps the messages of each session in order. Like
+        # chat.ChatPublisher, it sends all pending lines of a session at once
+        while True:
+            batch = [await self.chat_queue.get()]
+            while not self.chat_queue.empty():
+                batch.append(self.chat_queue.get_nowait())
+            for key, lines in chat.group_lines(batch):
+                await self._publish_lines(key, lines)
+
+    async def _publish_lines(self, key: str, lines: List[str]):
+        # Retried with backoff while the robust connection comes back, with
+        # new lines waiting in the queue meanwhile
+        body = "\n".join(lines).encode("utf-8")
+        attempt = 0
+        while True:
+            try:
+                start = time.perf_counter()
+                await self.chat_exchange.publish(
+                    aio_pika.Message(body=body), routing_key=key
+                )
+                self.chat_publish_seconds.observe(time.perf_counter() - start)
+                await self._set_chat_serving(True)
+                return
+            except Exception as e:
+                await self._set_chat_serving(False)
+                if attempt + 1 >= CHAT_MAX_ATTEMPTS:
+                    self.chat_dropped += len(lines)
+                    print(f"Dropped {len(lines)} chat lines to {key}: {e}")
+                    return
+                delay = utils.backoff_delay(attempt, CHAT_BACKOFF_MIN, CHAT_BACKOFF_MAX)
+                attempt += 1
+                print(f"Failed to publish to {key}, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+
+    async def _set_chat_serving(self, serving: bool):
+        if serving != self.chat_serving:
+            self.chat_serving = serving
+            await self.health.set(
+                utils.CHAT_HEALTH, SERVING if serving else NOT_SERVING
+            )
+
+    async def _post_scores(self):
+        # Like scores.ScoreReporter, coalesces pending updates to the latest
+        # score of each game and sends them in one mutation, and keeps them
+        # and retries with backoff while the scoreboard is unavailable
+        pending: Dict[str, Tuple[int, int]] = dict()
+        attempt = 0
+        while True:
+            if not pending:
+                session_id, t, m = await self.score_queue.get()
+                pending[session_id] = (t, m)
+            self._drain_scores(pending)
+            batch, pending = pending, dict()
+            start = time.perf_counter()
+            try:
+                async with self.http_session.post(
+                    utils.SCOREBOARD_URL, data=utils.make_scores_mutation(batch)
+                ) as response:
+                    response.raise_for_status()
+                    errors = (await response.json(content_type=None)).get("errors")
+                if errors:
+                    # The scoreboard understood the request, retrying will not help
+                    print(f"Scoreboard rejected scores: {errors}")
+                self.score_post_seconds["ok"].observe(time.perf_counter() - start)
+                attempt = 0
+            except Exception as e:
+                self.score_post_seconds["error"].observe(time.perf_counter() - start)
+                # Keep newer scores that arrived while the batch was in flight
+                self._drain_scores(pending)
+                for session_id, score in batch.items():
+                    pending.setdefault(session_id, score)
+                delay = utils.backoff_delay(
+                    attempt,
+                    scores.ScoreReporter.BACKOFF_MIN,
+                    scores.ScoreReporter.BACKOFF_MAX,
+                )
+                attempt += 1
+                print(
+                    f"Failed to report the scores of {len(batch)} games, "
+                    f"retrying in {delay:.1f}s: {e}"
+                )
+                await asyncio.sleep(delay)
+
+    def _drain_scores(self, pending: Dict[str, Tuple[int, int]]):
+        while not self.score_queue.empty():
+            session_id, t, m = self.score_queue.get_nowait()
+            pending[session_id] = (t, m)
+
+
+async def serve(port: str):
+    server = grpc.aio.server(interceptors=[metrics.AioMetricsInterceptor()])
+    core = AioGameCore()
+    core_pb2_grpc.add_GameCoreServicer_to_server(core, server)
+    health_pb2_grpc.add_HealthServicer_to_server(core.health, server)
+    server.add_insecure_port("[::]:" + port)
+    await core.start()
+    await server.start()
+    print(f"Server started, listening on {port} (asyncio)")
+    try:
+        await server.wait_for_termination()
+    finally:
+        await core.health.enter_graceful_shutdown()
+        await server.stop(grace=5)
+        await core.stop()
@@ -0,0 +1,77 @@
+from contextlib import nullcontext
+from typing import Callable, Optional
+
+import core_pb2
+
+import game_controller
+
+# Most actions accepted in one DoBatch
+MAX_ACTIONS = 1000
+
+
+def get_session_id(action: core_pb2.Action) -> str:
+    kind = action.WhichOneof("action")
+    if kind is None:
+        return ""
+    return getattr(action, kind).key.session_id
+
+
+def apply(
+    game: game_controller.GameController, action: core_pb2.Action
+) -> core_pb2.ActionResult:
+    # Same as the unary RPC of the action, with the error in the result
+    kind = action.WhichOneof("action")
+    request = getattr(action, kind)
+    token = request.key.player_token
+    try:
+        if kind == "chat":
+            msg = game.do_chat(token, request.message)
+        elif kind == "vote_sacrifice":
+            msg = game.do_vote_sacrifice(token, request.target_name)
+        elif kind == "vote_murder":
+            msg = game.do_vote_murder(token, request.target_name)
+        elif kind == "get_status":
+            msg = game.do_get_status(token)
+        else:
+            msg = game.do_leave(token)
+    except game_controller.InvalidAction as e:
+        return core_pb2.ActionResult(ok=False, message=str(e))
+    return core_pb2.ActionResult(ok=True, message=msg)
+
+
+def apply_batch(
+    request: core_pb2.BatchRequest,
+    get_session: Callable[[str], Optional[game_controller.GameController]],
+    locked: bool = True,
+) -> core_pb2.BatchResponse:
+    # Applies the actions in order. A run of consecutive actions on the same
+    # session takes the session lock once, so clients that group the actions
+    # of a session together pay for one lock per session
+    if len(request.actions) > MAX_ACTIONS:
+        raise game_controller.InvalidAction(
+            f"Too many actions in a batch: {len(request.actions)} > {MAX_ACTIONS}"
+        )
+
+    response = core_pb2.BatchResponse()
+    actions = request.actions
+    i = 0
+    while i < len(actions):
+        session_id = get_session_id(actions[i])
+        j = i + 1
+        while j < len(actions) and get_session_id(actions[j]) == session_id:
+            j += 1
+
+        game = get_session(session_id) if session_id else None
+        if game is None:
+            for action in actions[i:j]:
+                if action.WhichOneof("action") is None:
+                    msg = "Empty action"
+                else:
+                    msg = f"No session with such ID: {session_id}"
+                response.results.add(ok=False, message=msg)
+        else:
+            with game.lock if locked else nullcontext():
+                for action in actions[i:j]:
+                    response.results.append(apply(game, action))
+        i = j
+    return response
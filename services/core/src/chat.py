@@ -0,0 +1,232 @@
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import itertools
+import queue
+import threading
+import time
+
+import pika
+
+import metrics
+import utils
+
+# Chat lines of all sessions go to one topic exchange, with the routing key
+# "<session ID>.all", or "<session ID>.mafia" for the lines only the mafia may
+# read. Every listener binds a queue of its own to the keys of a session, see
+# clients/bot/chat_client.py, so each of them gets every line; lines nobody
+# listens to are dropped by the exchange rather than kept in a queue.
+EXCHANGE = "chat"
+
+
+def routing_key(session_id: str, mafia_only: bool = False) -> str:
+    return f"{session_id}.{'mafia' if mafia_only else 'all'}"
+
+
+def group_lines(batch: Iterable[Tuple[str, str, bool]]) -> List[Tuple[str, List[str]]]:
+    # Turns (session ID, line, mafia only) items into (routing key, lines)
+    # messages: the lines of a session stay in order, and each run of lines
+    # for the same listeners makes one message
+    sessions: "OrderedDict[str, List[Tuple[bool, str]]]" = OrderedDict()
+    for session_id, line, mafia_only in batch:
+        sessions.setdefault(session_id, []).append((mafia_only, line))
+    messages = []
+    for session_id, lines in sessions.items():
+        for mafia_only, run in itertools.groupby(lines, key=lambda item: item[0]):
+            messages.append(
+                (routing_key(session_id, mafia_only), [line for _, line in run])
+            )
+    return messages
+
+
+# Publishes chat messages to RabbitMQ from a background thread.
+#
+# RPC threads only enqueue messages into a bounded queue, so broker I/O never
+# adds to RPC latency. The worker owns the (not thread-safe) pika connection,
+# drains the queue in batches and publishes the pending lines of a session as
+# one AMQP message with newline-separated lines. Publisher confirms are
+# enabled; on connection errors the worker reconnects with exponential backoff
+# and retries the rest of the batch. The worker connects once started, and
+# until then the queue holds the messages, so the broker never holds up
+# startup.
+class ChatPublisher(object):
+    MAX_BATCH = 256
+    BACKOFF_MIN = 0.5
+    BACKOFF_MAX = 30.0
+    # Idle worker wakes up this often to service connection heartbeats
+    IDLE_POLL = 1.0
+
+    def __init__(
+        self,
+        parameters: pika.ConnectionParameters,
+        maxsize: int = 10000,
+        on_connection: Callable[[bool], None] = lambda connected: None,
+    ):
+        self.parameters = parameters
+        # Called from the worker when the connection goes up or down
+        self.on_connection = on_connection
+        # (session ID, line, mafia only) items, None stops the worker
+        self.queue = queue.Queue(maxsize)
+
+        self.connection = None
+        self.channel = None
+
+        self.closing = False
+        self.counters_lock = threading.Lock()
+        self.counters: Dict[str, int] = {
+            "published": 0,
+            "batches": 0,
+            "dropped": 0,
+            "failed": 0,
+            "connections": 0,
+        }
+        self.publish_seconds = metrics.REGISTRY.histogram(
+            "game_core_chat_publish_seconds",
+            "Time to publish the pending messages of a session to RabbitMQ",
+        )
+
+        self.worker = threading.Thread(
+            target=self._run, name="chat-publisher", daemon=True
+        )
+        self.worker.start()
+
+    def publish(self, session_id: str, msg: str, mafia_only: bool = False):
+        self._put((session_id, msg, mafia_only))
+
+    def metrics(self) -> Dict[str, int]:
+        with self.counters_lock:
+            return dict(self.counters, queue_depth=self.queue.qsize())
+
+    def close(self, timeout: float = 5.0):
+        # Flush what is queued, then stop the worker
+        self.closing = True
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.worker.join(timeout)
+
+    def _put(self, item: Tuple[str, str, bool]):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self._count("dropped")
+
+    def _count(self, name: str, value: int = 1):
+        with self.counters_lock:
+            self.counters[name] += value
+
+    def _run(self):
+        self._connect()
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                self._disconnect()
+                return
+            if batch:
+                self._send(batch)
+
+    def _take_batch(self) -> Optional[List[Tuple[str, str, bool]]]:
+        try:
+            item = self.queue.get(timeout=self.IDLE_POLL)
+        except queue.Empty:
+            self._process_events()
+            return []
+        batch = []
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= self.MAX_BATCH:
+                return batch
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return batch
+        # Stop after flushing the items taken before the sentinel
+        if batch:
+            self._send(batch)
+        return None
+
+    def _send(self, batch: List[Tuple[str, str, bool]]):
+        messages = deque(group_lines(batch))
+
+        attempt = 0
+        while messages:
+            try:
+                self._ensure_connected()
+                while messages:
+                    key, lines = messages[0]
+                    self._publish_lines(key, lines)
+                    messages.popleft()
+                self._count("batches")
+                return
+            except pika.exceptions.AMQPChannelError as e:
+                # The broker refused the message, retrying will not help
+                key, lines = messages.popleft()
+                self._count("failed", len(lines))
+                print(f"Chat message to {key} was rejected: {e}")
+            except (pika.exceptions.AMQPError, OSError) as e:
+                # pika lets socket errors like failed name resolution through
+                self._disconnect()
+                if self.closing:
+                    self._count("failed", sum(len(v) for _, v in messages))
+                    return
+                delay = utils.backoff_delay(attempt, self.BACKOFF_MIN, self.BACKOFF_MAX)
+                attempt += 1
+                print(f"Chat publisher lost RabbitMQ, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+
+    def _connect(self):
+        # Messages published meanwhile wait in the queue
+        attempt = 0
+        while not self.closing:
+            try:
+                self._ensure_connected()
+                return
+            except (pika.exceptions.AMQPError, OSError) as e:
+                delay = utils.backoff_delay(attempt, self.BACKOFF_MIN, self.BACKOFF_MAX)
+                attempt += 1
+                print(f"Failed to connect to RabbitMQ, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+
+    def _publish_lines(self, key: str, lines: List[str]):
+        # Includes waiting for the publisher confirm
+        start = time.perf_counter()
+        self.channel.basic_publish(
+            exchange=EXCHANGE, routing_key=key, body="\n".join(lines)
+        )
+        self.publish_seconds.observe(time.perf_counter() - start)
+        self._count("published", len(lines))
+
+    def _ensure_connected(self):
+        if self.channel is not None and self.channel.is_open:
+            return
+        self._disconnect()
+        self.connection = pika.BlockingConnection(self.parameters)
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(
+            exchange=EXCHANGE, exchange_type="topic", durable=True
+        )
+        self.channel.confirm_delivery()
+        self._count("connections")
+        print("Connected to RabbitMQ!")
+        self.on_connection(True)
+
+    def _process_events(self):
+        if self.connection is None or not self.connection.is_open:
+            return
+        try:
+            self.connection.process_data_events(0)
+        except pika.exceptions.AMQPError:
+            self._disconnect()
+
+    def _disconnect(self):
+        connection = self.connection
+        self.connection = None
+        self.channel = None
+        if connection is None:
+            return
+        self.on_connection(False)
+        if connection.is_open:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError:
+                pass
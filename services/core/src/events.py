@@ -0,0 +1,156 @@
+from typing import Dict, List, Set
+import asyncio
+import queue
+import threading
+
+import core_pb2
+
+GameEvent = core_pb2.GameEvent
+
+
+def render(event: core_pb2.GameEvent) -> List[str]:
+    # The text of an event, as chat lines
+    kind = event.WhichOneof("event")
+    e = getattr(event, kind)
+    lines = []
+    if kind == "joined":
+        if e.name:
+            lines.append(f"A player joines the game: {e.name}")
+        if e.HasField("players"):
+            lines.append(f"Status: {e.players}/{e.max_players} players have joined")
+        if e.HasField("start_delay"):
+            lines.append(
+                f"The game starts in {e.start_delay:g}s or when the lobby is full"
+            )
+    elif kind == "left":
+        lines.append(f"A player leaves the game: {e.name}")
+        if e.HasField("players"):
+            lines.append(f"Status: {e.players}/{e.max_players} players are joined")
+    elif kind == "chat":
+        lines.append(f"[{e.name}] {e.message}")
+    elif kind == "voted":
+        if e.voter:
+            lines.append(f"{e.voter} votes for {e.target}")
+        if e.HasField("voted"):
+            lines.append(
+                f"Status: {e.voted}/{e.alive} players have voted for sacrifice"
+            )
+    elif kind == "died":
+        if e.cause == GameEvent.Died.SACRIFICED:
+            lines.append("Voting is done")
+            if e.tied:
+                names = ",".join(e.tied)
+                if e.more_tied:
+                    names += f" and {e.more_tied} more"
+                lines.append(f"Choosing the target at random among: {names}")
+            lines.append(f"Sacrificing {e.name}")
+        elif e.cause == GameEvent.Died.MURDERED:
+            lines.append("Voting is done")
+            lines.append(f"The mafia have murdered {e.name}")
+        lines.append(f"{e.name} dies!")
+    elif kind == "game_over":
+        if e.winner == core_pb2.ROLE_TOWNIE:
+            lines.append("Mafia is dead, TOWNIES win the game!")
+        else:
+            lines.append("Townies are dead, MAFIA wins the game!")
+        if e.restarting:
+            lines.append("Starting again! Leave if you wish")
+        else:
+            lines.append("Waiting for more players to start again")
+    elif kind == "session_closed":
+        lines.append("The session is closed")
+    # Phase changes have no text of their own
+    return lines
+
+
+# A game event as it is fanned out: built once and shared by all of the
+# subscribers of the session. Its text is only rendered for the consumers
+# that want it, and then once.
+class Announcement(object):
+    def __init__(self, event: core_pb2.GameEvent):
+        self.event = event
+        self._messages = None
+
+    @property
+    def messages(self) -> List[core_pb2.Event]:
+        if self._messages is None:
+            self._messages = [
+                core_pb2.Event(message=line, time=self.event.time)
+                for line in render(self.event)
+            ]
+        return self._messages
+
+
+class Subscription(object):
+    def __init__(self, hub: "EventHub", session_id: str, maxsize: int):
+        self.hub = hub
+        self.session_id = session_id
+        self.queue = hub.queue_factory(maxsize)
+        self.closed = False
+        self.overflow = False
+
+    def push(self, event):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except (queue.Full, asyncio.QueueFull):
+            # A subscriber that cannot keep up is disconnected rather than
+            # slowing down the game or growing without bound
+            self.overflow = True
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.hub.unsubscribe(self)
+        # Wake up the reader; None marks the end of the stream
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except (queue.Full, asyncio.QueueFull):
+                self.queue.get_nowait()
+
+
+# Fans out game events of a session to all of its live subscribers.
+# `queue_factory` builds per-subscriber queues: `queue.Queue` for threaded
+# readers, `asyncio.Queue` for readers on an event loop (then `publish` must be
+# called on the loop as well).
+class EventHub(object):
+    def __init__(self, queue_factory=queue.Queue, maxsize: int = 1024):
+        self.queue_factory = queue_factory
+        self.maxsize = maxsize
+        self.subscribers: Dict[str, Set[Subscription]] = dict()
+        self.lock = threading.Lock()
+
+    def subscribe(self, session_id: str) -> Subscription:
+        sub = Subscription(self, session_id, self.maxsize)
+        with self.lock:
+            self.subscribers.setdefault(session_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self.lock:
+            subs = self.subscribers.get(sub.session_id)
+            if subs is None:
+                return
+            subs.discard(sub)
+            if not subs:
+                self.subscribers.pop(sub.session_id)
+
+    def has_subscribers(self, session_id: str) -> bool:
+        return session_id in self.subscribers
+
+    def publish(self, session_id: str, event):
+        with self.lock:
+            subs = list(self.subscribers.get(session_id, ()))
+        for sub in subs:
+            sub.push(event)
+
+    def close_session(self, session_id: str):
+        with self.lock:
+            subs = list(self.subscribers.get(session_id, ()))
+        for sub in subs:
+            sub.close()
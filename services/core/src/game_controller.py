@@ -1,12 +1,23 @@
+from collections import Counter
 from dataclasses import dataclass
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from enum import Enum
 import random
+import threading
 
 import transitions
+import core_pb2
 
 import utils
 
+GameEvent = core_pb2.GameEvent
+
+PHASES = {
+    "not_started": core_pb2.PHASE_NOT_STARTED,
+    "day": core_pb2.PHASE_DAY,
+    "night": core_pb2.PHASE_NIGHT,
+}
+
 
 class InvalidAction(Exception):
     pass
@@ -26,17 +37,91 @@ class PlayerState:
     vote: str = ""
 
 
+@dataclass
+class GameConfig:
+    # The game starts as soon as max_players have joined, or start_delay
+    # seconds after min_players have joined
+    min_players: int = 5
+    max_players: int = 5
+    mafia_ratio: float = 0.4
+    start_delay: float = 0.0
+
+    MAX_LOBBY = 10000
+
+    @classmethod
+    def from_message(cls, message) -> "GameConfig":
+        # Fields unset in a core_pb2.GameConfig keep their defaults
+        config = cls()
+        for field in ["min_players", "max_players", "mafia_ratio", "start_delay"]:
+            if message.HasField(field):
+                setattr(config, field, getattr(message, field))
+        if message.HasField("max_players") and not message.HasField("min_players"):
+            config.min_players = config.max_players
+        config.validate()
+        return config
+
+    def validate(self):
+        if not 3 <= self.min_players <= self.max_players <= self.MAX_LOBBY:
+            raise InvalidAction(
+                "Bad lobby size: need 3 <= min_players <= max_players <= "
+                f"{self.MAX_LOBBY}"
+            )
+        if not 0 < self.mafia_ratio < 0.5:
+            raise InvalidAction("Bad mafia ratio: need 0 < mafia_ratio < 0.5")
+        if self.start_delay < 0:
+            raise InvalidAction("Bad start delay: need start_delay >= 0")
+
+    def roles(self, players: int) -> List[Role]:
+        mafia = min(max(1, round(players * self.mafia_ratio)), (players - 1) // 2)
+        return [Role.TOWNIE] * (players - mafia) + [Role.MAFIA] * mafia
+
+
 class GameController(object):
     STATES = ["not_started", "day", "night", "finished"]
 
-    ROLES = [Role.TOWNIE, Role.TOWNIE, Role.TOWNIE, Role.MAFIA, Role.MAFIA]
+    # Lobbies up to this size announce every join and vote, larger ones only
+    # report aggregated progress
+    VERBOSE_LOBBY = 20
+    # Names listed in a single announcement
+    MAX_NAMES = 10
+
+    def __init__(
+        self,
+        announce,
+        score_callback,
+        config: Optional[GameConfig] = None,
+        schedule=None,
+        record=None,
+        rng=None,
+    ):
+        # Guards all game state; callers hold it for the whole action
+        self.lock = threading.RLock()
+
+        self.config = config or GameConfig()
+        # schedule(delay, callback) -> handle with cancel(); runs the callback
+        # with the game lock held
+        self.schedule = schedule or self._schedule_thread
+        self.start_timer = None
+        # record(kind, *fields) is told about every change of the game state,
+        # see persistence.Journal and status.StatusFeed
+        self.record = record or (lambda kind, *fields: None)
+        # Source of the role shuffle and the tie breaks, see simulation.py
+        self.rng = rng or random
 
-    def __init__(self, print_message, score_callback):
         self.players: Dict[str, PlayerState] = dict()
         self.visitors: List[str] = []
-        self.score: Dict[Role, int] = {role: 0 for role in set(self.ROLES)}
-
-        self.announce = print_message
+        # Indexes kept up to date by every action, so that none of them has to
+        # scan the players: name -> token, alive players per role, and the
+        # number of votes per target token along with the number of voters
+        self.tokens: Dict[str, str] = dict()
+        self.alive: Counter = Counter()
+        self.votes: Counter = Counter()
+        self.voted = 0
+        self.score: Dict[Role, int] = {Role.TOWNIE: 0, Role.MAFIA: 0}
+
+        # announce(core_pb2.GameEvent) tells the players what happens, see
+        # events.render for its text
+        self.announce = announce
         self.send_score = score_callback
         self.send_score(0, 0)
 
@@ -45,20 +130,53 @@ class GameController(object):
             model=self, states=self.STATES, initial="not_started"
         )
         self.machine.add_transition(
-            "start_game", "not_started", "day", after=["_reset_votes", "_give_roles"]
+            "start_game",
+            "not_started",
+            "day",
+            after=["_record_phase", "_reset_votes", "_give_roles"],
+        )
+        self.machine.add_transition(
+            "finish_day", "day", "night", after=["_record_phase", "_reset_votes"]
         )
-        self.machine.add_transition("finish_day", "day", "night", after="_reset_votes")
         self.machine.add_transition(
-            "finish_night", "night", "day", after="_reset_votes"
+            "finish_night", "night", "day", after=["_record_phase", "_reset_votes"]
         )
         self.machine.add_transition(
             "finish_game",
             ["day", "night"],
             "not_started",
-            after=["_reset_votes", "_reset_alive", "_restart_game"],
+            after=["_reset_votes", "_reset_alive", "_record_phase", "_restart_game"],
         )
         # Can add callbacks as string arguments: before, after, conditions
 
+    @classmethod
+    def restore(
+        cls, announce, score_callback, session, schedule=None, record=None
+    ) -> "GameController":
+        # Rebuilds a game from a persistence.SessionState
+        # Without the 0:0 report of a new game, only the restored score is sent
+        game = cls(announce, lambda townies, mafia: None, session.config, schedule)
+        game.send_score = score_callback
+        game.players = session.players
+        game.score = session.score
+        game.tokens = {p.name: token for token, p in game.players.items()}
+        game.alive = Counter(p.role for p in game.players.values() if p.alive)
+        for p in game.players.values():
+            if p.vote:
+                game.votes[p.vote] += 1
+                game.voted += 1
+        game.machine.set_state(session.state)
+        game.send_score(game.score[Role.TOWNIE], game.score[Role.MAFIA])
+
+        joined = len(game.players)
+        if game.is_not_started() and joined >= game.config.min_players:
+            game.start_timer = game.schedule(
+                game.config.start_delay, game._on_start_timer
+            )
+        if record is not None:
+            game.record = record
+        return game
+
     def join(self, player_name: str) -> str:
         if not self.is_not_started():
             raise InvalidAction("The game is in progress, cannot join")
@@ -76,46 +194,66 @@ class GameController(object):
 
         # Create player info
         self.players[token] = PlayerState(player_name)
+        self.tokens[player_name] = token
+        self.record("join", token, player_name)
         self.visitors.append(player_name)
 
         # Announce status
-        self.announce(f"A player joines the game: {player_name}")
-        self.announce(
-            f"Status: {len(self.players)}/{len(self.ROLES)} players have joined"
-        )
+        joined = len(self.players)
+        event = GameEvent.Joined(max_players=self.config.max_players)
+        if joined <= self.VERBOSE_LOBBY:
+            event.name = player_name
+        if self._is_milestone(joined, self.config.max_players):
+            event.players = joined
+        starting = self.config.min_players == joined < self.config.max_players
+        if starting:
+            event.start_delay = self.config.start_delay
+        if event.name or event.HasField("players") or starting:
+            self.announce(GameEvent(joined=event))
 
         # Advance
-        if len(self.players) == len(self.ROLES):
+        if joined == self.config.max_players:
             self.start_game()
+        elif starting:
+            self.start_timer = self.schedule(
+                self.config.start_delay, self._on_start_timer
+            )
 
         return token
 
     def do_leave(self, token: str) -> str:
         player = self._get_player(token)
 
-        self.announce(f"A player leaves the game: {player.name}")
+        event = GameEvent.Left(name=player.name, max_players=self.config.max_players)
 
         if self.is_not_started():
-            # Remove player
+            # Remove player, recorded while the player can still be looked up
+            self.record("remove", token)
             self.players.pop(token)
+            self.tokens.pop(player.name)
 
             # Announce status
-            self.announce(
-                f"Status: {len(self.players)}/{len(self.ROLES)} players are joined"
-            )
+            event.players = len(self.players)
+            self.announce(GameEvent(left=event))
+            if len(self.players) < self.config.min_players:
+                self._cancel_start_timer()
         else:
             # Kill player
-            self._kill(player, quit=True)
+            self.announce(GameEvent(left=event))
+            self._kill(token, quit=True)
 
         return "OK"
 
     def do_chat(self, token: str, message: str) -> str:
         # Preconditions
         player = self._get_player(token)
-        if self.is_night():
+        # At night only the living mafia talk, among themselves
+        mafia_only = self.is_night()
+        if mafia_only and (player.role != Role.MAFIA or not player.alive):
             raise InvalidAction("Chatting is not allowed at night")
 
-        self.announce(f"[{player.name}] {message}")
+        chat = GameEvent.Chat(name=player.name, message=message)
+        self.announce(GameEvent(chat=chat, mafia_only=mafia_only))
         return "OK"
 
     def do_vote_sacrifice(self, token: str, name: str) -> str:
@@ -135,10 +273,18 @@ class GameController(object):
             raise InvalidAction(f"Player character is dead: {name}")
 
         # Vote
-        player.vote = target_token
+        self._set_vote(token, target_token)
 
         # Announce
-        self.announce(f"{player.name} votes for {target.name}")
+        alive_cnt = self.alive[Role.TOWNIE] + self.alive[Role.MAFIA]
+        event = GameEvent.Voted(alive=alive_cnt)
+        if alive_cnt <= self.VERBOSE_LOBBY:
+            event.voter = player.name
+            event.target = target.name
+        if self._is_milestone(self.voted, alive_cnt):
+            event.voted = self.voted
+        if event.voter or event.HasField("voted"):
+            self.announce(GameEvent(voted=event))
 
         # Advance
         self._check_sacrifice()
@@ -164,7 +310,7 @@ class GameController(object):
             raise InvalidAction(f"Player character is dead: {name}")
 
         # Vote
-        player.vote = target_token
+        self._set_vote(token, target_token)
 
         # Advance
         self._check_murder()
@@ -175,117 +321,189 @@ class GameController(object):
         player = self._get_player(player_name)
 
         if self.is_not_started():
-            return f"Waiting for players: {len(self.players)}/{len(self.ROLES)}"
+            return f"Waiting for players: {len(self.players)}/{self.config.max_players}"
         elif self.is_day():
             return f"The city is awake. You are {player.role}."
         elif self.is_night():
             return f"The city is asleep. You are {player.role}."
         assert False, "Should never reach here"
 
+    def close(self):
+        # The session is going away: stop timers and report the final score
+        self._cancel_start_timer()
+        self.announce(GameEvent(session_closed=GameEvent.SessionClosed()))
+        self.send_score(self.score[Role.TOWNIE], self.score[Role.MAFIA])
+
+    def get_player_name(self, token: str) -> str:
+        return self._get_player(token).name
+
+    def is_mafia(self, token: str) -> bool:
+        player = self.players.get(token)
+        return player is not None and player.role == Role.MAFIA
+
     def _get_player(self, token: str) -> PlayerState:
         if token not in self.players:
             raise InvalidAction(f"No player with such token: {token}")
         return self.players[token]
 
-    def _kill(self, player: PlayerState, quit: bool = False):
+    def _kill(
+        self, token: str, died: Optional[GameEvent.Died] = None, quit: bool = False
+    ) -> bool:
+        player = self._get_player(token)
         if player.alive:
-            self.announce(f"{player.name} dies!")
+            died = died or GameEvent.Died(cause=GameEvent.Died.QUIT)
+            died.name = player.name
+            self.announce(GameEvent(died=died))
             player.alive = False
+            self.alive[player.role] -= 1
+            self._drop_vote(player)
+            self.record("death", token)
         if quit:
-            self.players.popitem(player)
-        self._check_winning()
+            self._drop_votes_for(token)
+            self.record("remove", token)
+            self.players.pop(token)
+            self.tokens.pop(player.name)
+        return self._check_winning()
 
-    def _check_winning(self):
+    def _check_winning(self) -> bool:
         assert not self.is_not_started()
-        mafia_cnt = len(
-            [
-                item
-                for item in self.players.values()
-                if item.alive and item.role == Role.MAFIA
-            ]
-        )
-        townie_cnt = len(
-            [
-                item
-                for item in self.players.values()
-                if item.alive and item.role == Role.TOWNIE
-            ]
-        )
+        mafia_cnt = self.alive[Role.MAFIA]
+        townie_cnt = self.alive[Role.TOWNIE]
         assert mafia_cnt != 0 or townie_cnt != 0
         if mafia_cnt == 0:
-            self.announce("Mafia is dead, TOWNIES win the game!")
-            self.score[Role.TOWNIE] += 1
-            self.finish_game()
-            self.send_score(self.score[Role.TOWNIE], self.score[Role.MAFIA])
+            winner = Role.TOWNIE
         elif townie_cnt == 0:
-            self.announce("Townies are dead, MAFIA wins the game!")
-            self.score[Role.MAFIA] += 1
-            self.finish_game()
-            self.send_score(self.score[Role.TOWNIE], self.score[Role.MAFIA])
+            winner = Role.MAFIA
+        else:
+            return False
 
-    def _check_sacrifice(self):
-        assert self.is_day()
-        alive_players = [p for p in self.players.values() if p.alive]
-        votes = [p.vote for p in alive_players if p.vote]
+        self.score[winner] += 1
+        self.record("score", self.score[Role.TOWNIE], self.score[Role.MAFIA])
         self.announce(
-            f"Status: {len(votes)}/{len(alive_players)} players have voted for sacrifice"
+            GameEvent(
+                game_over=GameEvent.GameOver(
+                    winner=winner.value,
+                    score=core_pb2.Score(
+                        townies=self.score[Role.TOWNIE], mafia=self.score[Role.MAFIA]
+                    ),
+                    restarting=len(self.players) >= self.config.min_players,
+                )
+            )
         )
-        if len(votes) == len(alive_players):
-            self.announce("Voting is done")
-            target = self._choose_voted_player(votes, silent=False)
-            self.announce(f"Sacrificing {target.name}")
-            self._kill(target)
-            if self.is_day():
+        self.finish_game()
+        self.send_score(self.score[Role.TOWNIE], self.score[Role.MAFIA])
+        return True
+
+    def _check_sacrifice(self):
+        assert self.is_day()
+        alive_cnt = self.alive[Role.TOWNIE] + self.alive[Role.MAFIA]
+        if self.voted == alive_cnt:
+            target_token, match = self._choose_voted_player()
+            died = GameEvent.Died(cause=GameEvent.Died.SACRIFICED)
+            if len(match) != 1:
+                died.tied.extend(
+                    self._get_player(t).name for t in match[: self.MAX_NAMES]
+                )
+                died.more_tied = max(0, len(match) - self.MAX_NAMES)
+            # A finished game restarts at day, so only advance the ongoing one
+            if not self._kill(target_token, died):
                 self.finish_day()
 
     def _check_murder(self):
         assert self.is_night()
-        alive_mafia = [
-            p for p in self.players.values() if p.alive and p.role == Role.MAFIA
-        ]
-        votes = [p.vote for p in alive_mafia if p.vote]
-        if len(votes) == len(alive_mafia):
-            self.announce("Voting is done")
-            target = self._choose_voted_player(votes, silent=True)
-            self.announce(f"The mafia have murdered {target.name}")
-            self._kill(target)
-            if self.is_night():
+        # Only mafia can vote at night
+        if self.voted == self.alive[Role.MAFIA]:
+            # The tie among the mafia stays secret
+            target_token, _ = self._choose_voted_player()
+            died = GameEvent.Died(cause=GameEvent.Died.MURDERED)
+            if not self._kill(target_token, died):
                 self.finish_night()
 
-    def _choose_voted_player(self, votes: List[str], silent: bool) -> PlayerState:
-        assert votes
-        # Neglecting O-complexity because item count <= 5
-        votes.sort()
-        max_vote_cnt = votes.count(votes[0])
-        match = [t for t in votes if votes.count(t) == max_vote_cnt]
-        if len(match) != 1 and not silent:
-            self.announce(
-                f"Choosing the target at random among: {','.join(self._get_player(t).name for t in match)}"
-            )
-        target_token = random.choice(match)
-        target = self._get_player(target_token)
-        return target
+    def _choose_voted_player(self) -> Tuple[str, List[str]]:
+        # Returns the target and the tokens it was chosen among
+        assert self.votes
+        max_vote_cnt = max(self.votes.values())
+        match = [t for t, cnt in self.votes.items() if cnt == max_vote_cnt]
+        return self.rng.choice(match), match
 
     def _get_token_by_name(self, name: str) -> Optional[str]:
-        match = [token for token, player in self.players.items() if player.name == name]
-        if len(match) != 1:
-            return None
-        return match[0]
+        return self.tokens.get(name)
+
+    def _set_vote(self, token: str, target_token: str):
+        player = self._get_player(token)
+        self._drop_vote(player)
+        player.vote = target_token
+        self.votes[target_token] += 1
+        self.voted += 1
+        self.record("vote", token, target_token)
+
+    def _drop_vote(self, player: PlayerState):
+        if not player.vote:
+            return
+        self.votes[player.vote] -= 1
+        if not self.votes[player.vote]:
+            del self.votes[player.vote]
+        self.voted -= 1
+        player.vote = ""
+
+    def _drop_votes_for(self, target_token: str):
+        # Voters for a player who left have to vote again. Scans the players,
+        # which only leaving does
+        for player in self.players.values():
+            if player.vote == target_token:
+                self._drop_vote(player)
 
     def _reset_votes(self):
         for p in self.players.values():
             p.vote = ""
+        self.votes.clear()
+        self.voted = 0
 
     def _reset_alive(self):
         for p in self.players.values():
             p.alive = True
 
+    def _is_milestone(self, done: int, total: int) -> bool:
+        # Report every step in small lobbies and every 10% in large ones
+        step = 1 if total <= self.VERBOSE_LOBBY else total // 10
+        return done % step == 0 or done == total
+
+    def _schedule_thread(self, delay: float, callback):
+        def run():
+            with self.lock:
+                callback()
+
+        timer = threading.Timer(delay, run)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _cancel_start_timer(self):
+        if self.start_timer is not None:
+            self.start_timer.cancel()
+            self.start_timer = None
+
+    def _on_start_timer(self):
+        self.start_timer = None
+        if self.is_not_started() and len(self.players) >= self.config.min_players:
+            self.start_game()
+
     def _give_roles(self):
-        roles = [r for r in self.ROLES]
-        random.shuffle(roles)
+        self._cancel_start_timer()
+        roles = self.config.roles(len(self.players))
+        self.rng.shuffle(roles)
         for i, p in enumerate(self.players.values()):
             p.role = roles[i]
+        self.alive = Counter(p.role for p in self.players.values() if p.alive)
+        self.record("roles", roles)
+
+    def _record_phase(self):
+        self.record("phase", self.state)
+        self.announce(
+            GameEvent(phase_changed=GameEvent.PhaseChanged(phase=PHASES[self.state]))
+        )
 
     def _restart_game(self):
-        self.announce("Starting again! Leave if you wish")
-        self.start_game()
+        # GameOver has told the players whether it restarts
+        if len(self.players) >= self.config.min_players:
+            self.start_game()
@@ -1,9 +1,17 @@
 from concurrent import futures
+import asyncio
 import logging
+from typing import Dict
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
 import time
-import requests
 
 import grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
 import core_pb2
 import core_pb2_grpc
 
@@ -12,32 +20,97 @@ import atexit
 
 import utils
 import game_controller
+import events
+import chat
+import scores
+import sessions
+import batch
+import status
+import persistence
+import metrics
+
+# Event stream reader wakes up this often to notice a cancelled RPC
+SUBSCRIPTION_POLL_SECONDS = 1.0
+
+SERVING = health_pb2.HealthCheckResponse.SERVING
+NOT_SERVING = health_pb2.HealthCheckResponse.NOT_SERVING
 
 
 class GameCore(core_pb2_grpc.GameCore):
-    def __init__(self):
+    def __init__(self, max_streams: int = 8):
+        # Readiness, reported by the gRPC health service of the server
+        self.health = health.HealthServicer()
+        for service in ["", utils.GAME_HEALTH]:
+            self.health.set(service, NOT_SERVING)
+
         # Init sessions
-        self.sessions = dict()
+        self.sessions = sessions.SessionStore.from_env()
 
-        # Init connection to the chat
-        self.chat_connection = None
-        while self.chat_connection is None:
-            try:
-                connection = pika.BlockingConnection(
-                    pika.ConnectionParameters(
-                        "chat",
-                        credentials=pika.credentials.PlainCredentials(
-                            username="user", password="bitnami"
-                        ),
+        # In-process fan-out of game events to SubscribeEvents streams
+        self.events = events.EventHub()
+        # And of status changes to WatchStatus streams, fed by the games
+        self.status = events.EventHub()
+        self.feeds: Dict[str, status.StatusFeed] = dict()
+        # Each open stream holds a worker thread of the server for its whole
+        # life, so only some of them may, leaving the rest to unary RPCs
+        self.max_streams = max_streams
+        self.streams = threading.BoundedSemaphore(max_streams)
+
+        # Scores are reported to the scoreboard in the background
+        self.scores = scores.ScoreReporter()
+        atexit.register(self.scores.close)
+
+        # RabbitMQ is an optional sink for external chat consumers. It is
+        # connected in the background, games do not wait for it
+        self.chat = None
+        if os.environ.get("CHAT_SINK", "rabbitmq") == "rabbitmq":
+            self.health.set(utils.CHAT_HEALTH, NOT_SERVING)
+            self.chat = chat.ChatPublisher(
+                pika.ConnectionParameters(
+                    "chat",
+                    credentials=pika.credentials.PlainCredentials(
+                        username="user", password="bitnami"
                     ),
-                )
-                self.chat_connection = connection
-                print("Connected to RabbitMQ!")
-            except Exception as e:
-                print(f"Failed to connect to RabbitMQ: {e}")
-                time.sleep(5)
-        atexit.register(self.chat_connection.close)
-        self.chat_channel = self.chat_connection.channel()
+                ),
+                on_connection=lambda connected: self.health.set(
+                    utils.CHAT_HEALTH, SERVING if connected else NOT_SERVING
+                ),
+            )
+            atexit.register(self.chat.close)
+
+        # Sessions survive restarts when CORE_DATA_DIR is set
+        self.journal = None
+        data_dir = os.environ.get("CORE_DATA_DIR")
+        if data_dir:
+            self.journal = persistence.Journal(data_dir)
+            atexit.register(self.journal.close)
+            self._recover()
+
+        # Metrics kept by the components, exported when scraped
+        self.announce_seconds = metrics.REGISTRY.histogram(
+            "game_core_announce_seconds",
+            "Time to publish a game event to subscribers and the chat sink",
+        )
+        metrics.collect_dict(
+            "game_core_sessions",
+            self.sessions.metrics,
+            gauges=["sessions", "rss_bytes"],
+        )
+        metrics.collect_dict(
+            "game_core_scores", self.scores.metrics, gauges=["pending"]
+        )
+        if self.chat is not None:
+            metrics.collect_dict(
+                "game_core_chat", self.chat.metrics, gauges=["queue_depth"]
+            )
+
+        # Evict idle sessions in the background
+        threading.Thread(
+            target=self._sweep_sessions, name="session-sweeper", daemon=True
+        ).start()
+
+        for service in ["", utils.GAME_HEALTH]:
+            self.health.set(service, SERVING)
 
     def MakeSession(self, request: core_pb2.MakeSessionRequest, context):
         session_id = request.session_id
@@ -45,28 +118,32 @@ class GameCore(core_pb2_grpc.GameCore):
         # Allocate new ID
         if not session_id:
             session_id = utils.make_session_id()
+        elif not utils.validate_session_id(session_id):
+            context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                "Invalid session ID, expected 1 to 64 letters, digits, _ or -",
+            )
 
-        # Validate session ID
-        if session_id in self.sessions:
+        # Validate game config
+        config = None
+        if request.HasField("config"):
+            try:
+                config = game_controller.GameConfig.from_message(request.config)
+            except game_controller.InvalidAction as e:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        # Reserve session ID
+        evicted = self.sessions.add(session_id)
+        if evicted is None:
             context.abort(
                 grpc.StatusCode.INVALID_ARGUMENT,
                 f"Requested ID is already allocated: {session_id}",
             )
-
-        # Create a message queue for the in-game chat
-        self.chat_channel.queue_declare(queue=session_id)
+        self._close_sessions(evicted)
 
         # Create a game controller
-        self.sessions[session_id] = game_controller.GameController(
-            lambda msg: self.chat_channel.basic_publish(
-                exchange="", routing_key=session_id, body=msg
-            ),
-            lambda t, m: requests.post(
-                "http://scoreboard:5000/graphql",
-                data=f'{{"query": "mutation {{ updateGame(gameID:\\"{session_id}\\", towniesScore:{t}, mafiaScore:{m}) {{id}}}}"}}',
-                headers={"Content-Type": "application/json"},
-            ),
-        )
+        game = self._create_game(session_id, config=config)
+        self.sessions.put(session_id, game)
 
         return core_pb2.SessionID(session_id=session_id)
 
@@ -76,7 +153,8 @@ class GameCore(core_pb2_grpc.GameCore):
 
         game = self._get_session(session_id)
         try:
-            token = game.join(player_name)
+            with game.lock:
+                token = game.join(player_name)
             return core_pb2.PlayerInfo(player_token=token, session_id=session_id)
         except game_controller.InvalidAction as e:
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
@@ -87,7 +165,8 @@ class GameCore(core_pb2_grpc.GameCore):
 
         game = self._get_session(session_id)
         try:
-            msg = game.do_leave(token)
+            with game.lock:
+                msg = game.do_leave(token)
             return core_pb2.CoreResponse(message=msg)
         except game_controller.InvalidAction as e:
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
@@ -99,7 +178,8 @@ class GameCore(core_pb2_grpc.GameCore):
 
         game = self._get_session(session_id)
         try:
-            msg = game.do_chat(token, message)
+            with game.lock:
+                msg = game.do_chat(token, message)
             return core_pb2.CoreResponse(message=msg)
         except game_controller.InvalidAction as e:
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
@@ -111,7 +191,8 @@ class GameCore(core_pb2_grpc.GameCore):
 
         game = self._get_session(session_id)
         try:
-            msg = game.do_vote_sacrifice(token, target)
+            with game.lock:
+                msg = game.do_vote_sacrifice(token, target)
             return core_pb2.CoreResponse(message=msg)
         except game_controller.InvalidAction as e:
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
@@ -123,7 +204,8 @@ class GameCore(core_pb2_grpc.GameCore):
 
         game = self._get_session(session_id)
         try:
-            msg = game.do_vote_murder(token, target)
+            with game.lock:
+                msg = game.do_vote_murder(token, target)
             return core_pb2.CoreResponse(message=msg)
         except game_controller.InvalidAction as e:
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
@@ -134,24 +216,264 @@ class GameCore(core_pb2_grpc.GameCore):
 
         game = self._get_session(session_id)
         try:
-            msg = game.do_get_status(token)
+            with game.lock:
+                msg = game.do_get_status(token)
             return core_pb2.CoreResponse(message=msg)
         except game_controller.InvalidAction as e:
             context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
 
+    def DoBatch(self, request: core_pb2.BatchRequest, context):
+        try:
+            return batch.apply_batch(request, self.sessions.get)
+        except game_controller.InvalidAction as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+    def SubscribeEvents(self, request: core_pb2.PlayerInfo, context):
+        for announcement in self._limit(self._subscribe(request, context), context):
+            yield from announcement.messages
+
+    def WatchEvents(self, request: core_pb2.PlayerInfo, context):
+        for announcement in self._limit(self._subscribe(request, context), context):
+            yield announcement.event
+
+    def WatchStatus(self, request: core_pb2.PlayerInfo, context):
+        yield from self._limit(self._watch_status(request, context), context)
+
+    def _limit(self, stream, context):
+        # Runs the stream in one of the max_streams slots, or refuses it
+        if not self.streams.acquire(blocking=False):
+            context.abort(
+                grpc.StatusCode.RESOURCE_EXHAUSTED,
+                f"Too many open streams: {self.max_streams}",
+            )
+        try:
+            yield from stream
+        finally:
+            self.streams.release()
+
+    def _subscribe(self, request: core_pb2.PlayerInfo, context):
+        # Yields the events.Announcement of the session of the player
+        token = request.player_token
+        session_id = request.session_id
+
+        game = self._get_session(session_id)
+        try:
+            with game.lock:
+                game.get_player_name(token)
+                # Subscribe under the game lock so that no event is missed
+                sub = self.events.subscribe(session_id)
+        except game_controller.InvalidAction as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        context.add_callback(sub.close)
+        try:
+            while context.is_active():
+                try:
+                    announcement = sub.queue.get(timeout=SUBSCRIPTION_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                if announcement is None:
+                    break
+                if announcement.event.mafia_only and not game.is_mafia(token):
+                    continue
+                yield announcement
+        finally:
+            sub.close()
+        if sub.overflow:
+            context.abort(
+                grpc.StatusCode.RESOURCE_EXHAUSTED, "Event stream is lagging behind"
+            )
+
+    def _watch_status(self, request: core_pb2.PlayerInfo, context):
+        token = request.player_token
+        session_id = request.session_id
+
+        game = self._get_session(session_id)
+        try:
+            with game.lock:
+                # Take the full status and subscribe at once, so that the
+                # updates continue exactly from it
+                watch = status.StatusWatch(self.feeds[session_id], token)
+                sub = self.status.subscribe(session_id)
+        except game_controller.InvalidAction as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        context.add_callback(sub.close)
+        try:
+            yield watch.first
+            while context.is_active() and not watch.done:
+                try:
+                    delta = sub.queue.get(timeout=SUBSCRIPTION_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                if delta is None:
+                    break
+                update = watch.view(delta)
+                if update is not None:
+                    yield update
+        finally:
+            sub.close()
+        if sub.overflow:
+            context.abort(
+                grpc.StatusCode.RESOURCE_EXHAUSTED, "Status stream is lagging behind"
+            )
+
     def _get_session(self, session_id: str) -> game_controller.GameController:
-        if session_id not in self.sessions:
+        game = self.sessions.get(session_id)
+        if game is None:
             raise Exception(f"No session with such ID: {session_id}")
-        return self.sessions[session_id]
+        return game
+
+    def _create_game(
+        self, session_id: str, config=None, state=None
+    ) -> game_controller.GameController:
+        announce = lambda event: self._announce(session_id, event)
+        report = lambda t, m: self.scores.report(session_id, t, m)
+        feed = status.StatusFeed(
+            lambda delta: self.status.publish(session_id, delta),
+            lambda: self.status.has_subscribers(session_id),
+        )
+        record = feed.record
+        if self.journal is not None:
+
+            def record(kind, *fields):
+                feed.record(kind, *fields)
+                self.journal.record(session_id, kind, *fields)
+
+        # Either resume a recovered session or start a new one
+        if state is not None:
+            game = game_controller.GameController.restore(
+                announce, report, state, record=record
+            )
+        else:
+            if self.journal is not None:
+                self.journal.create(session_id, config or game_controller.GameConfig())
+            game = game_controller.GameController(
+                announce, report, config, record=record
+            )
+        feed.attach(game)
+        self.feeds[session_id] = feed
+        return game
+
+    def _recover(self):
+        start = time.perf_counter()
+        for session_id, state in self.journal.recover():
+            self._close_sessions(self.sessions.add(session_id) or [])
+            game = self._create_game(session_id, state=state)
+            self.sessions.put(session_id, game)
+        print(
+            f"Recovered {len(self.sessions)} sessions "
+            f"in {time.perf_counter() - start:.3f}s"
+        )
+
+    def _sweep_sessions(self):
+        while True:
+            time.sleep(self.sessions.SWEEP_INTERVAL)
+            evicted = self.sessions.sweep()
+            self._close_sessions(evicted)
+            if evicted:
+                metrics = self.sessions.metrics()
+                print(
+                    f"Evicted {len(evicted)} idle sessions, "
+                    f"live: {metrics['sessions']}, "
+                    f"rss: {metrics['rss_bytes'] // 2**20} MiB"
+                )
+
+    def _close_sessions(self, evicted: sessions.Evicted):
+        for session_id, game in evicted:
+            with game.lock:
+                game.close()
+            self.events.close_session(session_id)
+            self.status.close_session(session_id)
+            self.feeds.pop(session_id, None)
+            if self.journal is not None:
+                self.journal.drop(session_id)
+
+    def _announce(self, session_id: str, event: core_pb2.GameEvent):
+        start = time.perf_counter()
+        event.time = time.time()
+        announcement = events.Announcement(event)
+        self.events.publish(session_id, announcement)
+        if self.chat is not None:
+            for message in announcement.messages:
+                self.chat.publish(session_id, message.message, event.mafia_only)
+        self.announce_seconds.observe(time.perf_counter() - start)
+
+
+def serve_metrics():
+    # Prometheus endpoint, off unless METRICS_PORT is set
+    port = os.environ.get("METRICS_PORT")
+    if port:
+        metrics.serve(int(port))
+
+
+def spawn(port: str, env: Dict[str, str]) -> str:
+    process = subprocess.Popen(
+        [sys.executable, "-u", __file__], env=dict(os.environ, CORE_PORT=port, **env)
+    )
+    atexit.register(process.terminate)
+    return f"localhost:{port}"
 
 
 def serve():
-    port = "5000"
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
-    core_pb2_grpc.add_GameCoreServicer_to_server(GameCore(), server)
+    port = os.environ.get("CORE_PORT", "5000")
+
+    # Route sessions to shards, either spawned here on the ports following
+    # `port` or running elsewhere. Routers are stateless, so CORE_ROUTERS
+    # replicas share the port (gRPC sets SO_REUSEPORT) to spread the load
+    shards = int(os.environ.get("CORE_SHARDS", "1"))
+    targets = os.environ.get("CORE_SHARD_TARGETS")
+    if targets or shards > 1:
+        import router
+
+        # Make atexit terminate the spawned processes
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if not targets:
+            # Each shard keeps its own sessions on disk and serves its metrics
+            # on the ports following METRICS_PORT
+            data_dir = os.environ.get("CORE_DATA_DIR")
+            metrics_port = os.environ.get("METRICS_PORT")
+            shard_envs = [{"CORE_SHARDS": "1"} for _ in range(shards)]
+            for i, env in enumerate(shard_envs):
+                if data_dir:
+                    env["CORE_DATA_DIR"] = os.path.join(data_dir, f"shard-{i}")
+                if metrics_port:
+                    env["METRICS_PORT"] = str(int(metrics_port) + 1 + i)
+            targets = ",".join(
+                spawn(str(int(port) + 1 + i), env) for i, env in enumerate(shard_envs)
+            )
+            # Only the first router reports metrics
+            routers = int(os.environ.get("CORE_ROUTERS", "1"))
+            for _ in range(routers - 1):
+                spawn(port, {"CORE_SHARD_TARGETS": targets, "METRICS_PORT": ""})
+        serve_metrics()
+        asyncio.run(router.serve(port, targets.split(",")))
+        return
+
+    serve_metrics()
+    if os.environ.get("CORE_MODE", "threads") == "aio":
+        import aio_core
+
+        asyncio.run(aio_core.serve(port))
+        return
+
+    max_workers = int(os.environ.get("CORE_WORKERS", "16"))
+    # Streams beyond this are refused with RESOURCE_EXHAUSTED, serve many
+    # of them with CORE_MODE=aio instead
+    max_streams = int(os.environ.get("CORE_MAX_STREAMS", str(max(1, max_workers // 2))))
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=max_workers),
+        interceptors=[metrics.MetricsInterceptor()],
+    )
+    core = GameCore(max_streams)
+    core_pb2_grpc.add_GameCoreServicer_to_server(core, server)
+    health_pb2_grpc.add_HealthServicer_to_server(core.health, server)
     server.add_insecure_port("[::]:" + port)
     server.start()
-    print("Server started, listening on " + port)
+    print(
+        f"Server started, listening on {port} with {max_workers} workers, "
+        f"{max_streams} for streams"
+    )
     server.wait_for_termination()
 
 
@@ -0,0 +1,356 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import bisect
+import threading
+import time
+
+import grpc
+
+# Latency buckets, seconds
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)  # fmt: skip
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Value(object):
+    # A counter or a gauge. Metrics always updated together share a lock
+    def __init__(self, lock: Optional[threading.Lock] = None):
+        self.value = 0.0
+        self.lock = lock or threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self.lock:
+            self.value -= amount
+
+    def render(self, name: str, labels: Labels) -> List[str]:
+        with self.lock:
+            value = self.value
+        return [f"{name}{_format_labels(labels)} {value}"]
+
+
+class Histogram(object):
+    def __init__(self, lock: Optional[threading.Lock] = None, buckets=BUCKETS):
+        self.buckets = buckets
+        # Observations per bucket, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = lock or threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def render(self, name: str, labels: Labels) -> List[str]:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            bucket_labels = _format_labels(labels, f'le="{le}"')
+            lines.append(f"{name}_bucket{bucket_labels} {seen}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {seen}")
+        return lines
+
+
+# Metrics of the process, rendered in the Prometheus text format.
+#
+# Metrics are created once and kept by their users, so the hot path is an
+# increment under a per-metric lock and never looks anything up here.
+# Collectors report values that are kept elsewhere, like the counters of
+# chat.ChatPublisher, when the metrics are scraped.
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (type, help, labels -> metric)
+        self.families: Dict[str, Tuple[str, str, Dict[Labels, object]]] = dict()
+        self.collectors: List[Callable[[], Iterable[Tuple[str, str, float]]]] = []
+
+    def counter(self, name: str, help: str, lock=None, **labels) -> Value:
+        return self._get(name, "counter", help, labels, lambda: Value(lock))
+
+    def gauge(self, name: str, help: str, lock=None, **labels) -> Value:
+        return self._get(name, "gauge", help, labels, lambda: Value(lock))
+
+    def histogram(self, name: str, help: str, lock=None, **labels) -> Histogram:
+        return self._get(name, "histogram", help, labels, lambda: Histogram(lock))
+
+    def collect(self, collector: Callable[[], Iterable[Tuple[str, str, float]]]):
+        # collector() yields (name, type, value) of untyped, unlabeled metrics
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self) -> str:
+        with self.lock:
+            families = [(n, t, h, dict(m)) for n, (t, h, m) in self.families.items()]
+            collectors = list(self.collectors)
+        lines = []
+        for name, kind, help, metrics in sorted(families):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in sorted(metrics.items()):
+                lines += metric.render(name, labels)
+        for collector in collectors:
+            for name, kind, value in collector():
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _get(self, name, kind, help, labels, factory):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            family = self.families.setdefault(name, (kind, help, dict()))
+            metrics = family[2]
+            if key not in metrics:
+                metrics[key] = factory()
+            return metrics[key]
+
+
+REGISTRY = Registry()
+
+
+def collect_dict(prefix: str, values: Callable[[], Dict[str, float]], gauges=()):
+    # Exports a metrics() dict of counters, except the `gauges` keys
+    def collector():
+        for key, value in values().items():
+            if key in gauges:
+                yield f"{prefix}_{key}", "gauge", value
+            else:
+                yield f"{prefix}_{key}_total", "counter", value
+
+    REGISTRY.collect(collector)
+
+
+def serve(port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    # Serves GET /metrics from a daemon thread
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Metrics served on {port}")
+    return server
+
+
+def _code_name(code) -> str:
+    if code is None:
+        return "OK"
+    if isinstance(code, grpc.StatusCode):
+        return code.name
+    # grpc.aio reports the numeric code
+    for status in grpc.StatusCode:
+        if status.value[0] == code:
+            return status.name
+    return "UNKNOWN"
+
+
+class RpcMetrics(object):
+    # Metrics of one RPC method, under one lock to keep the overhead of an
+    # RPC to two lock acquisitions
+    def __init__(self, registry: Registry, path: str):
+        _, service, method = path.split("/")
+        self.registry = registry
+        self.lock = threading.Lock()
+        self.labels = {"grpc_service": service, "grpc_method": method}
+        self.latency = registry.histogram(
+            "grpc_server_handling_seconds",
+            "Time to handle an RPC",
+            lock=self.lock,
+            **self.labels,
+        )
+        self.in_flight = registry.gauge(
+            "grpc_server_in_flight", "RPCs being handled", lock=self.lock, **self.labels
+        )
+        # Status code name -> counter
+        self.handled: Dict[str, Value] = dict()
+
+    def start(self) -> float:
+        with self.lock:
+            self.in_flight.value += 1
+        return time.perf_counter()
+
+    def finish(self, start: float, code: str):
+        elapsed = time.perf_counter() - start
+        i = bisect.bisect_left(self.latency.buckets, elapsed)
+        counter = self.handled.get(code)
+        if counter is None:
+            counter = self.registry.counter(
+                "grpc_server_handled_total",
+                "RPCs handled, by status code",
+                lock=self.lock,
+                grpc_code=code,
+                **self.labels,
+            )
+            self.handled[code] = counter
+        with self.lock:
+            self.in_flight.value -= 1
+            self.latency.counts[i] += 1
+            self.latency.sum += elapsed
+            counter.value += 1
+
+
+def _error_code(context, error: BaseException) -> str:
+    # context.abort() sets the code before raising, a stream cancelled by
+    # the client is closed by the server
+    code = context.code()
+    if code is not None:
+        return _code_name(code)
+    if isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+        return "CANCELLED"
+    return "UNKNOWN"
+
+
+def _wrap_handler(handler, metrics: RpcMetrics, asynchronous: bool):
+    # Same handler with the behavior timed from the request to the last
+    # response of a stream
+    if handler.unary_unary:
+        behavior, make = handler.unary_unary, grpc.unary_unary_rpc_method_handler
+    elif handler.unary_stream:
+        behavior, make = handler.unary_stream, grpc.unary_stream_rpc_method_handler
+    elif handler.stream_unary:
+        behavior, make = handler.stream_unary, grpc.stream_unary_rpc_method_handler
+    else:
+        behavior, make = handler.stream_stream, grpc.stream_stream_rpc_method_handler
+
+    if not handler.response_streaming and not asynchronous:
+
+        def wrapped(request, context):
+            start = metrics.start()
+            try:
+                response = behavior(request, context)
+            except BaseException as e:
+                metrics.finish(start, _error_code(context, e))
+                raise
+            metrics.finish(start, _code_name(context.code()))
+            return response
+
+    elif not handler.response_streaming or asyncio.iscoroutinefunction(behavior):
+        # Also aio stream handlers that write their responses to the context
+
+        async def wrapped(request, context):
+            start = metrics.start()
+            try:
+                response = await behavior(request, context)
+            except BaseException as e:
+                metrics.finish(start, _error_code(context, e))
+                raise
+            metrics.finish(start, _code_name(context.code()))
+            return response
+
+    elif not asynchronous:
+
+        def wrapped(request, context):
+            start = metrics.start()
+            try:
+                yield from behavior(request, context)
+            except BaseException as e:
+                metrics.finish(start, _error_code(context, e))
+                raise
+            # A handler may stop by itself once the client has cancelled
+            if context.code() is None and not context.is_active():
+                metrics.finish(start, "CANCELLED")
+            else:
+                metrics.finish(start, _code_name(context.code()))
+
+    else:
+
+        async def wrapped(request, context):
+            start = metrics.start()
+            try:
+                async for response in behavior(request, context):
+                    yield response
+            except BaseException as e:
+                metrics.finish(start, _error_code(context, e))
+                raise
+            metrics.finish(start, _code_name(context.code()))
+
+    return make(
+        wrapped,
+        request_deserializer=handler.request_deserializer,
+        response_serializer=handler.response_serializer,
+    )
+
+
+class _HandlerCache(object):
+    def __init__(self, registry: Registry, asynchronous: bool):
+        self.registry = registry
+        self.asynchronous = asynchronous
+        self.lock = threading.Lock()
+        # method path -> (handler, wrapped handler)
+        self.handlers: Dict[str, tuple] = dict()
+        # method path -> RpcMetrics, made once: the series of a path in the
+        # registry are guarded by the lock of the first RpcMetrics for it
+        self.metrics: Dict[str, RpcMetrics] = dict()
+
+    def wrap(self, handler, path: str):
+        if handler is None:
+            return None
+        # Services return the same handler for every call of a method, so it
+        # is wrapped only once, under the lock for the first concurrent calls
+        cached = self.handlers.get(path)
+        if cached is not None and cached[0] is handler:
+            return cached[1]
+        with self.lock:
+            cached = self.handlers.get(path)
+            if cached is not None and cached[0] is handler:
+                return cached[1]
+            metrics = self.metrics.get(path)
+            if metrics is None:
+                metrics = self.metrics[path] = RpcMetrics(self.registry, path)
+            wrapped = _wrap_handler(handler, metrics, self.asynchronous)
+            self.handlers[path] = (handler, wrapped)
+            return wrapped
+
+
+# Records latency, in-flight RPCs and status codes of every method of a
+# grpc.server
+class MetricsInterceptor(grpc.ServerInterceptor):
+    def __init__(self, registry: Registry = REGISTRY):
+        self.cache = _HandlerCache(registry, asynchronous=False)
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        return self.cache.wrap(handler, handler_call_details.method)
+
+
+# Same for a grpc.aio.server
+class AioMetricsInterceptor(grpc.aio.ServerInterceptor):
+    def __init__(self, registry: Registry = REGISTRY):
+        self.cache = _HandlerCache(registry, asynchronous=True)
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        return self.cache.wrap(handler, handler_call_details.method)
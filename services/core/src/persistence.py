@@ -0,0 +1,294 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Tuple
+import os
+import struct
+import threading
+import time
+import zlib
+
+from game_controller import GameConfig, PlayerState, Role
+
+# Record kinds of the binary log
+KINDS = ["config", "join", "remove", "vote", "death", "roles", "phase", "score"]
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+
+# Record: crc32 and length of the body, then the body: kind code and fields
+HEADER = struct.Struct("<IH")
+STR_LEN = struct.Struct("<H")
+CONFIG = struct.Struct("<IIdd")
+SCORE = struct.Struct("<II")
+
+
+def _pack_str(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return STR_LEN.pack(len(data)) + data
+
+
+def _unpack_str(body: bytes, pos: int) -> Tuple[str, int]:
+    (length,) = STR_LEN.unpack_from(body, pos)
+    pos += STR_LEN.size
+    return body[pos : pos + length].decode("utf-8"), pos + length
+
+
+def encode(kind: str, *fields) -> bytes:
+    code = KIND_CODES[kind]
+    if kind == "config":
+        payload = CONFIG.pack(*fields)
+    elif kind == "score":
+        payload = SCORE.pack(*fields)
+    elif kind == "roles":
+        payload = bytes(role.value for role in fields[0])
+    else:
+        payload = b"".join(_pack_str(f) for f in fields)
+    body = bytes([code]) + payload
+    return HEADER.pack(zlib.crc32(body), len(body)) + body
+
+
+def _bodies(data: bytes) -> Iterator[Tuple[bytes, int]]:
+    # The body of each record and the offset it ends at. Stops at the first
+    # torn or corrupted record, which can only be the tail of a log that was
+    # being written during a crash
+    pos = 0
+    while pos + HEADER.size <= len(data):
+        crc, length = HEADER.unpack_from(data, pos)
+        body = data[pos + HEADER.size : pos + HEADER.size + length]
+        if len(body) != length or zlib.crc32(body) != crc:
+            return
+        pos += HEADER.size + length
+        yield body, pos
+
+
+def valid_size(data: bytes) -> int:
+    # Bytes up to the end of the last whole record
+    end = 0
+    for _, end in _bodies(data):
+        pass
+    return end
+
+
+def decode(data: bytes) -> Iterator[Tuple[str, tuple]]:
+    for body, _ in _bodies(data):
+        kind = KINDS[body[0]]
+        if kind == "config":
+            fields = CONFIG.unpack_from(body, 1)
+        elif kind == "score":
+            fields = SCORE.unpack_from(body, 1)
+        elif kind == "roles":
+            fields = ([Role(value) for value in body[1:]],)
+        else:
+            fields = []
+            i = 1
+            while i < len(body):
+                value, i = _unpack_str(body, i)
+                fields.append(value)
+            fields = tuple(fields)
+        yield kind, fields
+
+
+@dataclass
+class SessionState:
+    config: GameConfig = field(default_factory=GameConfig)
+    state: str = "not_started"
+    players: Dict[str, PlayerState] = field(default_factory=OrderedDict)
+    score: Dict[Role, int] = field(
+        default_factory=lambda: {Role.TOWNIE: 0, Role.MAFIA: 0}
+    )
+
+    def apply(self, kind: str, fields: tuple):
+        # Mirrors the changes GameController makes when it records them
+        if kind == "config":
+            self.config = GameConfig(*fields)
+        elif kind == "join":
+            token, name = fields
+            self.players[token] = PlayerState(name)
+        elif kind == "remove":
+            self.players.pop(fields[0], None)
+            for player in self.players.values():
+                if player.vote == fields[0]:
+                    player.vote = ""
+        elif kind == "vote":
+            voter, target = fields
+            self.players[voter].vote = target
+        elif kind == "death":
+            player = self.players[fields[0]]
+            player.alive = False
+            player.vote = ""
+        elif kind == "roles":
+            for player, role in zip(self.players.values(), fields[0]):
+                player.role = role
+        elif kind == "phase":
+            self.state = fields[0]
+            for player in self.players.values():
+                player.vote = ""
+                if self.state == "not_started":
+                    player.alive = True
+        elif kind == "score":
+            self.score = {Role.TOWNIE: fields[0], Role.MAFIA: fields[1]}
+
+    def records(self) -> List[bytes]:
+        # Records that rebuild this state from scratch, written as a snapshot
+        c = self.config
+        records = [
+            encode(
+                "config", c.min_players, c.max_players, c.mafia_ratio, c.start_delay
+            ),
+            encode("score", self.score[Role.TOWNIE], self.score[Role.MAFIA]),
+        ]
+        records += [encode("join", t, p.name) for t, p in self.players.items()]
+        records.append(encode("phase", self.state))
+        records.append(encode("roles", [p.role for p in self.players.values()]))
+        records += [encode("death", t) for t, p in self.players.items() if not p.alive]
+        records += [
+            encode("vote", t, p.vote) for t, p in self.players.items() if p.vote
+        ]
+        return records
+
+
+# Write-ahead log of game sessions.
+#
+# Each session has an append-only log of compact binary records
+# (`<id>.wal`) and a snapshot (`<id>.snap`) made of the records that rebuild
+# its state. record() only appends to an in-memory buffer; a writer thread
+# group-commits the buffers of all sessions every COMMIT_INTERVAL with one
+# write and fsync per dirty log, so RPCs never wait for the disk. A crash
+# loses at most the last COMMIT_INTERVAL of changes. Once a log grows past
+# SNAPSHOT_EVERY records the writer folds it into a new snapshot.
+class Journal(object):
+    COMMIT_INTERVAL = 0.01
+    SNAPSHOT_EVERY = 1000
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.buffers: Dict[str, List[bytes]] = dict()
+        self.dropped: List[str] = []
+        # Records in the log of each session since its last snapshot
+        self.log_records: Dict[str, int] = dict()
+        self.closing = False
+
+        self.writer = threading.Thread(target=self._run, name="journal", daemon=True)
+        self.writer.start()
+
+    def create(self, session_id: str, config: GameConfig):
+        self.record(
+            session_id,
+            "config",
+            config.min_players,
+            config.max_players,
+            config.mafia_ratio,
+            config.start_delay,
+        )
+
+    def record(self, session_id: str, kind: str, *fields):
+        data = encode(kind, *fields)
+        with self.lock:
+            self.buffers.setdefault(session_id, []).append(data)
+
+    def drop(self, session_id: str):
+        # Deletes the session from disk along with its pending records. A
+        # session created again under the same ID starts a new log
+        with self.lock:
+            self.buffers.pop(session_id, None)
+            self.dropped.append(session_id)
+
+    def close(self):
+        self.closing = True
+        self.writer.join()
+
+    def recover(self) -> Iterator[Tuple[str, SessionState]]:
+        session_ids = set()
+        for name in os.listdir(self.data_dir):
+            session_id, ext = os.path.splitext(name)
+            if ext in (".wal", ".snap"):
+                session_ids.add(session_id)
+        for session_id in sorted(session_ids):
+            state, log_records = self._load(session_id)
+            self.log_records[session_id] = log_records
+            yield session_id, state
+
+    def _path(self, session_id: str, ext: str) -> str:
+        return os.path.join(self.data_dir, session_id + ext)
+
+    def _load(self, session_id: str) -> Tuple[SessionState, int]:
+        state = SessionState()
+        log_records = 0
+        for ext in (".snap", ".wal"):
+            try:
+                with open(self._path(session_id, ext), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            for kind, fields in decode(data):
+                state.apply(kind, fields)
+                if ext == ".wal":
+                    log_records += 1
+            if ext == ".wal" and valid_size(data) < len(data):
+                # Cut the torn tail, or the records appended after it would
+                # be lost to the next recovery
+                os.truncate(self._path(session_id, ext), valid_size(data))
+                print(f"Truncated the torn log of session {session_id}")
+        return state, log_records
+
+    def _run(self):
+        while True:
+            time.sleep(self.COMMIT_INTERVAL)
+            closing = self.closing
+            with self.lock:
+                buffers, self.buffers = self.buffers, dict()
+                dropped, self.dropped = self.dropped, []
+            # Before the records of a session created again after its drop
+            for session_id in dropped:
+                try:
+                    self._delete(session_id)
+                except Exception as e:
+                    print(f"Failed to delete the log of session {session_id}: {e}")
+            self._commit(buffers)
+            if closing:
+                return
+
+    def _commit(self, buffers: Dict[str, List[bytes]]):
+        for session_id, records in buffers.items():
+            # One session failing to persist does not stop the others
+            try:
+                self._append(session_id, records)
+            except Exception as e:
+                print(f"Failed to write the log of session {session_id}: {e}")
+
+    def _append(self, session_id: str, records: List[bytes]):
+        fd = os.open(
+            self._path(session_id, ".wal"),
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+            0o644,
+        )
+        try:
+            os.write(fd, b"".join(records))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        count = self.log_records.get(session_id, 0) + len(records)
+        self.log_records[session_id] = count
+        if count >= self.SNAPSHOT_EVERY:
+            self._snapshot(session_id)
+
+    def _snapshot(self, session_id: str):
+        # Only the writer touches the files, so the log cannot grow meanwhile
+        state, _ = self._load(session_id)
+        path = self._path(session_id, ".snap")
+        with open(path + ".tmp", "wb") as f:
+            f.write(b"".join(state.records()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        os.truncate(self._path(session_id, ".wal"), 0)
+        self.log_records[session_id] = 0
+
+    def _delete(self, session_id: str):
+        self.log_records.pop(session_id, None)
+        for ext in (".wal", ".snap"):
+            try:
+                os.remove(self._path(session_id, ext))
+            except FileNotFoundError:
+                pass
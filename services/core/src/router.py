@@ -0,0 +1,238 @@
+from typing import Dict, List
+import asyncio
+
+import grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
+import core_pb2
+
+import utils
+import batch
+import metrics
+
+SERVICE = core_pb2.DESCRIPTOR.services_by_name["GameCore"]
+# Shards that went away are watched again after this long
+HEALTH_RETRY_SECONDS = 1.0
+SERVING = health_pb2.HealthCheckResponse.SERVING
+NOT_SERVING = health_pb2.HealthCheckResponse.NOT_SERVING
+
+
+def get_session_id(message) -> str:
+    # Every GameCore request carries the session ID either directly or in
+    # its PlayerInfo key
+    fields = message.DESCRIPTOR.fields_by_name
+    if "session_id" in fields:
+        return message.session_id
+    if "key" in fields:
+        return message.key.session_id
+    return ""
+
+
+# Front router of a sharded game-core.
+#
+# Forwards each GameCore RPC to the shard that owns its session, picked by
+# utils.get_shard. Handlers are derived from the service descriptor, so new
+# RPCs of any kind are routed without changes here. Messages are passed
+# through as serialized bytes and parsed only to read the session ID; stream
+# messages are relayed one by one as they arrive.
+class Router(object):
+    def __init__(self, targets: List[str]):
+        self.channels = [grpc.aio.insecure_channel(target) for target in targets]
+        # The game is ready once every shard reports it is
+        self.health = health.aio.HealthServicer()
+        self.serving = [False] * len(self.channels)
+        self.tasks = []
+
+    async def start(self):
+        await self.health.set(utils.GAME_HEALTH, NOT_SERVING)
+        self.tasks = [
+            asyncio.create_task(self._watch_shard(i)) for i in range(len(self.channels))
+        ]
+
+    def handler(self) -> grpc.GenericRpcHandler:
+        handlers = dict()
+        for method in SERVICE.methods:
+            handlers[method.name] = self._make_handler(method)
+        return grpc.method_handlers_generic_handler(SERVICE.full_name, handlers)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for channel in self.channels:
+            await channel.close()
+
+    async def _watch_shard(self, shard: int):
+        stub = health_pb2_grpc.HealthStub(self.channels[shard])
+        request = health_pb2.HealthCheckRequest(service=utils.GAME_HEALTH)
+        while True:
+            try:
+                async for response in stub.Watch(request, wait_for_ready=True):
+                    await self._set_serving(shard, response.status == SERVING)
+            except grpc.aio.AioRpcError as e:
+                print(f"Lost the health of shard {shard}: {e.code()}")
+            await self._set_serving(shard, False)
+            await asyncio.sleep(HEALTH_RETRY_SECONDS)
+
+    async def _set_serving(self, shard: int, serving: bool):
+        self.serving[shard] = serving
+        status = SERVING if all(self.serving) else NOT_SERVING
+        await self.health.set(utils.GAME_HEALTH, status)
+
+    def _make_handler(self, method):
+        path = f"/{SERVICE.full_name}/{method.name}"
+        request_class = getattr(core_pb2, method.input_type.name)
+        is_make_session = method.name == "MakeSession"
+
+        # Multi-callables of the method, one per shard
+        unary_unary_calls = [c.unary_unary(path) for c in self.channels]
+        unary_stream_calls = [c.unary_stream(path) for c in self.channels]
+        stream_unary_calls = [c.stream_unary(path) for c in self.channels]
+        stream_stream_calls = [c.stream_stream(path) for c in self.channels]
+
+        def route(request: bytes):
+            message = request_class.FromString(request)
+            session_id = get_session_id(message)
+            if is_make_session and not session_id:
+                # Allocate the ID here, so that it determines the shard
+                message.session_id = utils.make_session_id()
+                request = message.SerializeToString()
+                session_id = message.session_id
+            return utils.get_shard(session_id, len(self.channels)), request
+
+        if method.name == "DoBatch":
+            return self._make_batch_handler(unary_unary_calls)
+
+        if not method.client_streaming and not method.server_streaming:
+
+            async def unary_unary(request: bytes, context):
+                shard, request = route(request)
+                call = unary_unary_calls[shard]
+                try:
+                    return await call(request, metadata=_forwarded(context))
+                except grpc.aio.AioRpcError as e:
+                    await context.abort(e.code(), e.details())
+
+            return grpc.unary_unary_rpc_method_handler(unary_unary)
+
+        if not method.client_streaming:
+
+            async def unary_stream(request: bytes, context):
+                shard, request = route(request)
+                call = unary_stream_calls[shard](request, metadata=_forwarded(context))
+                try:
+                    async for response in call:
+                        yield response
+                except grpc.aio.AioRpcError as e:
+                    await context.abort(e.code(), e.details())
+                finally:
+                    call.cancel()
+
+            return grpc.unary_stream_rpc_method_handler(unary_stream)
+
+        async def open_stream(request_iterator, context):
+            # The first message picks the shard, the rest follow it as is
+            first = await request_iterator.__anext__()
+            shard, first = route(first)
+
+            async def requests():
+                yield first
+                async for request in request_iterator:
+                    yield request
+
+            return shard, requests()
+
+        if not method.server_streaming:
+
+            async def stream_unary(request_iterator, context):
+                shard, requests = await open_stream(request_iterator, context)
+                call = stream_unary_calls[shard]
+                try:
+                    return await call(requests, metadata=_forwarded(context))
+                except grpc.aio.AioRpcError as e:
+                    await context.abort(e.code(), e.details())
+
+            return grpc.stream_unary_rpc_method_handler(stream_unary)
+
+        async def stream_stream(request_iterator, context):
+            shard, requests = await open_stream(request_iterator, context)
+            call = stream_stream_calls[shard](requests, metadata=_forwarded(context))
+            try:
+                async for response in call:
+                    yield response
+            except grpc.aio.AioRpcError as e:
+                await context.abort(e.code(), e.details())
+            finally:
+                call.cancel()
+
+        return grpc.stream_stream_rpc_method_handler(stream_stream)
+
+    def _make_batch_handler(self, calls):
+        # A batch may span shards: each shard gets its actions as a batch of
+        # their own, in their order, and the results are put back in place
+        async def do_batch(request: bytes, context):
+            message = core_pb2.BatchRequest.FromString(request)
+            if len(message.actions) > batch.MAX_ACTIONS:
+                await context.abort(
+                    grpc.StatusCode.INVALID_ARGUMENT,
+                    "Too many actions in a batch: "
+                    f"{len(message.actions)} > {batch.MAX_ACTIONS}",
+                )
+            parts: Dict[int, List[int]] = dict()
+            for i, action in enumerate(message.actions):
+                shard = utils.get_shard(batch.get_session_id(action), len(calls))
+                parts.setdefault(shard, []).append(i)
+
+            metadata = _forwarded(context)
+            try:
+                if len(parts) <= 1:
+                    shard = next(iter(parts), 0)
+                    return await calls[shard](request, metadata=metadata)
+                shards = list(parts)
+                responses = await asyncio.gather(
+                    *[
+                        calls[shard](
+                            core_pb2.BatchRequest(
+                                actions=[message.actions[i] for i in parts[shard]]
+                            ).SerializeToString(),
+                            metadata=metadata,
+                        )
+                        for shard in shards
+                    ]
+                )
+            except grpc.aio.AioRpcError as e:
+                await context.abort(e.code(), e.details())
+
+            results = [None] * len(message.actions)
+            for shard, data in zip(shards, responses):
+                response = core_pb2.BatchResponse.FromString(data)
+                for i, result in zip(parts[shard], response.results):
+                    results[i] = result
+            return core_pb2.BatchResponse(results=results).SerializeToString()
+
+        return grpc.unary_unary_rpc_method_handler(do_batch)
+
+
+def _forwarded(context):
+    # Pass the caller's metadata on, except what the channel sets itself
+    return tuple(
+        (key, value)
+        for key, value in context.invocation_metadata()
+        if key not in ("user-agent",) and not key.startswith(":")
+    )
+
+
+async def serve(port: str, targets: List[str]):
+    router = Router(targets)
+    server = grpc.aio.server(interceptors=[metrics.AioMetricsInterceptor()])
+    server.add_generic_rpc_handlers((router.handler(),))
+    health_pb2_grpc.add_HealthServicer_to_server(router.health, server)
+    server.add_insecure_port("[::]:" + port)
+    await router.start()
+    await server.start()
+    print(f"Router started, listening on {port}, shards: {', '.join(targets)}")
+    try:
+        await server.wait_for_termination()
+    finally:
+        await router.health.enter_graceful_shutdown()
+        await server.stop(grace=5)
+        await router.close()
@@ -0,0 +1,132 @@
+from typing import Dict, Tuple
+import threading
+import time
+
+import utils
+import metrics
+
+
+# Reports game scores to the scoreboard from a background thread.
+#
+# RPC threads only record the latest score of a game; rapid updates of the same
+# game coalesce into one. The worker sends the scores of many games in one
+# batched GraphQL mutation over a keep-alive session and, while the scoreboard
+# is unavailable, keeps the pending scores and retries with exponential backoff.
+class ScoreReporter(object):
+    MAX_BATCH = 100
+    # Wait this long after the first update so that more of them coalesce
+    LINGER = 0.05
+    TIMEOUT = 5.0
+    BACKOFF_MIN = 0.5
+    BACKOFF_MAX = 30.0
+
+    def __init__(self, url: str = utils.SCOREBOARD_URL):
+        self.url = url
+        # Created by the worker, see _run
+        self.session = None
+
+        # Latest unsent score of each game
+        self.pending: Dict[str, Tuple[int, int]] = dict()
+        self.cond = threading.Condition()
+
+        self.closing = False
+        self.counters: Dict[str, int] = {
+            "reported": 0,
+            "coalesced": 0,
+            "batches": 0,
+            "retries": 0,
+        }
+        self.post_seconds = {
+            outcome: metrics.REGISTRY.histogram(
+                "game_core_score_post_seconds",
+                "Time to post a batch of scores to the scoreboard",
+                outcome=outcome,
+            )
+            for outcome in ["ok", "error"]
+        }
+
+        self.worker = threading.Thread(
+            target=self._run, name="score-reporter", daemon=True
+        )
+        self.worker.start()
+
+    def report(self, session_id: str, townies: int, mafia: int):
+        with self.cond:
+            if session_id in self.pending:
+                self.counters["coalesced"] += 1
+            self.pending[session_id] = (townies, mafia)
+            self.cond.notify()
+
+    def metrics(self) -> Dict[str, int]:
+        with self.cond:
+            return dict(self.counters, pending=len(self.pending))
+
+    def close(self, timeout: float = 5.0):
+        # Flush what is pending, then stop the worker
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.worker.join(timeout)
+
+    def _run(self):
+        # requests takes about a third of the startup of game-core to import,
+        # which the worker does instead of the server
+        import requests
+
+        self.session = requests.Session()
+        self.session.headers["Content-Type"] = "application/json"
+
+        attempt = 0
+        while True:
+            with self.cond:
+                while not self.pending and not self.closing:
+                    self.cond.wait()
+                if not self.pending:
+                    break
+            if not self.closing:
+                time.sleep(self.LINGER)
+            batch = self._take_batch()
+
+            start = time.perf_counter()
+            try:
+                self._post(batch)
+                self.post_seconds["ok"].observe(time.perf_counter() - start)
+                attempt = 0
+            except Exception as e:
+                self.post_seconds["error"].observe(time.perf_counter() - start)
+                self._restore(batch)
+                if self.closing:
+                    print(f"Dropping {len(self.pending)} unsent scores: {e}")
+                    break
+                delay = utils.backoff_delay(attempt, self.BACKOFF_MIN, self.BACKOFF_MAX)
+                attempt += 1
+                print(f"Failed to report scores, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+        self.session.close()
+
+    def _take_batch(self) -> Dict[str, Tuple[int, int]]:
+        with self.cond:
+            batch = dict()
+            for session_id in list(self.pending)[: self.MAX_BATCH]:
+                batch[session_id] = self.pending.pop(session_id)
+            return batch
+
+    def _restore(self, batch: Dict[str, Tuple[int, int]]):
+        # Keep newer scores that arrived while the batch was in flight
+        with self.cond:
+            self.counters["retries"] += 1
+            for session_id, score in batch.items():
+                self.pending.setdefault(session_id, score)
+
+    def _post(self, batch: Dict[str, Tuple[int, int]]):
+        response = self.session.post(
+            self.url, data=utils.make_scores_mutation(batch), timeout=self.TIMEOUT
+        )
+        response.raise_for_status()
+        errors = response.json().get("errors")
+        if errors:
+            # The scoreboard understood the request, retrying will not help
+            print(f"Scoreboard rejected scores: {errors}")
+        with self.cond:
+            self.counters["batches"] += 1
+            self.counters["reported"] += len(batch)
@@ -0,0 +1,122 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import os
+import threading
+import time
+
+import game_controller
+
+Evicted = List[Tuple[str, game_controller.GameController]]
+
+
+def get_rss_bytes() -> int:
+    # Resident set size of this process, 0 where /proc is unavailable
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+# Game sessions in least-recently-used order.
+#
+# Every lookup moves the session to the end, so the idle ones gather at the
+# front: sweep() only visits sessions it evicts (plus one), and the capacity
+# limit drops the least recently used session. A None value reserves an ID
+# while its session is being created.
+class SessionStore(object):
+    # Seconds between sweeps of idle sessions
+    SWEEP_INTERVAL = 30.0
+
+    def __init__(self, ttl: float, empty_ttl: float, max_sessions: int):
+        self.ttl = ttl
+        self.empty_ttl = min(empty_ttl, ttl)
+        self.max_sessions = max_sessions
+
+        self.sessions: "OrderedDict[str, Optional[game_controller.GameController]]" = (
+            OrderedDict()
+        )
+        self.last_active: Dict[str, float] = dict()
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    @classmethod
+    def from_env(cls) -> "SessionStore":
+        return cls(
+            ttl=float(os.environ.get("SESSION_TTL", "3600")),
+            empty_ttl=float(os.environ.get("SESSION_EMPTY_TTL", "300")),
+            max_sessions=int(os.environ.get("MAX_SESSIONS", "100000")),
+        )
+
+    def __contains__(self, session_id: str) -> bool:
+        with self.lock:
+            return session_id in self.sessions
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.sessions)
+
+    def get(self, session_id: str) -> Optional[game_controller.GameController]:
+        with self.lock:
+            game = self.sessions.get(session_id)
+            if game is not None:
+                self._touch(session_id)
+            return game
+
+    def add(self, session_id: str) -> Optional[Evicted]:
+        # Reserves the ID; None if it is taken. Returns the sessions evicted to
+        # stay within capacity, the caller has to close them
+        with self.lock:
+            if session_id in self.sessions:
+                return None
+            self.sessions[session_id] = None
+            self._touch(session_id)
+            evicted = []
+            while len(self.sessions) > self.max_sessions:
+                old_id, game = self.sessions.popitem(last=False)
+                self.last_active.pop(old_id)
+                if game is not None:
+                    evicted.append((old_id, game))
+            self.evicted += len(evicted)
+            return evicted
+
+    def put(self, session_id: str, game: game_controller.GameController):
+        with self.lock:
+            if session_id in self.sessions:
+                self.sessions[session_id] = game
+
+    def pop(self, session_id: str):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+            self.last_active.pop(session_id, None)
+
+    def sweep(self, now: Optional[float] = None) -> Evicted:
+        # Removes sessions idle for longer than ttl, or empty ones idle for
+        # longer than empty_ttl; the caller has to close them
+        now = time.monotonic() if now is None else now
+        stale = []
+        with self.lock:
+            for session_id, game in self.sessions.items():
+                idle = now - self.last_active[session_id]
+                if idle < self.empty_ttl:
+                    break
+                # Also drops reservations of sessions that failed to start
+                if idle >= self.ttl or game is None or not game.players:
+                    stale.append((session_id, game))
+            for session_id, _ in stale:
+                self.sessions.pop(session_id)
+                self.last_active.pop(session_id)
+        evicted = [(session_id, game) for session_id, game in stale if game is not None]
+        with self.lock:
+            self.evicted += len(evicted)
+        return evicted
+
+    def metrics(self) -> Dict[str, int]:
+        with self.lock:
+            live = len(self.sessions)
+            evicted = self.evicted
+        return {"sessions": live, "evicted": evicted, "rss_bytes": get_rss_bytes()}
+
+    def _touch(self, session_id: str):
+        self.last_active[session_id] = time.monotonic()
+        self.sessions.move_to_end(session_id)
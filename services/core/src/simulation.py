@@ -0,0 +1,298 @@
+from concurrent import futures
+from dataclasses import dataclass
+from typing import List, Optional
+import argparse
+import os
+import time
+
+import numpy as np
+
+from game_controller import GameConfig, GameController, InvalidAction, Role
+
+TOWNIE_WIN = 1
+MAFIA_WIN = 2
+
+# How mafia picks its victims, both at day and at night. Townies always vote
+# for a random living player other than themselves
+MAFIA_STRATEGIES = ["random", "coordinated"]
+
+# Games played at once by a single engine call, and the unit of work of the
+# process pool
+CHUNK = 20000
+
+
+@dataclass
+class Trace:
+    # What happened in every phase of a batch of games, for verify(): the
+    # target of every player's vote or -1, the victim, the number of players
+    # the victim was chosen from at random, and the games still going on
+    roles: np.ndarray
+    votes: List[np.ndarray]
+    victims: List[np.ndarray]
+    ties: List[np.ndarray]
+    active: List[np.ndarray]
+
+
+# Headless Monte Carlo engine with the rules of GameController.
+#
+# Plays a batch of games with the same lobby at once as arrays: roles and
+# alive masks of shape (games, players), and each phase draws the votes of
+# all games, counts them into a (games, players) tally and kills the most
+# voted player of every game that is still going on. A phase costs a
+# few NumPy operations however many games are played, and the games of a
+# batch finish within 2 * players phases.
+def play(
+    players: int,
+    config: GameConfig,
+    games: int,
+    rng: np.random.Generator,
+    mafia_strategy: str = "random",
+    trace: bool = False,
+):
+    mafia_count = config.roles(players).count(Role.MAFIA)
+    rows = np.arange(games)
+
+    # Deal the roles: first mafia_count of a random permutation are mafia
+    order = np.argsort(rng.random((games, players)), axis=1)
+    mafia = np.zeros((games, players), dtype=bool)
+    mafia[rows[:, None], order[:, :mafia_count]] = True
+
+    alive = np.ones((games, players), dtype=bool)
+    active = np.ones(games, dtype=bool)
+    winner = np.zeros(games, dtype=np.int8)
+    phases = np.zeros(games, dtype=np.int32)
+    history = Trace(mafia.copy(), [], [], [], []) if trace else None
+
+    day = True
+    while active.any():
+        voters = alive & active[:, None]
+        if not day:
+            voters &= mafia
+        townies = alive & ~mafia
+
+        # Townies vote for anyone alive but themselves, mafia for living
+        # townies, all together or each on their own
+        targets = _pick(rng, alive, (games, players), exclude_self=True)
+        if mafia_strategy == "coordinated":
+            mafia_targets = _pick(rng, townies, (games, 1))
+        else:
+            mafia_targets = _pick(rng, townies, (games, players))
+        targets = np.where(mafia, mafia_targets, targets)
+        targets = np.where(voters, targets, -1)
+
+        # Tally the votes and pick the victim among the most voted at random
+        tally = np.bincount(
+            (rows[:, None] * players + targets)[voters], minlength=games * players
+        ).reshape(games, players)
+        most_voted = tally == tally.max(axis=1, keepdims=True)
+        victims = _pick(rng, most_voted, (games, 1))[:, 0]
+
+        alive[rows[active], victims[active]] = False
+        phases[active] += 1
+        if trace:
+            history.votes.append(targets)
+            history.victims.append(victims)
+            history.ties.append(most_voted.sum(axis=1))
+            history.active.append(active.copy())
+
+        mafia_alive = (alive & mafia).sum(axis=1)
+        townies_alive = (alive & ~mafia).sum(axis=1)
+        finished = active & ((mafia_alive == 0) | (townies_alive == 0))
+        winner[finished] = np.where(mafia_alive[finished] == 0, TOWNIE_WIN, MAFIA_WIN)
+        active &= ~finished
+        day = not day
+
+    return winner, phases, history
+
+
+def _pick(rng, members: np.ndarray, shape, exclude_self: bool = False) -> np.ndarray:
+    # Picks players of every game uniformly among its `members` without
+    # materializing a choice per pair of players: draws a rank among the
+    # members and looks it up in the member indices, which come first in
+    # the stable argsort. With exclude_self, the player in column i of the
+    # result never picks itself and skips its own rank
+    indices = np.argsort(~members, axis=1, kind="stable")
+    count = members.sum(axis=1, keepdims=True)
+    u = rng.random(shape)
+    if exclude_self:
+        rank = np.cumsum(members, axis=1) - 1
+        j = (u * (count - members)).astype(np.int64)
+        j += members & (j >= rank)
+    else:
+        j = (u * count).astype(np.int64)
+    j = np.minimum(j, members.shape[1] - 1)
+    return np.take_along_axis(indices, j, axis=1)
+
+
+def _play_chunk(players, config, games, seed, mafia_strategy):
+    winner, phases, _ = play(
+        players, config, games, np.random.default_rng(seed), mafia_strategy
+    )
+    return (
+        int((winner == TOWNIE_WIN).sum()),
+        int((winner == MAFIA_WIN).sum()),
+        int(phases.sum()),
+    )
+
+
+def simulate(
+    players: int,
+    config: GameConfig,
+    games: int,
+    seed: int,
+    mafia_strategy: str = "random",
+    pool: Optional[futures.Executor] = None,
+):
+    # Chunks get independent streams of the seed, so the result does not
+    # depend on the number of processes
+    chunks = [CHUNK] * (games // CHUNK) + ([games % CHUNK] if games % CHUNK else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    args = [(players, config, n, s, mafia_strategy) for n, s in zip(chunks, seeds)]
+    if pool is None:
+        results = [_play_chunk(*a) for a in args]
+    else:
+        results = list(pool.map(_play_chunk, *zip(*args)))
+    townie_wins, mafia_wins, phases = (sum(r) for r in zip(*results))
+    return townie_wins, mafia_wins, phases
+
+
+# Stands in for the `random` module of a GameController to deal the roles and
+# break the ties the way the engine did, and checks that the controller was
+# choosing among the same players
+class ScriptedRandom(object):
+    def __init__(self, roles: List[Role], victims: List[int], ties: List[int]):
+        self.roles = roles
+        self.victims = victims
+        self.ties = ties
+        self.tokens: List[str] = []
+        self.choices = 0
+
+    def shuffle(self, roles: List[Role]):
+        roles[:] = self.roles
+
+    def choice(self, match: List[str]) -> str:
+        victim = self.tokens[self.victims[self.choices]]
+        if victim not in match or len(match) != self.ties[self.choices]:
+            raise InvalidAction(
+                f"Engine chose among other players in phase {self.choices}"
+            )
+        self.choices += 1
+        return victim
+
+
+def replay(players: int, config: GameConfig, history: Trace, game: int):
+    # Plays the votes of one engine game through a GameController, returns
+    # its winner and the number of phases
+    phases = [i for i, active in enumerate(history.active) if active[game]]
+    script = ScriptedRandom(
+        [Role.MAFIA if m else Role.TOWNIE for m in history.roles[game]],
+        [int(history.victims[i][game]) for i in phases],
+        [int(history.ties[i][game]) for i in phases],
+    )
+    scores = []
+    controller = GameController(
+        lambda event: None,
+        lambda t, m: scores.append((t, m)),
+        GameConfig(players, players, config.mafia_ratio),
+        schedule=lambda delay, callback: None,
+        rng=script,
+    )
+    script.tokens = [controller.join(f"player{i}") for i in range(players)]
+
+    for i in phases:
+        day = controller.is_day()
+        for voter, target in enumerate(history.votes[i][game]):
+            if target < 0:
+                continue
+            if day:
+                controller.do_vote_sacrifice(script.tokens[voter], f"player{target}")
+            else:
+                controller.do_vote_murder(script.tokens[voter], f"player{target}")
+
+    townies, mafia = scores[-1]
+    winner = TOWNIE_WIN if townies else MAFIA_WIN if mafia else 0
+    return winner, script.choices
+
+
+def verify(
+    players: int, config: GameConfig, games: int, seed: int, mafia_strategy: str
+) -> int:
+    # Returns the number of games GameController played differently
+    winner, phases, history = play(
+        players, config, games, np.random.default_rng(seed), mafia_strategy, trace=True
+    )
+    mismatches = 0
+    for game in range(games):
+        try:
+            outcome = replay(players, config, history, game)
+        except InvalidAction as e:
+            outcome = str(e)
+        if outcome != (winner[game], phases[game]):
+            mismatches += 1
+            print(
+                f"Game {game}: engine {(winner[game], phases[game])}, "
+                f"controller {outcome}"
+            )
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Estimates win rates with the headless game engine"
+    )
+    parser.add_argument("--players", type=int, nargs="+", default=[5])
+    parser.add_argument("--mafia-ratio", type=float, nargs="+", default=[0.4])
+    parser.add_argument(
+        "--mafia-strategy", nargs="+", choices=MAFIA_STRATEGIES, default=["random"]
+    )
+    parser.add_argument("--games", type=int, default=1000000)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--verify",
+        type=int,
+        default=0,
+        help="replay this many games of every setup through GameController",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'players':>7} {'mafia':>5} {'strategy':>11} {'townies win':>12} "
+        f"{'phases':>7} {'games/s':>10}"
+    )
+    failed = False
+    with futures.ProcessPoolExecutor(max_workers=args.processes) as pool:
+        for players in args.players:
+            for ratio in args.mafia_ratio:
+                for strategy in args.mafia_strategy:
+                    config = GameConfig(players, players, ratio)
+                    config.validate()
+                    mafia = config.roles(players).count(Role.MAFIA)
+
+                    start = time.perf_counter()
+                    townie_wins, mafia_wins, phases = simulate(
+                        players, config, args.games, args.seed, strategy, pool
+                    )
+                    elapsed = time.perf_counter() - start
+
+                    # Binomial standard error of the win rate
+                    rate = townie_wins / args.games
+                    error = (rate * (1 - rate) / args.games) ** 0.5
+                    print(
+                        f"{players:>7} {mafia:>5} {strategy:>11} "
+                        f"{rate:>7.2%}±{error:.2%} {phases / args.games:>7.2f} "
+                        f"{args.games / elapsed:>10.0f}"
+                    )
+
+                    if args.verify:
+                        mismatches = verify(
+                            players, config, args.verify, args.seed, strategy
+                        )
+                        print(f"Verified {args.verify} games, mismatches: {mismatches}")
+                        failed = failed or mismatches > 0
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
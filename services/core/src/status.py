@@ -0,0 +1,152 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Optional
+
+import core_pb2
+
+import game_controller
+from game_controller import PHASES, Role
+
+
+@dataclass
+class StatusDelta:
+    # A change of the status of a session, shared by all of its watchers.
+    # Each watcher takes its own role from `roles`, and only the mafia see
+    # `secret` deltas (night votes)
+    update: core_pb2.StatusUpdate
+    roles: Optional[Dict[str, Role]] = None
+    secret: bool = False
+
+
+# Turns the changes a GameController records into StatusDeltas for the
+# WatchStatus streams of its session. Must be called with the game lock held,
+# like record itself.
+class StatusFeed(object):
+    def __init__(
+        self,
+        publish: Callable[[StatusDelta], None],
+        watched: Callable[[], bool] = lambda: True,
+    ):
+        self.game: Optional[game_controller.GameController] = None
+        self.publish = publish
+        # Deltas are only built while someone watches the session
+        self.watched = watched
+        # Voter token -> target token, to tell which vote counts a vote or a
+        # death has changed
+        self.targets: Dict[str, str] = dict()
+
+    def attach(self, game: game_controller.GameController):
+        self.game = game
+        self.targets = {t: p.vote for t, p in game.players.items() if p.vote}
+
+    def record(self, kind: str, *fields):
+        # Keep the vote targets up to date even with no one watching
+        changed = ()
+        voters = []
+        if kind == "vote":
+            token, target = fields
+            changed = [target, self.targets.get(token)]
+            self.targets[token] = target
+        elif kind in ["death", "remove"]:
+            changed = [self.targets.pop(fields[0], None)]
+            if kind == "remove":
+                # Votes for a player who left are dropped along with them
+                voters = [v for v, t in self.targets.items() if t == fields[0]]
+                for voter in voters:
+                    del self.targets[voter]
+        elif kind == "phase":
+            self.targets.clear()
+        if not self.watched():
+            return
+
+        game = self.game
+        if kind == "join":
+            self._publish(players=[core_pb2.PlayerStatus(name=fields[1], alive=True)])
+        elif kind == "remove":
+            self._publish(left=[game.players[fields[0]].name])
+            if voters:
+                self._publish_votes(())
+        elif kind == "death":
+            name = game.players[fields[0]].name
+            self._publish(players=[core_pb2.PlayerStatus(name=name, alive=False)])
+            self._publish_votes(changed)
+        elif kind == "vote":
+            self._publish_votes(changed)
+        elif kind == "roles":
+            roles = {t: p.role for t, p in game.players.items()}
+            self.publish(StatusDelta(core_pb2.StatusUpdate(), roles=roles))
+        elif kind == "phase":
+            if game.is_not_started():
+                # A new game: everyone is alive again and has no role yet
+                self.publish(StatusDelta(self.snapshot()))
+            elif fields[0] in PHASES:
+                # Nobody has voted yet, which only the mafia learn at night
+                self._publish(phase=PHASES[fields[0]])
+                self._publish(secret=game.is_night(), voted=0)
+        elif kind == "score":
+            self._publish(score=core_pb2.Score(townies=fields[0], mafia=fields[1]))
+
+    def snapshot(self, token: str = "") -> core_pb2.StatusUpdate:
+        # The full status as the player of `token` sees it, or as anyone does
+        game = self.game
+        role = game.players[token].role if token else Role.NOBODY
+        update = core_pb2.StatusUpdate(
+            full=True,
+            phase=PHASES[game.state],
+            score=core_pb2.Score(
+                townies=game.score[Role.TOWNIE], mafia=game.score[Role.MAFIA]
+            ),
+        )
+        if role != Role.NOBODY and not game.is_not_started():
+            update.role = role.value
+        update.players.extend(
+            core_pb2.PlayerStatus(name=p.name, alive=p.alive)
+            for p in game.players.values()
+        )
+        if not game.is_night() or role == Role.MAFIA:
+            update.voted = game.voted
+            update.votes.extend(
+                self._vote_counts(t for t in game.votes if t in game.players)
+            )
+        return update
+
+    def _publish(self, secret: bool = False, **fields):
+        self.publish(StatusDelta(core_pb2.StatusUpdate(**fields), secret=secret))
+
+    def _publish_votes(self, targets: Iterable[Optional[str]]):
+        # Votes for players that have left go with them
+        votes = self._vote_counts(t for t in targets if t in self.game.players)
+        self._publish(secret=self.game.is_night(), votes=votes, voted=self.game.voted)
+
+    def _vote_counts(self, targets: Iterable[str]):
+        # Counts of absent targets are 0, which Counter returns without adding
+        players = self.game.players
+        votes = self.game.votes
+        return [
+            core_pb2.VoteCount(name=players[t].name, votes=votes[t])
+            for t in dict.fromkeys(targets)
+        ]
+
+
+# The state of one WatchStatus stream: turns the deltas of its session into
+# the updates of its player.
+class StatusWatch(object):
+    def __init__(self, feed: StatusFeed, token: str):
+        self.name = feed.game.get_player_name(token)
+        self.token = token
+        self.role = feed.game.players[token].role
+        self.first = feed.snapshot(token)
+        # Set once the player has left the session
+        self.done = False
+
+    def view(self, delta: StatusDelta) -> Optional[core_pb2.StatusUpdate]:
+        update = delta.update
+        if update.full:
+            self.role = Role.NOBODY
+        if delta.roles is not None:
+            self.role = delta.roles.get(self.token, Role.NOBODY)
+            update = core_pb2.StatusUpdate(role=self.role.value)
+        if delta.secret and self.role != Role.MAFIA:
+            return None
+        if self.name in update.left:
+            self.done = True
+        return update
@@ -1,5 +1,21 @@
+from typing import Dict, Tuple
+import json
 import random
+import re
 import string
+import zlib
+
+SCOREBOARD_URL = "http://scoreboard:5000/graphql"
+
+# Services the gRPC health service reports besides the server as a whole (""):
+# the game, SERVING once the sessions are recovered, and the chat sink,
+# SERVING while connected to RabbitMQ
+GAME_HEALTH = "GameCore"
+CHAT_HEALTH = "chat"
+
+
+# Session IDs name their log files and chat routing keys (`<id>.all`)
+SESSION_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
 
 
 def make_player_token() -> str:
@@ -12,5 +28,31 @@ def make_session_id() -> str:
     )
 
 
+def get_shard(session_id: str, shards: int) -> int:
+    # Stable across processes, unlike hash()
+    return zlib.crc32(session_id.encode("utf-8")) % shards
+
+
+def validate_session_id(session_id: str) -> bool:
+    return SESSION_ID.fullmatch(session_id) is not None
+
+
 def validate_player_name(name: str) -> bool:
     return bool(name)
+
+
+def make_scores_mutation(scores: Dict[str, Tuple[int, int]]) -> str:
+    # One aliased updateGame per game: {session ID: (townies, mafia)}
+    fields = " ".join(
+        f"g{i}: updateGame(gameID:{json.dumps(session_id)}, "
+        f"towniesScore:{t}, mafiaScore:{m}) {{id}}"
+        for i, (session_id, (t, m)) in enumerate(scores.items())
+    )
+    return json.dumps({"query": f"mutation {{ {fields} }}"})
+
+
+def backoff_delay(attempt: int, low: float, high: float) -> float:
+    # Exponential backoff with jitter, so that the instances that lost the
+    # same peer do not all come back to it at once
+    delay = min(high, low * 2 ** min(attempt, 16))
+    return random.uniform(delay / 2, delay)
@@ -0,0 +1,94 @@
+# Compares loading the profiles of a lobby one GET /profile/info at a time
+# with a single POST /profile/info:batchGet, against game-info under
+# gunicorn, at growing lobby sizes. The one-at-a-time client keeps its
+# connection alive, so the difference is the round trips alone.
+# Run from services/info: python3 bench/bench_batch.py
+import http.client
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import tempfile
+import time
+
+PORT = 5082
+LOBBIES = [10, 100, 500]
+RUNS = 20
+
+
+def start_server(data_dir: str) -> subprocess.Popen:
+    env = dict(os.environ, INFO_DATA_DIR=data_dir, INFO_BIND=f"127.0.0.1:{PORT}")
+    server = subprocess.Popen(
+        ["gunicorn", "-c", "gunicorn.conf.py", "--access-logfile", "/dev/null"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            request(connect(), "GET", "/profile/image/stats")
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("game-info did not start")
+
+
+def connect() -> http.client.HTTPConnection:
+    return http.client.HTTPConnection("127.0.0.1", PORT, timeout=30)
+
+
+def request(conn, method: str, path: str, body=None) -> bytes:
+    conn.request(method, path, body=body, headers={"Accept-Encoding": "gzip"})
+    response = conn.getresponse()
+    data = response.read()
+    assert response.status == 200, data
+    return data
+
+
+def timed(run) -> float:
+    # Median milliseconds of run()
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1e3
+
+
+def main():
+    data_dir = tempfile.mkdtemp()
+    server = start_server(data_dir)
+    try:
+        conn = connect()
+        profiles = [
+            {"username": f"player{i}", "gender": "f", "email": f"player{i}@example.com"}
+            for i in range(max(LOBBIES))
+        ]
+        body = json.dumps({"profiles": profiles})
+        request(conn, "POST", "/profile/info:batchUpsert", body)
+
+        print(f"{'players':>7} {'one by one ms':>13} {'batchGet ms':>11}")
+        for size in LOBBIES:
+            names = [f"player{i}" for i in range(size)]
+            body = json.dumps({"usernames": names})
+
+            def one_by_one():
+                for name in names:
+                    request(conn, "GET", f"/profile/info?username={name}")
+
+            def batch():
+                request(conn, "POST", "/profile/info:batchGet", body)
+
+            print(f"{size:>7} {timed(one_by_one):>13.1f} {timed(batch):>11.1f}")
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    main()
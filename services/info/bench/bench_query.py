@@ -0,0 +1,75 @@
+# Measures /profile/query lookups on the username index against the linear
+# re.match scan it replaced, at growing numbers of profiles.
+# Run from services/info: python3 bench/bench_query.py
+import os
+import random
+import re
+import statistics
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import search  # noqa: E402
+
+SIZES = [10_000, 100_000, 1_000_000]
+LIMIT = 100
+QUERIES = 200
+# The linear scan is slow enough at 1M with fewer runs
+LINEAR_QUERIES = 5
+
+
+def make_names(count: int, rng: random.Random):
+    letters = string.ascii_lowercase + string.digits
+    return ["".join(rng.choices(letters, k=8)) for _ in range(count)]
+
+
+def timed(queries, run) -> float:
+    # Median microseconds of run(query)
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        run(query)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1e6
+
+
+def page(index, pattern: str):
+    prefix, literal = search.literal_prefix(pattern)
+    match = None if literal else search.compile_pattern(pattern)
+    return index.page(prefix, "", LIMIT, match)
+
+
+def linear(names, pattern: str):
+    return [name for name in names if re.match(pattern, name)]
+
+
+def main():
+    rng = random.Random(1)
+    print(
+        f"{'profiles':>9} {'build ms':>9} {'insert us':>10} {'prefix us':>10} "
+        f"{'regex us':>9} {'linear us':>10}"
+    )
+    for size in SIZES:
+        names = make_names(size, rng)
+        start = time.perf_counter()
+        index = search.UsernameIndex(names)
+        build = time.perf_counter() - start
+
+        extra = make_names(QUERIES, rng)
+        insert = timed(extra, index.add)
+        # Two-character prefixes, about size / 1300 matches each, and regexes
+        # narrowed by the same prefixes
+        prefixes = [name[:2] for name in rng.sample(names, QUERIES)]
+        prefix = timed(prefixes, lambda p: page(index, p))
+        regex = timed([p + "[0-9]" for p in prefixes], lambda p: page(index, p))
+        scan = timed(prefixes[:LINEAR_QUERIES], lambda p: linear(names, p))
+        print(
+            f"{size:>9} {build * 1e3:>9.0f} {insert:>10.1f} {prefix:>10.1f} "
+            f"{regex:>9.1f} {scan:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# Measures the throughput of game-info under gunicorn as its request threads
+# grow, on a mix of profile reads, profile writes and avatar uploads. Uploads
+# come in slowly, like from a phone, and hold a thread while they do, which
+# is what a single-threaded server serializes everything behind.
+# Run from services/info: python3 bench/bench_serving.py
+import http.client
+import os
+import random
+import shutil
+import signal
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+PORT = 5081
+THREADS = [1, 2, 4, 8]
+CLIENTS = 16
+DURATION = 5.0
+PROFILES = 200
+# Share of reads and writes, the rest are uploads
+READS = 0.80
+WRITES = 0.15
+# An upload of UPLOAD_KB, sent in UPLOAD_CHUNKS pieces UPLOAD_PAUSE apart
+UPLOAD_KB = 64
+UPLOAD_CHUNKS = 8
+UPLOAD_PAUSE = 0.005
+
+
+def start_server(threads: int, data_dir: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        INFO_DATA_DIR=data_dir,
+        INFO_THREADS=str(threads),
+        INFO_BIND=f"127.0.0.1:{PORT}",
+    )
+    server = subprocess.Popen(
+        ["gunicorn", "-c", "gunicorn.conf.py", "--access-logfile", "/dev/null"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            request(connect(), "GET", "/profile/info?username=player0")
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("game-info did not start")
+
+
+def connect() -> http.client.HTTPConnection:
+    return http.client.HTTPConnection("127.0.0.1", PORT, timeout=30)
+
+
+def request(conn, method: str, path: str, body=None, headers={}) -> int:
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+
+def upload_form(boundary: str, image: bytes) -> bytes:
+    head = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="avatar.jpg"\r\n'
+        "Content-Type: image/jpeg\r\n\r\n"
+    ).encode()
+    return head + image + f"\r\n--{boundary}--\r\n".encode()
+
+
+def slowly(data: bytes):
+    step = len(data) // UPLOAD_CHUNKS + 1
+    for i in range(0, len(data), step):
+        time.sleep(UPLOAD_PAUSE)
+        yield data[i : i + step]
+
+
+def client(seed: int, deadline: float, latencies: dict, errors: list):
+    rng = random.Random(seed)
+    conn = connect()
+    image = rng.randbytes(UPLOAD_KB * 1024)
+    while time.monotonic() < deadline:
+        username = f"player{rng.randrange(PROFILES)}"
+        kind = rng.random()
+        start = time.perf_counter()
+        if kind < READS:
+            op = "read"
+            status = request(conn, "GET", f"/profile/info?username={username}")
+        elif kind < READS + WRITES:
+            op = "write"
+            body = f'{{"gender": "{rng.choice("mf")}"}}'
+            status = request(conn, "POST", f"/profile/info?username={username}", body)
+        else:
+            op = "upload"
+            boundary = uuid.uuid4().hex
+            form = upload_form(boundary, image)
+            headers = {
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+                "Content-Length": str(len(form)),
+            }
+            path = f"/profile/image?username={username}"
+            status = request(conn, "POST", path, slowly(form), headers)
+        if status != 200:
+            errors.append((op, status))
+        latencies[op].append(time.perf_counter() - start)
+
+
+def run(threads: int):
+    data_dir = tempfile.mkdtemp()
+    server = start_server(threads, data_dir)
+    try:
+        conn = connect()
+        for i in range(PROFILES):
+            request(conn, "POST", f"/profile/info?username=player{i}", "{}")
+        conn.close()
+
+        latencies = {"read": [], "write": [], "upload": []}
+        errors = []
+        deadline = time.monotonic() + DURATION
+        clients = [
+            threading.Thread(target=client, args=(i, deadline, latencies, errors))
+            for i in range(CLIENTS)
+        ]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        shutil.rmtree(data_dir)
+
+    total = sum(len(times) for times in latencies.values())
+    p50 = {
+        op: statistics.median(times) * 1e3 for op, times in latencies.items() if times
+    }
+    p99 = {
+        op: statistics.quantiles(times, n=100)[98] * 1e3
+        for op, times in latencies.items()
+        if len(times) > 1
+    }
+    print(
+        f"{threads:>7} {total / DURATION:>7.0f} "
+        f"{p50.get('read', 0):>8.1f} {p99.get('read', 0):>8.1f} "
+        f"{p50.get('write', 0):>9.1f} {p50.get('upload', 0):>10.1f} {len(errors):>6}"
+    )
+
+
+def main():
+    print(
+        f"{CLIENTS} clients for {DURATION:.0f}s each, {READS:.0%} reads, "
+        f"{WRITES:.0%} writes, the rest {UPLOAD_KB} KB uploads "
+        f"over {UPLOAD_CHUNKS * UPLOAD_PAUSE * 1e3:.0f} ms, on {os.cpu_count()} CPUs"
+    )
+    print(
+        f"{'threads':>7} {'req/s':>7} {'read p50':>8} {'read p99':>8} "
+        f"{'write p50':>9} {'upload p50':>10} {'errors':>6}"
+    )
+    for threads in THREADS:
+        run(threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Compares a lobby page of full avatars with one of thumbnails: the bytes
+# sent, the time game-info takes to serve them, cold and cached, and the
+# time a client takes to decode them.
+# Run from services/info: python3 bench/bench_thumbnails.py
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ["INFO_DATA_DIR"] = tempfile.mkdtemp()
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from PIL import Image, ImageFilter  # noqa: E402
+
+import main as game_info  # noqa: E402
+
+PLAYERS = 20
+AVATAR_SIZE = 1024
+THUMBNAIL_SIZE = "64"
+
+
+def make_avatar(rng: random.Random) -> bytes:
+    # Smooth shapes over noise compress about like a photo
+    image = Image.effect_noise((AVATAR_SIZE, AVATAR_SIZE), 40).convert("RGB")
+    overlay = Image.new("RGB", image.size, tuple(rng.randrange(256) for _ in range(3)))
+    image = Image.blend(image, overlay, 0.6).filter(ImageFilter.GaussianBlur(2))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def load_page(client, size: str = ""):
+    # Seconds to fetch and to decode the avatars of all players, and bytes
+    query = f"&size={size}" if size else ""
+    start = time.perf_counter()
+    bodies = []
+    for i in range(PLAYERS):
+        response = client.get(f"/profile/image?username=player{i}{query}")
+        assert response.status_code == 200, response.data
+        bodies.append(response.data)
+    fetched = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for body in bodies:
+        Image.open(io.BytesIO(body)).load()
+    decoded = time.perf_counter() - start
+    return fetched, decoded, sum(len(body) for body in bodies)
+
+
+def main():
+    rng = random.Random(1)
+    client = game_info.app.test_client()
+    for i in range(PLAYERS):
+        client.post(f"/profile/info?username=player{i}", json={})
+        client.post(
+            f"/profile/image?username=player{i}",
+            data={"file": (io.BytesIO(make_avatar(rng)), "avatar.jpg", "image/jpeg")},
+        )
+
+    print(f"{PLAYERS} avatars of {AVATAR_SIZE}x{AVATAR_SIZE}, one lobby page each:")
+    print(f"{'page':>16} {'KB':>8} {'serve ms':>9} {'decode ms':>10}")
+    pages = [
+        ("full", ""),
+        ("thumbnail cold", THUMBNAIL_SIZE),
+        ("thumbnail cached", THUMBNAIL_SIZE),
+    ]
+    for name, size in pages:
+        fetched, decoded, total = load_page(client, size)
+        print(
+            f"{name:>16} {total / 1024:>8.1f} "
+            f"{fetched * 1e3:>9.1f} {decoded * 1e3:>10.1f}"
+        )
+    print(game_info.thumbnailer.metrics())
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        shutil.rmtree(os.environ["INFO_DATA_DIR"])
@@ -0,0 +1,21 @@
+# Production serving of game-info: gunicorn -c gunicorn.conf.py
+import os
+
+wsgi_app = "main:app"
+pythonpath = "src"
+bind = os.environ.get("INFO_BIND", "0.0.0.0:5000")
+
+# The profiles live in the memory of one process, which is also the only
+# writer of the journal, so requests are served by threads of that process.
+# They overlap on disk and network IO: uploads, sendfile of images, the
+# journal, and resizing in Pillow, which releases the GIL
+worker_class = "gthread"
+workers = 1
+threads = int(os.environ.get("INFO_THREADS", "8"))
+# Keep-alive connections wait for their next request off the threads
+keepalive = 5
+# Slow uploads from mobile clients
+timeout = 60
+graceful_timeout = 10
+
+accesslog = "-"
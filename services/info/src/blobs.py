@@ -0,0 +1,119 @@
+from collections import Counter
+from typing import BinaryIO, Iterable, Tuple
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+
+# Uploads are hashed and written in chunks of this many bytes
+CHUNK = 64 * 1024
+
+
+# Content-addressed store of uploaded files on local disk.
+#
+# A blob is named by the SHA-256 of its content, so identical uploads are kept
+# once. Uploads are streamed to a temporary file while being hashed, then
+# renamed into place, so a blob on disk is always complete and never changes.
+# Blobs are shared: the store counts the references its users hold and
+# deletes a blob along with the last one, and with the variants derived from
+# it, like thumbnails, which are kept next to it.
+class BlobStore(object):
+    def __init__(self, root: str):
+        self.root = root
+        self.tmp = os.path.join(root, "tmp")
+        os.makedirs(self.tmp, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.refs: Counter = Counter()
+
+    def path(self, digest: str) -> str:
+        # Fanned out by the first byte, to keep directories small
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def variant_path(self, digest: str, name: str) -> str:
+        return f"{self.path(digest)}.{name}"
+
+    def put(self, stream: BinaryIO) -> Tuple[str, int]:
+        # Stores the stream and takes a reference to it, returns its digest
+        # and size
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp)
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = stream.read(CHUNK)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            key = digest.hexdigest()
+            path = self.path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self.lock:
+                if os.path.exists(path):
+                    os.unlink(tmp_path)
+                else:
+                    os.replace(tmp_path, path)
+                self.refs[key] += 1
+            return key, size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def put_variant(self, digest: str, name: str, data: bytes):
+        # Variants can be derived again, so they are written without fsync
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        with self.lock:
+            if digest in self.refs:
+                os.replace(tmp_path, self.variant_path(digest, name))
+            else:
+                # Released while it was being derived
+                os.unlink(tmp_path)
+
+    def ref(self, digest: str):
+        # Takes a reference to a blob already on disk, like those of the
+        # profiles loaded on startup
+        with self.lock:
+            self.refs[digest] += 1
+
+    def release(self, digest: str):
+        with self.lock:
+            self.refs[digest] -= 1
+            if self.refs[digest] > 0:
+                return
+            del self.refs[digest]
+            path = self.path(digest)
+            for file in [path] + glob.glob(glob.escape(path) + ".*"):
+                try:
+                    os.unlink(file)
+                except FileNotFoundError:
+                    pass
+
+    def sweep(self) -> int:
+        # Deletes the blobs nobody references and the leftovers of uploads
+        # interrupted by a crash. Call once the references are taken
+        removed = 0
+        with self.lock:
+            for path in self._files():
+                name = os.path.relpath(path, self.root).replace(os.sep, "")
+                # Variants go with their blob
+                if name.split(".")[0] not in self.refs:
+                    os.unlink(path)
+                    removed += 1
+        return removed
+
+    def _files(self) -> Iterable[str]:
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            for blob in os.scandir(entry.path):
+                if blob.is_file():
+                    yield blob.path
@@ -0,0 +1,61 @@
+from typing import Dict, Iterable, Optional, Tuple
+import json
+import os
+import threading
+
+
+# Append-only log of the profiles, replayed on startup.
+#
+# Each line is a JSON record of a whole profile after a change, or its
+# username alone once the profile is deleted, so the last line of a username
+# wins. Loading compacts the log down to one line per live profile.
+class ProfileJournal(object):
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def load(self) -> Dict[str, dict]:
+        records: Dict[str, dict] = dict()
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line, written during a crash
+                        break
+                    if len(record) == 1:
+                        records.pop(record["username"], None)
+                    else:
+                        records[record["username"]] = record
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records.values():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "a", encoding="utf-8")
+        return records
+
+    def write(self, username: str, record: Optional[dict]):
+        # None deletes the profile
+        self.write_many([(username, record)])
+
+    def write_many(self, records: Iterable[Tuple[str, Optional[dict]]]):
+        # Appended with a single flush
+        lines = "".join(
+            json.dumps(record if record is not None else {"username": username}) + "\n"
+            for username, record in records
+        )
+        with self.lock:
+            self.file.write(lines)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
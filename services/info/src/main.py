@@ -1,32 +1,41 @@
-from dataclasses import dataclass
-from typing import Dict, Optional, List
-import json
-import re
+from typing import Dict, Iterable, Optional, Tuple
+import atexit
 import io
+import json
+import os
 
-from flask import Flask, send_file, request
-
+from flask import Flask, Response, send_file, request
 
-@dataclass
-class PlayerProfile:
-    username: str
-    image: Optional[bytes] = None
-    image_type: str = ""
-    gender: str = ""
-    email: str = ""
+from responses import http_time, is_fresh, json_response, json_stream_response
+from store import PlayerProfile, ProfileStore
+import search
+import thumbnails
 
-    def get_info(self):
-        return {
-            "username": self.username,
-            "gender": self.gender,
-            "email": self.email,
-            "has_image": bool(self.image),
-        }
+# Profiles and their images are kept here across restarts
+DATA_DIR = os.environ.get("INFO_DATA_DIR", "data")
+# Clients and shared caches reuse an image this long before they revalidate it
+IMAGE_MAX_AGE = int(os.environ.get("IMAGE_MAX_AGE", "60"))
+# Profiles returned by one /profile/query page, by default and at most
+QUERY_LIMIT = 100
+QUERY_MAX_LIMIT = 1000
+# Usernames or profiles taken by one batch request at most
+BATCH_MAX = 1000
+# The fields of a profile set by its owner
+PROFILE_FIELDS = ("gender", "email")
+# Threads resizing images for ?size=, and the memory kept for the results
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", "2"))
+THUMBNAIL_CACHE_MB = int(os.environ.get("THUMBNAIL_CACHE_MB", "32"))
 
 
 app = Flask(__name__)
 
-profiles: Dict[str, PlayerProfile] = dict()
+# Shared by the request threads, see gunicorn.conf.py
+store = ProfileStore(DATA_DIR)
+thumbnailer = thumbnails.Thumbnailer(
+    store.blobs, THUMBNAIL_WORKERS, cache_bytes=THUMBNAIL_CACHE_MB * 2**20
+)
+atexit.register(thumbnailer.close)
+atexit.register(store.close)
 
 
 @app.get("/profile/info")
@@ -34,9 +43,10 @@ def get_info():
     username = request.args.get("username")
     if not username:
         return "Missing query parameter: username", 400
-    if username not in profiles:
+    profile = store.get(username)
+    if profile is None:
         return f"Unknown username: {username}", 404
-    return json.dumps(profiles[username].get_info())
+    return json_response(profile.get_info(), last_modified=profile.updated)
 
 
 @app.put("/profile/info")
@@ -44,9 +54,10 @@ def put_info():
     username = request.args.get("username")
     if not username:
         return "Missing query parameter: username", 400
-    if username not in profiles:
+    profile = store.get(username)
+    if profile is None:
         return f"Unknown username: {username}", 404
-    return json.dumps(profiles[username].get_info())
+    return json_response(profile.get_info())
 
 
 @app.post("/profile/info")
@@ -54,13 +65,12 @@ def post_info():
     username = request.args.get("username")
     if not username:
         return "Missing query parameter: username", 400
-    data = request.get_json(force=True)
-    if username not in profiles:
-        profiles[username] = PlayerProfile(username)
-    if "gender" in data:
-        profiles[username].gender = data["gender"]
-    if "email" in data:
-        profiles[username].gender = data["email"]
+    try:
+        fields = profile_fields(request.get_json(force=True))
+    except ValueError as e:
+        return f"Invalid profile: {e}", 400
+    profile = store.update(username, create=True, **fields)
+    return json_response(profile.get_info())
 
 
 @app.delete("/profile/info")
@@ -68,26 +78,109 @@ def delete_info():
     username = request.args.get("username")
     if not username:
         return "Missing query parameter: username", 400
-    data = request.get_json(force=True)
-    if username in profiles:
-        return f"Username is already taken: {username}"
-    profiles[username] = PlayerProfile(username)
-    if "gender" in data:
-        profiles[username].gender = data["gender"]
-    if "email" in data:
-        profiles[username].gender = data["email"]
+    profile = store.delete(username)
+    if profile is None:
+        return f"Unknown username: {username}", 404
+    return json_response(profile.get_info())
+
+
+@app.post("/profile/info:batchGet")
+def batch_get_info():
+    # The profiles of {"usernames": [...]}, see stream_profiles
+    data = request.get_json(force=True, silent=True)
+    names = data.get("usernames") if isinstance(data, dict) else None
+    if not isinstance(names, list) or not all(
+        isinstance(name, str) and name for name in names
+    ):
+        return 'Expected a JSON body: {"usernames": [string, ...]}', 400
+    if len(names) > BATCH_MAX:
+        return f"Too many usernames: {len(names)}, expected at most {BATCH_MAX}", 400
+    # Each username once, looked up while the response is sent
+    profiles = ((name, store.get(name)) for name in dict.fromkeys(names))
+    return json_stream_response(stream_profiles(profiles))
+
+
+@app.post("/profile/info:batchUpsert")
+def batch_upsert_info():
+    # Creates or changes the profiles of {"profiles": [{"username": ...,
+    # "gender": ..., "email": ...}, ...]}, all of them or none, and returns
+    # them like batchGet. A username given twice takes its last fields
+    data = request.get_json(force=True, silent=True)
+    records = data.get("profiles") if isinstance(data, dict) else None
+    if not isinstance(records, list):
+        return 'Expected a JSON body: {"profiles": [object, ...]}', 400
+    if len(records) > BATCH_MAX:
+        return f"Too many profiles: {len(records)}, expected at most {BATCH_MAX}", 400
+    updates = []
+    for i, record in enumerate(records):
+        try:
+            fields = profile_fields(record)
+        except ValueError as e:
+            return f"Invalid profile {i}: {e}", 400
+        username = record.get("username")
+        if not isinstance(username, str) or not username:
+            return f"Invalid profile {i}: missing username", 400
+        updates.append((username, fields))
+    profiles = {profile.username: profile for profile in store.upsert_many(updates)}
+    return json_stream_response(stream_profiles(profiles.items()))
+
+
+def profile_fields(record) -> Dict[str, str]:
+    # The PROFILE_FIELDS set in a JSON object, which must be strings
+    if not isinstance(record, dict):
+        raise ValueError("expected an object")
+    fields = {key: record[key] for key in PROFILE_FIELDS if key in record}
+    for key, value in fields.items():
+        if not isinstance(value, str):
+            raise ValueError(f"{key} must be a string")
+    return fields
+
+
+def stream_profiles(
+    profiles: Iterable[Tuple[str, Optional[PlayerProfile]]],
+) -> Iterable[str]:
+    # {"profiles": [...], "missing": [...]}: the info of each profile, and
+    # the usernames without one, in order
+    missing = []
+    separator = ""
+    yield '{"profiles": ['
+    for username, profile in profiles:
+        if profile is None:
+            missing.append(username)
+            continue
+        yield separator + json.dumps(profile.get_info())
+        separator = ", "
+    yield f'], "missing": {json.dumps(missing)}}}'
 
 
 @app.get("/profile/query")
 def get_query():
+    # A page of the profiles whose usernames match the pattern (re.match),
+    # in order, after the `cursor` of the previous page. Patterns that are
+    # just a prefix are answered from the index alone, others are matched
+    # against the usernames that start with their literal prefix
     username = request.args.get("username")
     if not username:
         return "Missing query parameter: username", 400
-    result = []
-    for k, v in profiles.items():
-        if re.match(username, k):
-            result.append(v.get_info())
-    return json.dumps(result)
+    limit = request.args.get("limit", str(QUERY_LIMIT))
+    if not limit.isdigit() or not 0 < int(limit) <= QUERY_MAX_LIMIT:
+        return f"Invalid limit: {limit}, expected 1 to {QUERY_MAX_LIMIT}", 400
+    prefix, literal = search.literal_prefix(username)
+    match = None
+    if not literal:
+        try:
+            match = search.compile_pattern(username)
+        except search.PatternError as e:
+            return f"Invalid pattern: {e}", 400
+    try:
+        result, cursor = store.query(
+            prefix, request.args.get("cursor", ""), int(limit), match
+        )
+    except TimeoutError:
+        return "Pattern takes too long to match", 400
+    return json_response(
+        {"profiles": [profile.get_info() for profile in result], "cursor": cursor}
+    )
 
 
 @app.get("/profile/image")
@@ -95,19 +188,68 @@ def get_image():
     username = request.args.get("username")
     if not username:
         return "Missing query parameter: username", 400
-    if username not in profiles:
+    profile = store.get(username)
+    if profile is None:
         return f"Unknown username: {username}", 404
-    image = profiles[username]
-    if not image:
-        return f"User does not have an image", 404
+    if not profile.image_hash:
+        return "User does not have an image", 404
+    if "size" in request.args:
+        return get_thumbnail(profile, request.args["size"])
+    # Served from the file, by sendfile where the WSGI server supports it.
+    # The content hash is a strong ETag, which also allows Range requests
+    try:
+        return send_file(
+            store.blobs.path(profile.image_hash),
+            mimetype=profile.image_type,
+            as_attachment=True,
+            download_name=f"{username}.jpg",
+            etag=profile.image_hash,
+            last_modified=profile.image_time,
+            max_age=IMAGE_MAX_AGE,
+        )
+    except FileNotFoundError:
+        # Replaced or deleted meanwhile
+        return "User does not have an image", 404
+
+
+def get_thumbnail(profile: PlayerProfile, size: str):
+    # The image fitted in a size x size box
+    if not size.isdigit() or int(size) not in thumbnails.SIZES:
+        sizes = ", ".join(map(str, thumbnails.SIZES))
+        return f"Invalid size: {size}, expected one of {sizes}", 400
+    size = int(size)
+
+    # Answered before the thumbnail is looked up
+    etag = f"{profile.image_hash}-{size}"
+    if is_fresh(etag, http_time(profile.image_time)):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = IMAGE_MAX_AGE
+        return response
+
+    try:
+        data, mimetype = thumbnailer.get(profile.image_hash, size)
+    except FileNotFoundError:
+        return "User does not have an image", 404
+    except thumbnails.ThumbnailError as e:
+        return str(e), 415
     return send_file(
-        io.BytesIO(image),
-        mimetype=profiles[username].image_type,
+        io.BytesIO(data),
+        mimetype=mimetype,
         as_attachment=True,
-        download_name=f"{username}.jpg",
+        download_name=f"{profile.username}.{thumbnails.EXTENSIONS[mimetype]}",
+        etag=etag,
+        last_modified=profile.image_time,
+        max_age=IMAGE_MAX_AGE,
     )
 
 
+@app.get("/profile/image/stats")
+def get_image_stats():
+    return json_response({"thumbnails": thumbnailer.metrics()})
+
+
 @app.post("/profile/image")
 def post_image():
     username = request.args.get("username")
@@ -118,12 +260,14 @@ def post_image():
     file = request.files["file"]
     if file.filename == "":
         return "No selected file", 400
-    if username not in profiles:
+    if store.get(username) is None:
         return f"Unknown username: {username}", 404
-    profile: PlayerProfile = profiles[username]
     if file and file.mimetype.startswith("image/"):
-        profile.image_type = file.mimetype
-        profile.image = file.stream.read()
+        profile = store.set_image(username, file.stream, file.mimetype)
+        if profile is None:
+            # Deleted during the upload
+            return f"Unknown username: {username}", 404
+        return json_response(profile.get_info())
     else:
         return f"Invalid mime-type: {file.mimetype}", 400
 
@@ -133,10 +277,12 @@ def delete_image():
     username = request.args.get("username")
     if not username:
         return "Missing query parameter: username", 400
-    if username not in profiles:
+    profile = store.clear_image(username)
+    if profile is None:
         return f"Unknown username: {username}", 404
-    profiles[username].image = None
+    return json_response(profile.get_info())
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, threaded=False)
+    # For development, production runs gunicorn with gunicorn.conf.py
+    app.run(host="0.0.0.0", port=5000, threaded=True)
@@ -0,0 +1,126 @@
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, Optional
+import gzip
+import hashlib
+import json
+import zlib
+
+from flask import Response, request
+from werkzeug.http import is_resource_modified
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies are sent as they are, compressing them saves less than the
+# Content-Encoding and Vary headers cost
+MIN_COMPRESS_SIZE = 512
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Streamed responses are compressed and sent in pieces of about this size
+STREAM_CHUNK = 16 * 1024
+
+# Profiles are personal and change at any time: caches may keep them, but
+# revalidate them on every use, which costs a 304 while they are unchanged
+JSON_CACHE_CONTROL = "private, no-cache"
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def choose_encoding(size: Optional[int]) -> Optional[str]:
+    # The encoding the client prefers, brotli on a tie. A size of None is a
+    # stream, which is compressed whatever its length
+    if size is not None and size < MIN_COMPRESS_SIZE:
+        return None
+    encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(encodings)
+
+
+def http_time(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+def is_fresh(etag: str, last_modified: Optional[datetime] = None) -> bool:
+    # Whether a GET or HEAD is conditional on the version the client has
+    return request.method in ["GET", "HEAD"] and not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
+    )
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def json_response(value, last_modified: Optional[float] = None) -> Response:
+    # A JSON response with a strong ETag of its content, which GET and HEAD
+    # requests turn into a 304 when the client has it already
+    body = json.dumps(value).encode("utf-8")
+    response = Response(mimetype="application/json")
+    response.headers["Cache-Control"] = JSON_CACHE_CONTROL
+    response.vary.add("Accept-Encoding")
+
+    # A strong ETag names one representation, so each encoding has its own
+    encoding = choose_encoding(len(body))
+    etag = content_hash(body)
+    if encoding is not None:
+        etag += f"-{encoding}"
+    response.set_etag(etag)
+    modified = None
+    if last_modified is not None:
+        modified = http_time(last_modified)
+        response.last_modified = modified
+
+    if is_fresh(etag, modified):
+        response.status_code = 304
+        return response
+
+    if encoding is not None:
+        body = compress(body, encoding)
+        response.content_encoding = encoding
+    response.set_data(body)
+    return response
+
+
+def json_stream_response(parts: Iterable[str]) -> Response:
+    # A JSON document sent as its parts are made, which are only iterated
+    # once the response is being sent. Each piece is compressed and flushed
+    # on its own, so the client can parse the start while the rest is made
+    encoding = choose_encoding(None)
+    response = Response(stream_body(parts, encoding), mimetype="application/json")
+    response.headers["Cache-Control"] = "no-store"
+    response.vary.add("Accept-Encoding")
+    if encoding is not None:
+        response.content_encoding = encoding
+    return response
+
+
+def stream_body(parts: Iterable[str], encoding: Optional[str]) -> Iterator[bytes]:
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush = compressor.process, compressor.flush
+        finish = compressor.finish
+    elif encoding == "gzip":
+        # wbits of 31 writes the gzip header and trailer
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        process = compressor.compress
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    else:
+        process, flush, finish = (lambda data: data), (lambda: b""), (lambda: b"")
+
+    pending = []
+    size = 0
+    for part in parts:
+        pending.append(part)
+        size += len(part)
+        if size >= STREAM_CHUNK:
+            yield process("".join(pending).encode("utf-8")) + flush()
+            pending.clear()
+            size = 0
+    yield process("".join(pending).encode("utf-8")) + finish()
@@ -0,0 +1,160 @@
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from typing import Callable, Iterable, List, Optional, Tuple
+import re
+import threading
+import time
+
+# The regex module can time out a single match, which catastrophic patterns
+# need. Without it, the scan deadline is only checked between usernames
+try:
+    import regex
+except ImportError:
+    regex = None
+
+# Usernames per block of the index: an insert shifts at most twice as many
+LOAD = 512
+# Time a pattern may take on one username, and a page on all it looks at
+MATCH_TIMEOUT = 0.01
+SCAN_TIMEOUT = 0.05
+# The deadline is checked once per this many usernames
+DEADLINE_EVERY = 64
+
+SPECIAL = set(".^$*+?{}[]\\|()")
+# Make the character before them optional
+OPTIONAL = set("*?{")
+
+Match = Callable[[str], bool]
+
+
+class PatternError(ValueError):
+    pass
+
+
+def literal_prefix(pattern: str) -> Tuple[str, bool]:
+    # The text every username matched by the pattern (with re.match) starts
+    # with, and whether any username that starts with it matches
+    if "|" in pattern:
+        return "", False
+    if pattern.startswith("^"):
+        pattern = pattern[1:]
+    prefix = []
+    for i, c in enumerate(pattern):
+        if c not in SPECIAL:
+            prefix.append(c)
+            continue
+        if c in OPTIONAL and prefix:
+            prefix.pop()
+            return "".join(prefix), False
+        return "".join(prefix), pattern[i:] == ".*"
+    return "".join(prefix), True
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern: str) -> Match:
+    # The match of a pattern, which raises TimeoutError on a username it
+    # takes too long on. Invalid patterns are not cached
+    engine = regex if regex is not None else re
+    try:
+        compiled = engine.compile(pattern)
+    except engine.error as e:
+        raise PatternError(str(e))
+    if regex is not None:
+        return lambda name: compiled.match(name, timeout=MATCH_TIMEOUT) is not None
+    return lambda name: compiled.match(name) is not None
+
+
+# Usernames in sorted order, for prefix queries in O(log N + k).
+#
+# The names are kept in blocks of LOAD to 2 * LOAD, with the largest name of
+# each block in `maxes`: a name is found by bisecting `maxes`, then its block,
+# and an insert or delete only shifts its block. Pages are read under the
+# lock, so a scan never sees a block being changed.
+class UsernameIndex(object):
+    def __init__(self, names: Iterable[str] = ()):
+        self.lock = threading.Lock()
+        names = sorted(names)
+        self.blocks: List[List[str]] = [
+            names[i : i + LOAD] for i in range(0, len(names), LOAD)
+        ]
+        self.maxes: List[str] = [block[-1] for block in self.blocks]
+        self.size = len(names)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, name: str):
+        with self.lock:
+            if not self.blocks:
+                self.blocks.append([name])
+                self.maxes.append(name)
+                self.size += 1
+                return
+            i = min(bisect_left(self.maxes, name), len(self.maxes) - 1)
+            block = self.blocks[i]
+            j = bisect_left(block, name)
+            if j < len(block) and block[j] == name:
+                return
+            block.insert(j, name)
+            self.maxes[i] = block[-1]
+            self.size += 1
+            if len(block) > 2 * LOAD:
+                self.blocks[i : i + 1] = [block[:LOAD], block[LOAD:]]
+                self.maxes[i : i + 1] = [block[LOAD - 1], block[-1]]
+
+    def remove(self, name: str):
+        with self.lock:
+            i = bisect_left(self.maxes, name)
+            if i == len(self.maxes):
+                return
+            block = self.blocks[i]
+            j = bisect_left(block, name)
+            if block[j] != name:
+                return
+            del block[j]
+            self.size -= 1
+            if block:
+                self.maxes[i] = block[-1]
+            else:
+                del self.blocks[i]
+                del self.maxes[i]
+
+    def page(
+        self,
+        prefix: str,
+        after: str = "",
+        limit: int = 100,
+        match: Optional[Match] = None,
+    ) -> Tuple[List[str], Optional[str]]:
+        # Up to `limit` names that start with `prefix`, come after `after`
+        # and are accepted by `match`. Also returns the cursor of the next
+        # page, the last name looked at, or None once there are no more.
+        # A page cut short by SCAN_TIMEOUT may hold fewer names
+        deadline = time.monotonic() + SCAN_TIMEOUT
+        names = []
+        looked = 0
+        with self.lock:
+            if after >= prefix:
+                i = bisect_right(self.maxes, after)
+                find = bisect_right
+                start = after
+            else:
+                i = bisect_left(self.maxes, prefix)
+                find = bisect_left
+                start = prefix
+            if i == len(self.blocks):
+                return names, None
+            j = find(self.blocks[i], start)
+            for block in self.blocks[i:]:
+                for name in block[j:]:
+                    if not name.startswith(prefix):
+                        return names, None
+                    if match is None or match(name):
+                        names.append(name)
+                        if len(names) == limit:
+                            return names, name
+                    looked += 1
+                    if looked % DEADLINE_EVERY == 0 and time.monotonic() > deadline:
+                        return names, name
+                j = 0
+        return names, None
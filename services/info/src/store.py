@@ -0,0 +1,166 @@
+from dataclasses import asdict, dataclass, replace
+from typing import BinaryIO, Dict, List, Optional, Tuple
+import os
+import threading
+import time
+
+from blobs import BlobStore
+from journal import ProfileJournal
+import search
+
+
+@dataclass(frozen=True)
+class PlayerProfile:
+    username: str
+    # SHA-256 of the image in the blob store, empty without one
+    image_hash: str = ""
+    image_size: int = 0
+    image_type: str = ""
+    # When the image was uploaded and the profile last changed, for
+    # Last-Modified
+    image_time: float = 0.0
+    updated: float = 0.0
+    gender: str = ""
+    email: str = ""
+
+    def get_info(self):
+        return {
+            "username": self.username,
+            "gender": self.gender,
+            "email": self.email,
+            "has_image": bool(self.image_hash),
+        }
+
+
+# The profiles of game-info, their images and the username index, shared by
+# the request threads.
+#
+# Profiles are immutable: a change replaces the profile of a username with a
+# new one, under the lock, along with its journal record and index entry.
+# Readers take a profile without locking and always see a consistent one.
+# Images are written to the blob store before the lock is taken, so a slow
+# upload holds up no other request.
+class ProfileStore(object):
+    def __init__(self, data_dir: str):
+        self.blobs = BlobStore(os.path.join(data_dir, "images"))
+        self.journal = ProfileJournal(os.path.join(data_dir, "profiles.log"))
+        self.lock = threading.Lock()
+
+        # Only the metadata of the profiles is kept in memory
+        self.profiles: Dict[str, PlayerProfile] = dict()
+        for username, record in self.journal.load().items():
+            profile = PlayerProfile(**record)
+            self.profiles[username] = profile
+            if profile.image_hash:
+                self.blobs.ref(profile.image_hash)
+        removed = self.blobs.sweep()
+        print(f"Loaded {len(self.profiles)} profiles, removed {removed} unused images")
+        self.usernames = search.UsernameIndex(self.profiles)
+
+    def get(self, username: str) -> Optional[PlayerProfile]:
+        return self.profiles.get(username)
+
+    def update(
+        self, username: str, create: bool = False, **fields
+    ) -> Optional[PlayerProfile]:
+        # Sets the fields of a profile, or of a new one with `create`.
+        # Returns None for unknown usernames
+        with self.lock:
+            old = self.profiles.get(username)
+            if old is None and not create:
+                return None
+            if old is None:
+                old = PlayerProfile(username)
+                self.usernames.add(username)
+            return self._put(replace(old, **fields))
+
+    def upsert_many(self, updates: List[Tuple[str, dict]]) -> List[PlayerProfile]:
+        # Sets the fields of each username, creating its profile if needed,
+        # with one lock and one journal flush for the whole batch
+        with self.lock:
+            result = []
+            for username, fields in updates:
+                old = self.profiles.get(username)
+                if old is None:
+                    old = PlayerProfile(username)
+                    self.usernames.add(username)
+                result.append(self._set(replace(old, **fields)))
+            self.journal.write_many((p.username, asdict(p)) for p in result)
+        return result
+
+    def delete(self, username: str) -> Optional[PlayerProfile]:
+        with self.lock:
+            profile = self.profiles.pop(username, None)
+            if profile is None:
+                return None
+            self.usernames.remove(username)
+            self.journal.write(username, None)
+        if profile.image_hash:
+            self.blobs.release(profile.image_hash)
+        return profile
+
+    def set_image(
+        self, username: str, stream: BinaryIO, mimetype: str
+    ) -> Optional[PlayerProfile]:
+        if username not in self.profiles:
+            return None
+        digest, size = self.blobs.put(stream)
+        with self.lock:
+            old = self.profiles.get(username)
+            if old is not None:
+                profile = self._put(
+                    replace(
+                        old,
+                        image_hash=digest,
+                        image_size=size,
+                        image_type=mimetype,
+                        image_time=time.time(),
+                    )
+                )
+        # The replaced image, or the new one if the profile is gone
+        if old is None:
+            self.blobs.release(digest)
+            return None
+        if old.image_hash:
+            self.blobs.release(old.image_hash)
+        return profile
+
+    def clear_image(self, username: str) -> Optional[PlayerProfile]:
+        with self.lock:
+            old = self.profiles.get(username)
+            if old is None:
+                return None
+            profile = self._put(
+                replace(old, image_hash="", image_size=0, image_type="", image_time=0.0)
+            )
+        if old.image_hash:
+            self.blobs.release(old.image_hash)
+        return profile
+
+    def query(
+        self,
+        prefix: str,
+        after: str,
+        limit: int,
+        match: Optional[search.Match] = None,
+    ) -> Tuple[List[PlayerProfile], Optional[str]]:
+        # See search.UsernameIndex.page. Profiles deleted since the page was
+        # read are left out
+        names, cursor = self.usernames.page(prefix, after, limit, match)
+        profiles = [self.profiles.get(name) for name in names]
+        return [p for p in profiles if p is not None], cursor
+
+    def close(self):
+        self.journal.close()
+
+    def _put(self, profile: PlayerProfile) -> PlayerProfile:
+        # With the lock held
+        profile = self._set(profile)
+        self.journal.write(profile.username, asdict(profile))
+        return profile
+
+    def _set(self, profile: PlayerProfile) -> PlayerProfile:
+        # With the lock held, the caller writes the journal
+        profile = replace(profile, updated=time.time())
+        self.profiles[profile.username] = profile
+        return profile
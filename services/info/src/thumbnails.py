@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from concurrent import futures
+from typing import BinaryIO, Dict, Optional, Tuple
+import io
+import threading
+
+from PIL import Image, ImageOps
+
+from blobs import BlobStore
+
+# Boxes thumbnails are fitted in. Other sizes are refused, so that clients
+# cannot fill the cache and the disk with variants
+SIZES = (32, 64, 128, 256)
+JPEG_QUALITY = 80
+
+# Variant extension -> Pillow format and mimetype. Images with transparency
+# become PNGs, all others JPEGs
+FORMATS = {"jpg": ("JPEG", "image/jpeg"), "png": ("PNG", "image/png")}
+# And back, for the file names of thumbnails
+EXTENSIONS = {mimetype: ext for ext, (_, mimetype) in FORMATS.items()}
+
+Thumbnail = Tuple[bytes, str]
+
+
+class ThumbnailError(Exception):
+    pass
+
+
+def make_thumbnail(file: BinaryIO, size: int) -> Tuple[bytes, str]:
+    # Returns the encoded thumbnail and its variant extension
+    with Image.open(file) as image:
+        # JPEGs are decoded at a fraction of their size right away
+        image.thumbnail((size, size))
+        image = ImageOps.exif_transpose(image)
+        alpha = image.mode in ["RGBA", "LA", "PA"] or "transparency" in image.info
+        if alpha:
+            image, ext, options = image.convert("RGBA"), "png", {"optimize": True}
+        else:
+            image, ext, options = image.convert("RGB"), "jpg", {"quality": JPEG_QUALITY}
+        out = io.BytesIO()
+        image.save(out, FORMATS[ext][0], **options)
+        return out.getvalue(), ext
+
+
+# Resized variants of the images in a BlobStore.
+#
+# Thumbnails are made by a pool of worker threads (Pillow releases the GIL
+# while it decodes, resizes and encodes) and stored next to their image, so
+# they are made once per image and size. The most recently used ones are also
+# kept in memory, up to `cache_bytes`. Concurrent requests for the same
+# thumbnail wait for the same worker. Entries are keyed by content hash, so
+# they never go stale: those of deleted images are simply not asked for again.
+class Thumbnailer(object):
+    def __init__(self, blobs: BlobStore, workers: int = 2, cache_bytes: int = 2**25):
+        self.blobs = blobs
+        self.pool = futures.ThreadPoolExecutor(workers, thread_name_prefix="thumbnail")
+        self.cache_bytes = cache_bytes
+
+        self.lock = threading.Lock()
+        # (digest, size) -> thumbnail, least recently used first
+        self.cache: "OrderedDict[Tuple[str, int], Thumbnail]" = OrderedDict()
+        self.cached_bytes = 0
+        self.pending: Dict[Tuple[str, int], futures.Future] = dict()
+        self.counters: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "made": 0,
+            "loaded": 0,
+        }
+
+    def get(self, digest: str, size: int) -> Thumbnail:
+        # The thumbnail and its mimetype. Raises FileNotFoundError once the
+        # image is gone, ThumbnailError if it cannot be decoded
+        key = (digest, size)
+        with self.lock:
+            thumbnail = self.cache.get(key)
+            if thumbnail is not None:
+                self.cache.move_to_end(key)
+                self.counters["hits"] += 1
+                return thumbnail
+            self.counters["misses"] += 1
+            future = self.pending.get(key)
+            if future is None:
+                future = self.pool.submit(self._load, digest, size)
+                self.pending[key] = future
+        return future.result()
+
+    def metrics(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counters, bytes=self.cached_bytes, entries=len(self.cache))
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+    def _load(self, digest: str, size: int) -> Thumbnail:
+        key = (digest, size)
+        try:
+            thumbnail = self._read(digest, size)
+            if thumbnail is None:
+                thumbnail = self._make(digest, size)
+            self._put(key, thumbnail)
+            return thumbnail
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def _read(self, digest: str, size: int) -> Optional[Thumbnail]:
+        # Made before, maybe by an earlier process
+        for ext, (_, mimetype) in FORMATS.items():
+            try:
+                with open(self.blobs.variant_path(digest, f"{size}.{ext}"), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            self._count("loaded")
+            return data, mimetype
+        return None
+
+    def _make(self, digest: str, size: int) -> Thumbnail:
+        with open(self.blobs.path(digest), "rb") as f:
+            try:
+                data, ext = make_thumbnail(f, size)
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                raise ThumbnailError("Cannot resize the image") from e
+        self.blobs.put_variant(digest, f"{size}.{ext}", data)
+        self._count("made")
+        return data, FORMATS[ext][1]
+
+    def _put(self, key: Tuple[str, int], thumbnail: Thumbnail):
+        size = len(thumbnail[0])
+        if size > self.cache_bytes:
+            return
+        with self.lock:
+            if key in self.cache:
+                return
+            self.cache[key] = thumbnail
+            self.cached_bytes += size
+            while self.cached_bytes > self.cache_bytes:
+                _, (data, _) = self.cache.popitem(last=False)
+                self.cached_bytes -= len(data)
+                self.counters["evictions"] += 1
+
+    def _count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1